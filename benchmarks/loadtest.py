@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Load test of the watchlist endpoints with concurrent HTTP clients.
+
+``run`` seeds a temporary database with ``flask forge --movies N
+--messages N --seed S``, serves the app from a local threaded WSGI server
+(or targets ``--url``) and drives each scenario with ``--clients`` threads
+for ``--duration`` seconds.  The report (p50/p95/p99 latency, RPS, errors
+and peak RSS) is printed and written as JSON.  The local server runs
+without the login rate limit; start a ``--url`` target with
+``LOGIN_RATE_LIMIT_ENABLED=0`` for the login scenario.  ``compare`` diffs
+two reports and exits with status 1 on a regression::
+
+    python benchmarks/loadtest.py run --movies 10000 --messages 100000 -o new.json
+    python benchmarks/loadtest.py compare base.json new.json --threshold 10
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+USERNAME, PASSWORD = 'bench', 'bench'
+
+
+class Client(object):
+    """Minimal keep-alive HTTP client that remembers the session cookie."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.cookie = None
+        self.conn = None
+
+    def request(self, method, path, form = None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        for attempt in range(2):  # 服务器关闭了空闲连接时重连一次
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout = 30)
+                self.conn.connect()
+                # 关闭 Nagle 算法，否则保持的连接上小请求会等待对方的延迟确认（约 40ms）
+                self.conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+        return response.status
+
+    def login(self):
+        return self.request('POST', '/login', {'username': USERNAME, 'password': PASSWORD})
+
+
+# 每个场景：(是否需要登录, 发出一次请求的函数)
+def _scenarios(movie_ids):
+    def index(client):
+        return client.request('GET', '/')
+
+    def message(client):
+        return client.request('GET', '/message')
+
+    def login(client):
+        return client.login()
+
+    def edit(client):
+        movie_id = next(movie_ids['edit'])
+        client.request('GET', '/movie/edit/%d' % movie_id)
+        return client.request('POST', '/movie/edit/%d' % movie_id, {'title': 'Edited %d' % movie_id, 'year': '2000'})
+
+    def delete(client):
+        return client.request('POST', '/movie/delete/%d' % next(movie_ids['delete']))
+
+    return {
+        'index': (False, index),
+        'message': (False, message),
+        'login': (False, login),
+        'edit': (True, edit),
+        'delete': (True, delete),
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def drive(url, scenario, needs_login, clients, duration):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker():
+        client = Client(url)
+        if needs_login:
+            client.login()
+        local, failed = [], 0
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                status = scenario(client)
+            except (http.client.HTTPException, OSError, StopIteration):
+                status = None
+            local.append(time.perf_counter() - start)
+            if status is None or status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target = worker) for _ in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+    }
+
+
+def start_local_server(args):
+    """Seed a temporary database and serve the app on a random port."""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class RequestHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'  # 保持连接，避免每个请求都重新建立 TCP 连接
+        disable_nagle_algorithm = True  # 否则测得的是延迟确认的等待时间，而不是程序的耗时
+
+        def log_request(self, *args, **kwargs):  # 不输出每个请求的访问日志
+            pass
+    from watchlist import create_app
+
+    directory = tempfile.mkdtemp(prefix = 'watchlist-bench-')
+    app = create_app('production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    app.config['RESPONSE_CACHE_DIR'] = os.path.join(directory, 'page_cache')
+    # 所有客户端用同一个地址和用户名登录，开启限流时 login 场景测得的几乎都是 429
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    runner = app.test_cli_runner()
+    with app.app_context():
+        runner.invoke(args = ['initdb'])
+        runner.invoke(args = ['forge', '--movies', str(args.movies), '--messages', str(args.messages),
+                              '--seed', str(args.seed)])
+        runner.invoke(args = ['admin', '--username', USERNAME, '--password', PASSWORD])
+
+    server = make_server('127.0.0.1', 0, app, threaded = True, request_handler = RequestHandler)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT,
+                                       universal_newlines = True, stderr = subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_local_server(args)
+
+    # 编辑从第一部电影开始，删除从最后一部开始，两者互不影响
+    movie_ids = {'edit': itertools.cycle(range(1, max(args.movies, 1) + 1)),
+                 'delete': iter(range(max(args.movies, 1), 0, -1))}
+    scenarios = _scenarios(movie_ids)
+    names = args.scenarios or list(scenarios)
+
+    report = {
+        'meta': {
+            'revision': git_revision(), 'python': platform.python_version(),
+            'movies': args.movies, 'messages': args.messages, 'seed': args.seed,
+            'clients': args.clients, 'duration': args.duration, 'url': args.url or 'local',
+        },
+        'scenarios': {},
+    }
+    for name in names:
+        needs_login, scenario = scenarios[name]
+        report['scenarios'][name] = drive(url, scenario, needs_login, args.clients, args.duration)
+    # 本地服务器与客户端在同一进程中，峰值内存包含两者（Linux 上单位为 KiB）
+    report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+    if server is not None:
+        server.shutdown()
+    output = json.dumps(report, indent = 2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = []
+    print('%-10s %12s %12s %10s %10s' % ('scenario', 'p95 base', 'p95 new', 'rps base', 'rps new'))
+    for name, old in sorted(base['scenarios'].items()):
+        current = new['scenarios'].get(name)
+        if current is None:
+            continue
+        print('%-10s %12s %12s %10s %10s' % (name, old['p95_ms'], current['p95_ms'], old['rps'], current['rps']))
+        limit = 1 + args.threshold / 100.0
+        if old['p95_ms'] and current['p95_ms'] and current['p95_ms'] > old['p95_ms'] * limit:
+            regressions.append('%s: p95 %.2fms -> %.2fms' % (name, old['p95_ms'], current['p95_ms']))
+        if current['rps'] * limit < old['rps']:
+            regressions.append('%s: rps %.1f -> %.1f' % (name, old['rps'], current['rps']))
+    if base.get('peak_rss_mb') and new.get('peak_rss_mb', 0) > base['peak_rss_mb'] * (1 + args.threshold / 100.0):
+        regressions.append('peak RSS %.1fMB -> %.1fMB' % (base['peak_rss_mb'], new['peak_rss_mb']))
+
+    for line in regressions:
+        print('REGRESSION ' + line)
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help = 'Seed, load and report.')
+    run_parser.add_argument('--url', help = 'Target an already running server instead of a local one.')
+    run_parser.add_argument('--movies', type = int, default = 1000)
+    run_parser.add_argument('--messages', type = int, default = 10000)
+    run_parser.add_argument('--seed', type = int, default = 0)
+    run_parser.add_argument('--clients', type = int, default = 8)
+    run_parser.add_argument('--duration', type = float, default = 10, help = 'Seconds per scenario.')
+    run_parser.add_argument('--scenario', dest = 'scenarios', action = 'append',
+                            choices = ['index', 'message', 'login', 'edit', 'delete'])
+    run_parser.add_argument('-o', '--output', help = 'Write the JSON report to this file.')
+    run_parser.set_defaults(func = run)
+
+    compare_parser = commands.add_parser('compare', help = 'Compare two JSON reports.')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type = float, default = 10, help = 'Allowed change in percent.')
+    compare_parser.set_defaults(func = compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Read throughput of the message list under concurrent guestbook writes.
+
+Runs the same workload twice against a temporary database file: once with
+SQLite's defaults (rollback journal, the "before" case) and once with the
+pragmas the app applies to every connection (``apply_sqlite_pragmas``)::
+
+    python benchmarks/sqlite_wal.py --seconds 5 --readers 4 --writers 2
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watchlist.database import apply_sqlite_pragmas  # noqa: E402
+
+PRAGMAS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_BUSY_TIMEOUT': 5000,
+    'SQLITE_MMAP_SIZE': 256 * 1024 * 1024,
+    'SQLITE_CACHE_SIZE': -20000,
+}
+
+
+def connect(path, tuned):
+    # timeout=0 时由 busy_timeout 决定等待时间；默认配置与 pysqlite 一致（等待 5 秒）
+    conn = sqlite3.connect(path, timeout = 0 if tuned else 5.0, check_same_thread = False)
+    if tuned:
+        apply_sqlite_pragmas(conn, PRAGMAS)
+    return conn
+
+
+def seed(path, rows, tuned):
+    conn = connect(path, tuned)
+    conn.execute('CREATE TABLE message (id INTEGER PRIMARY KEY, name VARCHAR(20), content VARCHAR(200))')
+    conn.executemany('INSERT INTO message (name, content) VALUES (?, ?)',
+                     (('name %d' % i, 'content %d' % i) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def run(tuned, args):
+    fd, path = tempfile.mkstemp(suffix = '.db')
+    os.close(fd)
+    os.remove(path)
+    seed(path, args.rows, tuned)
+
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.time() + args.seconds
+
+    def reader():
+        conn = connect(path, tuned)
+        done = errors = 0
+        while time.time() < deadline:
+            try:
+                conn.execute('SELECT count(id) FROM message').fetchone()
+                conn.execute('SELECT id, name, content FROM message ORDER BY id DESC LIMIT 50').fetchall()
+                done += 1
+            except sqlite3.OperationalError:  # database is locked
+                errors += 1
+        with lock:
+            counts['reads'] += done
+            counts['errors'] += errors
+
+    def writer():
+        conn = connect(path, tuned)
+        done = errors = 0
+        while time.time() < deadline:
+            try:
+                conn.execute('INSERT INTO message (name, content) VALUES (?, ?)', ('bench', 'x' * 120))
+                conn.commit()
+                done += 1
+            except sqlite3.OperationalError:
+                conn.rollback()
+                errors += 1
+        with lock:
+            counts['writes'] += done
+            counts['errors'] += errors
+
+    threads = [threading.Thread(target = reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target = writer) for _ in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return {
+        'reads_per_second': round(counts['reads'] / args.seconds, 1),
+        'writes_per_second': round(counts['writes'] / args.seconds, 1),
+        'lock_errors': counts['errors'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--seconds', type = float, default = 5)
+    parser.add_argument('--readers', type = int, default = 4)
+    parser.add_argument('--writers', type = int, default = 2)
+    parser.add_argument('--rows', type = int, default = 100000)
+    args = parser.parse_args()
+
+    result = {'default': run(False, args), 'tuned': run(True, args)}
+    print(json.dumps(result, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
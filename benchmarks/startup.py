@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Worker startup time: imports, ``create_app`` and the first request.
+
+Each run is a fresh interpreter started with ``python -X importtime`` so
+the import cost is measured cold, the way a gunicorn worker pays it::
+
+    python benchmarks/startup.py --runs 5 --top 15
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import time
+start = time.perf_counter()
+from watchlist import create_app
+app = create_app('production', cli = %r)
+imported = time.perf_counter()
+app.test_client().get('/static/style.css')
+print(imported - start, time.perf_counter() - start)
+'''
+
+_LINE_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def run_once(cli):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE = '1')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT % cli],
+        cwd = ROOT, env = env, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+        universal_newlines = True, check = True,
+    )
+    create_app, first_request = map(float, proc.stdout.split())
+    modules = {}
+    for match in _LINE_RE.finditer(proc.stderr):
+        self_us, cumulative_us, indent, name = match.groups()
+        modules[name] = (int(self_us), int(cumulative_us))
+    return create_app, first_request, modules
+
+
+def measure(cli, runs, top):
+    results = [run_once(cli) for _ in range(runs)]
+    modules = results[-1][2]
+    # 按自身耗时排序，找出真正耗时的模块；watchlist 自身的模块按累计耗时列出
+    heaviest = sorted(modules.items(), key = lambda item: item[1][0], reverse = True)[:top]
+    own = sorted((name, times[1]) for name, times in modules.items() if name.startswith('watchlist'))
+    return {
+        'import_and_create_app_ms': round(statistics.median(r[0] for r in results) * 1000, 1),
+        'first_request_ms': round(statistics.median(r[1] for r in results) * 1000, 1),
+        'modules_imported': len(modules),
+        'heaviest_imports_self_ms': {name: round(t[0] / 1000.0, 1) for name, t in heaviest},
+        'watchlist_imports_ms': {name: round(us / 1000.0, 1) for name, us in own},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--runs', type = int, default = 5)
+    parser.add_argument('--top', type = int, default = 10)
+    args = parser.parse_args()
+    result = {
+        'worker': measure(False, args.runs, args.top),
+        'cli': measure(True, args.runs, args.top),
+    }
+    print(json.dumps(result, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,157 @@
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from watchlist import app, db
-from watchlist.models import User, Movie, Message
-from watchlist.commands import forge, initdb
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, quote, urlsplit
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+from watchlist import create_app, db
+from watchlist.cache import fragment_cache, response_cache, user_cache, FileBackend
+from watchlist.enrich import enrich_worker
+from watchlist.ingest import message_writer
+from watchlist.security import password_hasher
+from watchlist.metrics import init_metrics, N_PLUS_ONE, REQUEST_LATENCY
+from watchlist.sessions import init_sessions
+from watchlist.spam import reset_filter
+from watchlist.stats import rebuild_stats, summary
+from watchlist.models import User, Movie, Message, Version
+from watchlist.commands import forge, initdb, migrate, reindex, import_movies, import_messages, export_movies, \
+    train_spam, filter_spam
+from watchlist.config import TestingConfig
+
+# 设置 TEST_DATABASE_URL 在其他数据库（如 PostgreSQL）上运行测试时，跳过只适用于 SQLite 的测试
+requires_sqlite = unittest.skipUnless(TestingConfig.SQLALCHEMY_DATABASE_URI.startswith('sqlite'), 'SQLite only')
+
+# 每个进程（pytest -n 的每个 worker）一个临时目录，并行运行的测试互不干扰；
+# pip install -r requirements-dev.txt 后用 python -m pytest -n auto 在所有 CPU 核心上运行
+TEST_DIR = tempfile.mkdtemp(prefix = 'watchlist-test-')
+atexit.register(shutil.rmtree, TEST_DIR, True)
+# SQLite 时测试共用进程内的一个数据库文件，表只创建一次，每个测试在外层事务中运行、结束时回滚；
+# 其他数据库的序列不随事务回滚，测试中写死的 id 会失效，仍然每个测试建表、删表
+ROLLBACK_DATABASE_URI = 'sqlite:///' + os.path.join(TEST_DIR, 'test.db') \
+    if TestingConfig.SQLALCHEMY_DATABASE_URI.startswith('sqlite') else None
+_schemas = set()  # 已经建好表的数据库
+SESSION = db.session  # 程序使用的会话，回滚模式的测试结束后恢复
+
+
+def committing(test):
+    """Give ``test`` a fresh database of its own instead of a rolled-back
+    transaction, for tests that write from other connections or threads
+    (DDL through ``db.engine``, VACUUM, the message writer)."""
+    test.committing = True
+    return test
+
+
+class RollbackSession(scoped_session):
+    """Session bound to the test's connection.  ``remove()`` (called when a
+    CLI command or an app context ends) only empties the identity map, so
+    the outer transaction and the savepoint survive until ``tearDown``."""
+
+    def remove(self):
+        if self.registry.has():
+            self.registry().expunge_all()
+
+
+def restart_savepoint(session, transaction):
+    # 程序中的 commit() 释放保存点，rollback() 回到保存点，之后重新开始一个保存点
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+def reset_process_state(app):
+    """Stop the background workers of ``app`` and forget the module-level
+    caches and pools, which were built from its configuration."""
+    app.extensions['message_writer'].stop()
+    enrich_worker.stop()
+    password_hasher.stop()
+    reset_filter()
+    user_cache.clear()
+    response_cache.reset()  # 下一个测试按自己的配置重新创建缓存后端
+    fragment_cache.reset()
+
+
+class WatchlistTestCase(unittest.TestCase):
+    """Per-test app instance with the fixture rows; see ``committing``."""
 
-class SayHelloTestCase(unittest.TestCase):
-    
     def setUp(self):  # 测试固件，用来做一些准备工作以开启测试
-        # update configuration
-        app.config.update(
-            TESTING = True,  # 开启测试模式
-            SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  #使用内存型数据库，避免干扰开发时使用的数据库文件
-        )
-        # 创建数据库和表
-        db.create_all()
+        # 每个测试使用自己的程序实例（开启测试模式）
+        self.app = create_app('testing')
+        test = getattr(self, self._testMethodName)
+        self.transactional = ROLLBACK_DATABASE_URI is not None and not getattr(test, 'committing', False)
+        if self.transactional:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = ROLLBACK_DATABASE_URI
+        self.context = self.app.app_context()
+        self.context.push()
+        if self.transactional:
+            self.begin_transaction()
+        else:
+            db.create_all()  # 使用内存型数据库（或 TEST_DATABASE_URL），每个测试重新建表
+        user_cache.clear()  # 每个测试的数据都是新的，缓存的用户和页面也要清空
+        response_cache.clear()
+        fragment_cache.clear()
         # 创建测试用户和测试电影条目
         user = User(name = 'Test', username = 'test')
         user.set_password('123')
-        movie = Movie(title = 'Test Movie Title', year = '2020')
+        db.session.add(user)
+        db.session.flush()  # 生成用户 id
+        movie = Movie(title = 'Test Movie Title', year = '2020', user_id = user.id)
         message = Message(name = u'小江', content = u'电影真好看啊！')
         # 一次性添加多个模型类实例
-        db.session.add_all([user, movie, message])
+        db.session.add_all([movie, message])
         db.session.commit()
 
-        self.client = app.test_client()  # 创建测试客户端（浏览器），模拟客户端请求
-        self.runner = app.test_cli_runner()  # 创建测试命令运行器，可以用来测试编写的flask命令
+        self.client = self.app.test_client()  # 创建测试客户端（浏览器），模拟客户端请求
+        self.runner = self.app.test_cli_runner()  # 创建测试命令运行器，可以用来测试编写的flask命令
+
+    def begin_transaction(self):
+        if ROLLBACK_DATABASE_URI not in _schemas:
+            db.create_all()
+            _schemas.add(ROLLBACK_DATABASE_URI)
+        self.connection = db.engine.connect()
+        # pysqlite 默认在 SAVEPOINT 前不开始事务，改为手动 BEGIN
+        self.connection.connection.connection.isolation_level = None
+        self.transaction = self.connection.begin()
+        self.connection.execute('BEGIN')
+        session = RollbackSession(db.create_session({'bind': self.connection, 'binds': {}}),
+                                  scopefunc = threading.get_ident)
+        event.listen(session, 'after_transaction_end', restart_savepoint)
+        session.begin_nested()
+        db.session = session
 
     def tearDown(self):  # 测试固件，在每一个测试方法执行后被调用，防止前面的测试对后面的测试造成影响
-        db.session.remove()  # 清除数据库会话
-        db.drop_all()  # 删除所有数据库表
+        if self.transactional:
+            event.remove(db.session, 'after_transaction_end', restart_savepoint)
+            db.session.rollback()  # 先回到保存点，连接上的事务才会回到最外层
+            db.session.close()
+            db.session = SESSION
+            self.transaction.rollback()  # 撤销测试中的全部写入
+            self.connection.close()
+        else:
+            db.session.remove()  # 清除数据库会话
+            db.drop_all()  # 删除所有数据库表
+            _schemas.discard(self.app.config['SQLALCHEMY_DATABASE_URI'])  # 与回滚模式共用数据库时需要重新建表
+        reset_process_state(self.app)
+        self.context.pop()
+
+
+class SayHelloTestCase(WatchlistTestCase):
 
     # 测试app实例是否存在
     def test_app_exit(self):  
-        self.assertIsNotNone(app)
+        self.assertIsNotNone(self.app)
 
     # 测试程序是否处于测试模式
     def test_app_is_testing(self):  
-        self.assertTrue(app.config['TESTING'])
+        self.assertTrue(self.app.config['TESTING'])
 
     # 测试客户端
     # 测试404页面
@@ -141,6 +257,142 @@ class SayHelloTestCase(unittest.TestCase):
         self.assertIn('Item deleted.', data)
         self.assertNotIn('Test Movie Title', data)
 
+    # 测试软删除后可以在期限内撤销
+    def test_delete_undo(self):
+        self.login()
+        self.client.post('/movie/delete/1')
+        self.assertIsNotNone(Movie.query.get(1).deleted_at)
+        self.assertEqual(self.client.get('/search.json?q=Test').get_json()['total'], 0)
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Undo delete', data)
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+
+        data = self.client.post('/movie/undo', follow_redirects = True).get_data(as_text = True)
+        self.assertIn('1 items restored.', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Undo delete', data)
+        self.assertIsNone(Movie.query.get(1).deleted_at)
+
+        # 超过期限后不能撤销
+        self.client.post('/movie/delete/1')
+        with self.client.session_transaction() as sess:
+            sess['undo'] = dict(sess['undo'], until = 0)
+        data = self.client.post('/movie/undo', follow_redirects = True).get_data(as_text = True)
+        self.assertIn('Nothing to undo.', data)
+        self.assertNotIn('Test Movie Title', data)
+
+        # 撤销期限过后，重新验证缓存的页面不会得到 304，撤销按钮随之消失
+        db.session.add(Movie(title = 'Another', year = '2021', user_id = 1))
+        db.session.commit()
+        self.client.post('/movie/delete/%d' % Movie.query.filter_by(title = 'Another').first().id)
+        self.client.get('/')  # 取走提示消息
+        response = self.client.get('/')
+        self.assertIn('Undo delete', response.get_data(as_text = True))
+        self.assertIsNone(response.last_modified)
+        etag = response.headers['ETag']
+        self.assertEqual(self.client.get('/', headers = {'If-None-Match': etag}).status_code, 304)
+        with self.client.session_transaction() as sess:
+            sess['undo'] = dict(sess['undo'], until = 0)
+        response = self.client.get('/', headers = {'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Undo delete', response.get_data(as_text = True))
+
+    # 测试勾选多个条目后批量删除和修改年份
+    def test_bulk_actions(self):
+        db.session.add_all([Movie(title = 'Bulk %d' % i, year = '2000', user_id = 1) for i in range(3)])
+        db.session.commit()
+        self.login()
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('<input type="checkbox" name="ids" value="2" form="bulk">', data)
+
+        from watchlist.events import broker
+        with mock.patch.object(broker, 'publish') as publish:
+            data = self.client.post('/movie/bulk', data = {'ids': ['3', '2', '99'], 'action': 'year', 'year': '1999'},
+                                    follow_redirects = True).get_data(as_text = True)
+        self.assertIn('2 items updated.', data)
+        self.assertEqual(publish.call_args[0][1]['ids'], [2, 3])  # 事件中只有确实修改的条目
+        self.assertEqual([m.year for m in Movie.query.order_by(Movie.id)], ['2020', '1999', '1999', '2000'])
+        data = self.client.post('/movie/bulk', data = {'ids': ['2'], 'action': 'year', 'year': '19999'},
+                                follow_redirects = True).get_data(as_text = True)
+        self.assertIn('Invalid input.', data)
+
+        with mock.patch.object(broker, 'publish') as publish:
+            data = self.client.post('/movie/bulk', data = {'ids': ['1', '2', '3', '3', '99'], 'action': 'delete'},
+                                    follow_redirects = True).get_data(as_text = True)
+        self.assertIn('3 items deleted.', data)
+        self.assertEqual(publish.call_args[0][1]['ids'], [1, 2, 3])
+        self.assertIn('1 Titles', data)
+        self.assertIn('Bulk 2', data)
+        data = self.client.post('/movie/undo', follow_redirects = True).get_data(as_text = True)
+        self.assertIn('3 items restored.', data)
+        self.assertIn('4 Titles', data)
+
+    # 测试修改标题或年份后清空元数据，由下一次 flask enrich 重新获取；没有改变的条目保留元数据
+    def test_edit_clears_enrichment(self):
+        enriched = dict(external_id = 'tt1', rating = 8.5, poster_url = 'https://example.com/p.jpg',
+                        detail_url = 'https://example.com/tt1', enriched_at = datetime.utcnow())
+        db.session.add_all([Movie(title = 'Movie %d' % i, year = '2000', user_id = 1, **enriched) for i in range(4)])
+        Movie.query.filter_by(title = 'Test Movie Title').update(enriched)
+        db.session.commit()
+        enrichment = lambda movie_id: [getattr(Movie.query.get(movie_id), c) for c in Movie.ENRICH_COLUMNS]
+        self.login()
+
+        self.client.post('/movie/edit/1', data = dict(title = 'Renamed', year = '2019'))
+        self.assertEqual(enrichment(1), [None] * 5)
+        self.client.post('/movie/edit/2', data = dict(title = 'Movie 0', year = '2000'))  # 没有改变
+        self.assertEqual(enrichment(2)[:4], ['tt1', 8.5, 'https://example.com/p.jpg', 'https://example.com/tt1'])
+
+        self.client.post('/movie/bulk', data = {'ids': ['2', '3'], 'action': 'year', 'year': '2000'})
+        self.assertEqual(enrichment(3)[0], 'tt1')
+        self.client.post('/movie/bulk', data = {'ids': ['3'], 'action': 'year', 'year': '2001'})
+        self.assertEqual(enrichment(3), [None] * 5)
+        self.assertEqual(enrichment(2)[0], 'tt1')
+
+        response = self.client.post('/api/v1/movies/batch', json = {'update': [
+            {'id': 4, 'title': 'Movie 2 Renamed'}, {'id': 5, 'year': '2000'}]})
+        self.assertEqual(response.get_json()['updated'], 2)
+        self.assertEqual(enrichment(4), [None] * 5)
+        self.assertEqual(enrichment(5)[0], 'tt1')
+
+    # 测试服务端会话：Cookie 中只有会话 id，可以登出所有设备，过期的会话被清理
+    def test_server_sessions(self):
+        for kind in ('memory', 'sqlite'):
+            with tempfile.TemporaryDirectory() as tmp:
+                self.app.config.update(SESSION_STORE = kind, SESSION_DB = os.path.join(tmp, 'sessions.db'))
+                init_sessions(self.app)
+                store = self.app.session_interface.store
+                first, second = self.app.test_client(), self.app.test_client()
+                self.assertEqual(first.get('/').headers.get('Set-Cookie'), None)  # 匿名访问不创建会话
+                self.assertEqual(len(store), 0)
+
+                with first.session_transaction() as sess:
+                    sess['marker'] = 1
+                old_sid = first.cookie_jar._cookies['localhost.local']['/']['session'].value
+                for client in (first, second):
+                    response = client.post('/login', data = dict(username = 'test', password = '123'))
+                    cookie = response.headers['Set-Cookie']
+                    self.assertLess(len(cookie), 120)
+                    self.assertNotIn(old_sid, cookie)  # 登录后更换会话 id
+                self.assertIn('Login success.', first.get('/').get_data(as_text = True))  # 闪现消息保存在服务端
+                self.assertEqual(len(store), 2)
+                self.assertIn('Log out everywhere', first.get('/settings').get_data(as_text = True))
+
+                data = first.post('/logout/all', follow_redirects = True).get_data(as_text = True)
+                self.assertIn('Logged out of 2 sessions.', data)
+                self.assertIn('Login', data)
+                self.assertEqual(second.get('/settings').status_code, 302)
+
+                second.post('/login', data = dict(username = 'test', password = '123'))
+                store.sweep(time.time() + 32 * 86400)
+                self.assertEqual(len(store), 0)
+                self.assertEqual(second.get('/settings').status_code, 302)
+
+                # 读取到的是副本，原地修改不会影响保存的数据
+                store.set('sid', {'_flashes': [('message', 'Hi')]}, None, time.time() + 60)
+                store.get('sid', time.time())[0]['_flashes'].append(('message', 'Again'))
+                self.assertEqual(len(store.get('sid', time.time())[0]['_flashes']), 1)
+        self.app.config['SESSION_STORE'] = 'cookie'
+
     # 测试认证保护,对于未登录用户不能进行的操作
     def test_login_protect(self):
         response = self.client.get('/')
@@ -201,6 +453,80 @@ class SayHelloTestCase(unittest.TestCase):
         self.assertIn('Invalid input.', data)
         self.assertNotIn('Login success.', data)
         
+    # 测试登录限流：令牌用完后返回 429，且不再校验密码
+    def test_login_rate_limit(self):
+        self.app.config['LOGIN_RATE_LIMIT_PER_USERNAME'] = '2/60'
+        for _ in range(2):
+            response = self.client.post('/login', data = dict(username = 'test', password = '456'))
+            self.assertEqual(response.status_code, 302)
+        with mock.patch('watchlist.views.password_hasher.check') as check:
+            response = self.client.post('/login', data = dict(username = 'TEST', password = '123'))
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertIn('Too many login attempts', response.get_data(as_text = True))
+        check.assert_not_called()
+
+        # 其他用户名只受 IP 限制
+        response = self.client.post('/login', data = dict(username = 'other', password = '123'))
+        self.assertEqual(response.status_code, 302)
+
+    # 测试反向代理之后按 X-Forwarded-For 中的客户端地址限流
+    def test_login_rate_limit_proxy(self):
+        from watchlist.security import init_proxy_fix
+        self.app.config.update(LOGIN_RATE_LIMIT_PER_IP = '1/60', PROXY_FIX_X_FOR = 1)
+        init_proxy_fix(self.app)
+        login = lambda client_ip: self.client.post('/login', data = dict(username = 'test', password = '456'),
+                                                   headers = {'X-Forwarded-For': client_ip})
+        self.assertEqual(login('1.1.1.1').status_code, 302)
+        self.assertEqual(login('1.1.1.1').status_code, 429)
+        self.assertEqual(login('2.2.2.2').status_code, 302)  # 其他客户端不受影响
+
+    # 测试不存在的用户名同样会计算一次散列
+    def test_login_unknown_user_hashes(self):
+        with mock.patch('watchlist.views.password_hasher.check', return_value = True) as check:
+            response = self.client.post('/login', data = dict(username = 'nobody', password = '123'),
+                                        follow_redirects = True)
+        self.assertIn('Invalid username or password.', response.get_data(as_text = True))
+        check.assert_called_once()
+
+    # 测试 SQLite 令牌桶在多个实例（进程）之间共享
+    def test_login_rate_limit_sqlite(self):
+        from watchlist.security import SQLiteBucketStore
+        path = os.path.join(tempfile.mkdtemp(), 'login_rate.db')
+        first, second = SQLiteBucketStore(path, 10), SQLiteBucketStore(path, 10)
+        self.assertTrue(first.take('ip:1.2.3.4', 2, 60, 1000)[0])
+        self.assertTrue(second.take('ip:1.2.3.4', 2, 60, 1000)[0])
+        self.assertFalse(first.take('ip:1.2.3.4', 2, 60, 1000)[0])
+        self.assertTrue(second.take('ip:1.2.3.4', 2, 60, 1030)[0])  # 30 秒补充一个令牌
+
+    # 测试密码校验繁忙时返回 503
+    def test_login_password_pool_busy(self):
+        from watchlist.security import PasswordCheckUnavailable
+        with mock.patch('watchlist.views.password_hasher.check', side_effect = PasswordCheckUnavailable):
+            response = self.client.post('/login', data = dict(username = 'test', password = '123'))
+        self.assertEqual(response.status_code, 503)
+
+    # 测试旧参数的密码散列在登录成功后更新
+    def test_login_rehash(self):
+        from werkzeug.security import generate_password_hash
+        user = User.query.first()
+        user.password_hash = generate_password_hash('123', 'pbkdf2:sha1:1000')
+        db.session.commit()
+        self.login()
+        user = User.query.first()
+        self.assertTrue(user.password_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+        self.assertTrue(user.validate_password('123'))
+
+    # 测试在进程池中校验密码
+    def test_password_pool(self):
+        self.app.config['PASSWORD_POOL_SIZE'] = 1
+        try:
+            pwhash = password_hasher.hash('secret')
+            self.assertTrue(password_hasher.check(pwhash, 'secret'))
+            self.assertFalse(password_hasher.check(pwhash, 'wrong'))
+        finally:
+            password_hasher.stop()
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -289,6 +615,505 @@ class SayHelloTestCase(unittest.TestCase):
         self.assertIn('Invalid input.', data)
         self.assertNotIn('Message created.', data)
 
+    # 测试游标分页
+    def test_pagination(self):
+        db.session.add_all([Movie(title = 'Paged Movie %d' % i, year = '2020', user_id = 1) for i in range(5)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=2')
+        data = response.get_data(as_text = True)
+        self.assertIn('6 Titles', data)  # 总数由 COUNT(*) 计算，与当前页无关
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Paged Movie 0', data)
+        self.assertNotIn('Paged Movie 1', data)
+        self.assertIn('after=2', data)
+        self.assertNotIn('before=', data)
+
+        response = self.client.get('/?per_page=2&after=2')
+        data = response.get_data(as_text = True)
+        self.assertIn('Paged Movie 1', data)
+        self.assertIn('Paged Movie 2', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('before=3', data)
+        self.assertIn('after=4', data)
+
+        response = self.client.get('/?per_page=2&before=3')
+        data = response.get_data(as_text = True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Paged Movie 0', data)
+        self.assertNotIn('before=', data)
+
+        # 每页条数不能超过配置的上限
+        self.app.config['WATCHLIST_MAX_PER_PAGE'] = 3
+        try:
+            data = self.client.get('/?per_page=100').get_data(as_text = True)
+        finally:
+            self.app.config['WATCHLIST_MAX_PER_PAGE'] = 200
+        self.assertIn('Paged Movie 1', data)
+        self.assertNotIn('Paged Movie 2', data)
+
+    # 测试留言按时间倒序分页（游标为 created_at 和 id），实时推送只在最新的一页开启
+    def test_message_pagination(self):
+        self.app.config['EVENTS_ENABLED'] = True
+        now = datetime.utcnow()
+        db.session.add_all([Message(name = 'Tom', content = 'Paged %d' % i, created_at = now + timedelta(minutes = i))
+                            for i in range(3)])
+        # 导入的旧留言 id 最大，但按时间排在最后
+        db.session.add(Message(name = 'Old', content = 'Imported', created_at = now - timedelta(days = 365)))
+        db.session.commit()
+        cursor = lambda message: '%s_%d' % (message.created_at.isoformat(), message.id)
+        paged = Message.query.filter(Message.content.like('Paged %')).order_by(Message.id).all()
+
+        data = self.client.get('/message?per_page=2').get_data(as_text = True)
+        self.assertLess(data.index('Paged 2'), data.index('Paged 1'))
+        self.assertNotIn('Paged 0', data)
+        self.assertIn('data-live=', data)
+        self.assertIn('after=' + quote(cursor(paged[1])), data)
+
+        data = self.client.get('/message?per_page=2&after=' + cursor(paged[1])).get_data(as_text = True)
+        self.assertLess(data.index('Paged 0'), data.index(u'小江'))
+        self.assertNotIn('Imported', data)
+        self.assertNotIn('data-live=', data)
+        self.assertIn('before=' + quote(cursor(paged[0])), data)
+
+        data = self.client.get('/message?per_page=2&before=' + cursor(paged[0])).get_data(as_text = True)
+        self.assertIn('Paged 2', data)
+        self.assertIn('Paged 1', data)
+        self.assertNotIn('before=', data)
+
+        data = self.client.get('/message?per_page=2&after=' + cursor(Message.query.get(1))).get_data(as_text = True)
+        self.assertIn('Imported', data)
+        self.assertNotIn('after=', data)
+        self.assertEqual(self.client.get('/message?after=bogus').status_code, 200)  # 无效的游标当作第一页
+
+    # 测试用户缓存：稳定状态下渲染页面不再查询 user 表
+    def test_user_cache(self):
+        self.login()
+        self.client.get('/')
+
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            data = self.client.get('/').get_data(as_text = True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertIn('Logout', data)
+        self.assertFalse([s for s in statements if 'FROM user' in s])
+
+        # 其他进程修改了用户并增加版本号，开启共享模式后应重新加载
+        self.app.config.update(OWNER_CACHE_SHARED = True, OWNER_CACHE_CHECK_INTERVAL = 0)
+        try:
+            self.client.get('/')
+            User.query.get(1).name = 'Other Process'
+            Version.bump('user')
+            db.session.commit()
+            data = self.client.get('/').get_data(as_text = True)
+        finally:
+            self.app.config.update(OWNER_CACHE_SHARED = False, OWNER_CACHE_CHECK_INTERVAL = 1.0)
+        self.assertIn('Other Process\'s Watchlist', data)
+
+    # 测试匿名访问的整页缓存
+    def test_response_cache(self):
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertIn('Test Movie Title', response.get_data(as_text = True))
+        # 查询字符串不同，缓存键也不同
+        self.assertEqual(self.client.get('/?per_page=1').headers['X-Cache'], 'MISS')
+
+        # 登录用户不使用缓存；写操作更新版本号后不再命中旧的页面
+        self.login()
+        response = self.client.post('/', data = dict(title = 'Cached Movie', year = '2020'))
+        self.assertNotIn('X-Cache', response.headers)
+        self.client.get('/logout')
+
+        # 有待显示的提示消息时不使用缓存
+        response = self.client.get('/')
+        self.assertNotIn('X-Cache', response.headers)
+        self.assertIn('Goodbye.', response.get_data(as_text = True))
+
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn('Cached Movie', response.get_data(as_text = True))
+
+        # 缓存键包含版本号，写操作不清空缓存，其他页面仍然命中
+        self.client.get('/message')
+        self.client.post('/message', data = dict(name = 'Tom', content = 'Cached message'))
+        self.client.get('/message')  # 取走提示消息
+        self.assertEqual(self.client.get('/').headers['X-Cache'], 'HIT')
+        response = self.client.get('/message')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertIn('Cached message', response.get_data(as_text = True))
+
+    # 测试文件缓存：读到过期的条目时删除文件，条目数超过上限时删除最旧的文件
+    def test_file_cache_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = FileBackend(tmp, max_entries = 10)
+            backend.set('expired', 'value', timeout = 1)
+            with mock.patch('watchlist.cache.time.time', return_value = time.time() + 2):
+                self.assertIsNone(backend.get('expired'))
+            self.assertEqual(os.listdir(tmp), [])
+
+            for i in range(11):
+                backend.set('key%d' % i, i)
+                os.utime(backend._path('key%d' % i), (i, i))  # 修改时间依次递增
+            self.assertEqual(len(os.listdir(tmp)), 9)  # 超过上限后多删除十分之一
+            self.assertIsNone(backend.get('key0'))
+            self.assertIsNone(backend.get('key1'))
+            self.assertEqual(backend.get('key10'), 10)
+
+    # 测试多用户：每个用户有自己的清单，只能修改自己的条目
+    def test_multi_user(self):
+        result = self.runner.invoke(args = ['add-user', '--username', 'tom', '--password', '456'])
+        self.assertIn('Created user tom.', result.output)
+        result = self.runner.invoke(args = ['add-user', '--username', 'tom', '--password', '456'])
+        self.assertIn('already exists', result.output)
+
+        response = self.client.get('/u/tom')
+        self.assertIn('0 Titles', response.get_data(as_text = True))
+        etag = self.client.get('/u/test').headers['ETag']
+        self.assertEqual(self.client.get('/u/nobody').status_code, 404)
+
+        self.client.post('/login', data = dict(username = 'tom', password = '456'))
+        data = self.client.post('/', data = dict(title = 'Tom Movie', year = '2021'),
+                                follow_redirects = True).get_data(as_text = True)
+        self.assertIn('Tom Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        # 查看其他用户的清单时没有编辑按钮
+        data = self.client.get('/u/test').get_data(as_text = True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Edit', data)
+        self.client.get('/logout')
+        self.client.get('/')  # 取走提示消息
+
+        # 其他用户的修改不影响该用户页面的 ETag
+        self.assertEqual(self.client.get('/u/test', headers = {'If-None-Match': etag}).status_code, 304)
+        self.assertIn('Tom Movie', self.client.get('/u/tom').get_data(as_text = True))
+        self.assertNotIn('Tom Movie', self.client.get('/').get_data(as_text = True))
+
+        data = self.client.get('/api/v1/movies?user=tom&fields=title').get_json()
+        self.assertEqual(data['items'], [{'title': 'Tom Movie'}])
+        self.assertEqual(self.client.get('/api/v1/movies?user=nobody').status_code, 404)
+
+    # 测试创建管理员时接管没有所属用户的条目
+    def test_admin_adopts_orphan_movies(self):
+        Movie.query.delete()
+        User.query.delete()
+        db.session.commit()
+        self.runner.invoke(args = ['forge', '--movies', '3', '--seed', '1'])
+        self.assertEqual(Movie.query.filter_by(user_id = None).count(), 3)
+        self.runner.invoke(args = ['admin', '--username', 'grey', '--password', '123'])
+        user = User.query.first()
+        self.assertEqual(Movie.query.filter_by(user_id = user.id).count(), 3)
+
+    # 测试实时推送：写操作提交后推送事件，空闲时发送心跳，断开后取消订阅
+    def test_events(self):
+        from watchlist.events import broker
+        self.assertEqual(self.client.get('/events').status_code, 404)  # 默认关闭
+        self.assertNotIn('data-live=', self.client.get('/message').get_data(as_text = True))
+        self.app.config['EVENTS_ENABLED'] = True
+        self.app.config['EVENTS_HEARTBEAT'] = 0.01
+        response = self.client.get('/events?kind=message', buffered = False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(len(broker), 1)
+        stream = iter(response.response)
+        self.assertEqual(next(stream), b'retry: 3000\n\n')
+        self.assertEqual(next(stream), b': ping\n\n')
+
+        self.client.post('/message', data = dict(name = 'Tom', content = 'Live message'))
+        self.login()
+        self.client.post('/', data = dict(title = 'Live Movie', year = '2021'))  # 没有订阅 movie 事件
+        chunk = next(stream).decode('utf-8')
+        self.assertIn('event: message', chunk)
+        self.assertIn('"content": "Live message"', chunk)
+        self.assertEqual(next(stream), b': ping\n\n')
+        response.close()
+        self.assertEqual(len(broker), 0)
+
+        # 重连时按 Last-Event-ID 补发错过的事件
+        event_id = int(chunk.split('\n')[0].split(': ')[1])
+        self.client.post('/movie/delete/1')
+        response = self.client.get('/events', buffered = False, headers = {'Last-Event-ID': str(event_id)})
+        stream = iter(response.response)
+        next(stream)
+        chunks = [next(stream).decode('utf-8') for _ in range(2)]
+        self.assertIn('"action": "create"', chunks[0])
+        self.assertIn('"action": "delete"', chunks[1])
+        response.close()
+
+        self.app.config['EVENTS_MAX_CLIENTS'] = 0
+        self.assertEqual(self.client.get('/events').status_code, 503)
+
+    # 测试基于版本号的条件请求
+    def test_conditional_get(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/', headers = {'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        # 留言板的版本号变化不影响主页
+        self.client.post('/message', data = dict(name = 'Tom', content = 'Hi'))
+        self.client.get('/message')  # 取走提示消息
+        self.assertEqual(self.client.get('/', headers = {'If-None-Match': etag}).status_code, 304)
+
+        self.login()
+        self.client.post('/', data = dict(title = 'New Movie', year = '2020'))
+        self.client.get('/logout')
+        self.client.get('/')  # 取走提示消息
+        response = self.client.get('/', headers = {'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('Last-Modified', response.headers)
+        self.assertIn('New Movie', response.get_data(as_text = True))
+
+    # 测试每个 SQLite 连接都应用了 PRAGMA 配置
+    @requires_sqlite
+    def test_sqlite_pragmas(self):
+        self.assertEqual(db.session.execute('PRAGMA busy_timeout').scalar(), self.app.config['SQLITE_BUSY_TIMEOUT'])
+        self.assertEqual(db.session.execute('PRAGMA cache_size').scalar(), self.app.config['SQLITE_CACHE_SIZE'])
+        self.assertEqual(db.session.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+
+    # 测试全文搜索
+    @requires_sqlite
+    def test_search(self):
+        db.session.add_all([
+            Movie(title = 'My Neighbor Totoro', year = '1988'),
+            Movie(title = 'Totoro Totoro', year = '1988'),
+            Message(name = 'Tom', content = 'Totoro is great'),
+        ])
+        db.session.commit()
+
+        data = self.client.get('/search?q=totoro').get_data(as_text = True)
+        self.assertIn('2 results', data)
+        self.assertLess(data.index('Totoro Totoro'), data.index('My Neighbor Totoro'))  # 按相关度排序
+
+        # 前缀匹配，特殊字符不会破坏查询语法
+        response = self.client.get('/search.json?q=neighbor+tot"&kind=message')
+        self.assertEqual(response.get_json()['total'], 0)
+        response = self.client.get('/search.json?q=neighbor+tot"')
+        self.assertEqual(response.get_json()['items'], [{'id': 2, 'title': 'My Neighbor Totoro', 'year': '1988'}])
+        response = self.client.get('/search.json?q=gre&kind=message')
+        self.assertEqual(response.get_json()['items'][0]['name'], 'Tom')
+
+        # 修改和删除会通过触发器同步到索引
+        Movie.query.get(2).title = 'Leon'
+        db.session.delete(Movie.query.get(3))
+        db.session.commit()
+        self.assertEqual(self.client.get('/search.json?q=totoro').get_json()['total'], 0)
+        self.assertEqual(self.client.get('/search.json?q=leon').get_json()['total'], 1)
+
+        # 分页
+        db.session.add(Movie(title = 'Titanic', year = '1997'))
+        db.session.commit()
+        data = self.client.get('/search?q=t&per_page=1').get_data(as_text = True)
+        self.assertIn('2 results', data)
+        self.assertIn('page=2', data)
+        self.assertIn('per_page=1', data)
+
+        result = self.runner.invoke(reindex)
+        self.assertIn('Rebuilt search index.', result.output)
+        self.assertEqual(self.client.get('/search.json?q=titanic').get_json()['total'], 1)
+
+    # 测试留言异步写入
+    @committing
+    def test_message_async_ingest(self):
+        self.app.config.update(MESSAGE_INGEST_ASYNC = True, MESSAGE_INGEST_FLUSH_INTERVAL = 0.05)
+        try:
+            for i in range(3):
+                response = self.client.post('/message', data = dict(name = 'Tom', content = 'Queued %d' % i),
+                                            follow_redirects = True)
+                self.assertIn('Message received.', response.get_data(as_text = True))
+            message_writer.stop()  # 写入队列中剩余的留言
+            self.assertEqual(Message.query.filter_by(name = 'Tom').count(), 3)
+            # 每个程序实例有自己的写入队列，不会写入其他实例的数据库
+            self.assertIs(message_writer.app, self.app)
+            self.assertIsNot(create_app('testing').extensions['message_writer'], self.app.extensions['message_writer'])
+            from watchlist.events import message_event
+            self.assertNotIn('id', message_event({'name': 'Tom', 'content': 'Hi', 'created_at': datetime.utcnow()}))
+
+            # 队列已满时返回 503
+            with mock.patch.object(message_writer, 'submit', return_value = False):
+                response = self.client.post('/message', data = dict(name = 'Tom', content = 'Dropped'))
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Service Unavailable - 503', response.get_data(as_text = True))
+        finally:
+            self.app.config['MESSAGE_INGEST_ASYNC'] = False
+            message_writer.stop()
+
+    # 测试垃圾留言过滤：黑名单和朴素贝叶斯模型
+    def test_spam_filter(self):
+        tmpdir = tempfile.mkdtemp()
+        self.app.config.update(SPAM_BLOCKLIST = ['sarigalin.org'], SPAM_MODEL_PATH = os.path.join(tmpdir, 'model.npz'))
+        reset_filter()
+        try:
+            response = self.client.post('/message',
+                data = dict(name = 'Small T', content = 'proscar http://www.sarigalin.org/order-finasteride-uk/'),
+                follow_redirects = True
+            )
+            data = response.get_data(as_text = True)
+            self.assertIn('Message rejected as spam.', data)
+            self.assertEqual(Message.query.count(), 1)
+
+            # 训练模型后，不在黑名单中的垃圾留言也会被拒绝；已经加载了过滤器的进程按文件修改时间重新加载
+            with open(os.path.join(tmpdir, 'train.csv'), 'w') as f:
+                f.write('content,spam\n')
+                f.write('cheap viagra http://viagraoier.com/ price,1\n')
+                f.write('cialis generic http://cialisyytr.com/ cheapest,1\n')
+                f.write('viagra cialis online pharmacy discount,1\n')
+                f.write('I love this movie,0\n')
+                f.write('Totoro is a great movie,0\n')
+                f.write('电影真好看啊,0\n')
+            result = self.runner.invoke(train_spam, [os.path.join(tmpdir, 'train.csv')])
+            self.assertIn('Trained on 6 messages (3 spam).', result.output)
+
+            response = self.client.post('/message',
+                data = dict(name = 'Glavin', content = 'cheapest viagra http://viagraonline20up.com/'),
+                follow_redirects = True
+            )
+            self.assertIn('Message rejected as spam.', response.get_data(as_text = True))
+            response = self.client.post('/message',
+                data = dict(name = 'Tom', content = 'What a great movie'),
+                follow_redirects = True
+            )
+            self.assertIn('Message created.', response.get_data(as_text = True))
+
+            # 批量重新过滤已有留言
+            db.session.add(Message(name = 'Natasha', content = 'cialis 10 mg generic viagra'))
+            db.session.commit()
+            result = self.runner.invoke(filter_spam)
+            self.assertIn('Found 1 spam messages.', result.output)
+            result = self.runner.invoke(filter_spam, ['--delete'])
+            self.assertIn('Deleted 1 spam messages.', result.output)
+            self.assertEqual(Message.query.count(), 2)
+        finally:
+            self.app.config.update(SPAM_BLOCKLIST = [], SPAM_MODEL_PATH = '')
+            reset_filter()
+
+    # 测试 JSON API
+    def test_api(self):
+        db.session.add_all([Movie(title = 'API Movie %d' % i, year = '2021', user_id = 1) for i in range(3)])
+        db.session.commit()
+
+        data = self.client.get('/api/v1/movies?fields=title&per_page=2').get_json()
+        self.assertEqual(data['items'], [{'title': 'Test Movie Title'}, {'title': 'API Movie 0'}])
+        self.assertEqual(data['total'], 4)
+        data = self.client.get('/api/v1/movies?per_page=2&after=%d' % data['next_cursor']).get_json()
+        self.assertEqual(data['items'][0], {'id': 3, 'title': 'API Movie 1', 'year': '2021'})
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(self.client.get('/api/v1/movies?fields=password').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/messages?fields=name').get_json()['items'], [{'name': u'小江'}])
+
+        # 批量写入需要登录
+        batch = {'create': [{'title': 'Batch Movie', 'year': '2022'}],
+                 'update': [{'id': 1, 'title': 'Renamed'}], 'delete': [2, 3, 3]}
+        self.assertEqual(self.client.post('/api/v1/movies/batch', json = batch).status_code, 401)
+        self.login()
+
+        # 任何一项无效时整个批次都不会写入
+        bad = dict(batch, update = [{'id': 1, 'year': '20222'}, {'id': 99, 'title': 'Missing'}])
+        response = self.client.post('/api/v1/movies/batch', json = bad)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.get_json()['errors']), 2)
+        self.assertEqual(Movie.query.count(), 4)
+
+        response = self.client.post('/api/v1/movies/batch', json = batch)
+        self.assertEqual(response.get_json(), {'created': 1, 'updated': 1, 'deleted': 2})
+        self.assertEqual(Movie.query.get(1).title, 'Renamed')
+        self.assertEqual(Movie.query.get(1).year, '2020')
+        self.assertIsNotNone(Movie.query.get(2).deleted_at)  # 软删除，之后由 flask purge 清除
+        self.assertEqual(self.client.get('/api/v1/movies').get_json()['total'], 3)
+        self.assertEqual(Movie.query.filter_by(title = 'Batch Movie').count(), 1)
+
+        response = self.client.post('/api/v1/messages/batch', json = {'create': [{'name': 'Tom', 'content': 'Hi'}]})
+        self.assertEqual(response.get_json(), {'created': 1, 'updated': 0, 'deleted': 0, 'rejected': 0})
+        self.assertEqual(self.client.post('/api/v1/messages/batch', json = [1]).status_code, 400)
+
+    # 测试模板片段缓存
+    def test_fragment_cache(self):
+        self.login()
+        self.client.get('/')
+        # 直接修改数据库但不更新版本号，页面仍显示缓存的片段
+        Movie.query.get(1).title = 'Silently Changed'
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Edit', data)
+
+        # 版本号变化后片段失效；登录状态不同使用不同的片段
+        Version.bump(Movie.version_key(1))
+        db.session.commit()
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Silently Changed', data)
+        self.client.get('/logout')
+        self.client.get('/')  # 取走提示消息
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Silently Changed', data)
+        self.assertNotIn('Edit', data)
+
+    # 测试视图查询数据之后、渲染模板之前提交的写入不会以新版本号缓存旧数据
+    def test_fragment_cache_version_read_first(self):
+        from watchlist import views
+        paginate = views.keyset_paginate
+
+        def paginate_then_write(*args, **kwargs):
+            page = paginate(*args, **kwargs)
+            db.session.add(Message(name = 'Tom', content = 'Written meanwhile', created_at = datetime.utcnow()))
+            Version.bump('message')
+            db.session.commit()
+            return page
+
+        with mock.patch.object(views, 'keyset_paginate', paginate_then_write):
+            data = self.client.get('/message').get_data(as_text = True)
+        self.assertNotIn('Written meanwhile', data)
+        data = self.client.get('/message').get_data(as_text = True)
+        self.assertIn('Written meanwhile', data)
+
+    # 测试请求级性能指标
+    def test_metrics(self):
+        self.app.config.update(METRICS_ENABLED = True, METRICS_N_PLUS_ONE_THRESHOLD = 5)
+        init_metrics(self.app)
+        # 模拟在循环中逐行查询的视图
+        self.app.add_url_rule('/n-plus-one', 'n_plus_one',
+                              lambda: str([Movie.query.filter_by(id = i).first() for i in range(6)]))
+
+        before = REQUEST_LATENCY.count(('main.index', 'GET'))
+        response = self.client.get('/')
+        self.assertIn('Server-Timing', response.headers)
+        self.assertEqual(REQUEST_LATENCY.count(('main.index', 'GET')), before + 1)
+
+        flagged = N_PLUS_ONE.value(('n_plus_one',))
+        self.client.get('/n-plus-one')
+        self.assertEqual(N_PLUS_ONE.value(('n_plus_one',)), flagged + 1)
+
+        response = self.client.get('/metrics')
+        data = response.get_data(as_text = True)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('watchlist_request_duration_seconds_bucket{endpoint="main.index",method="GET",le="+Inf"}', data)
+        self.assertIn('watchlist_request_sql_queries_count{endpoint="main.index"}', data)
+        self.assertIn('watchlist_template_render_seconds_count{template="index.html"}', data)
+        self.assertIn('watchlist_n_plus_one_total{endpoint="n_plus_one"}', data)
+
+    # 测试抽样分析慢请求
+    def test_metrics_profile(self):
+        tmpdir = tempfile.mkdtemp()
+        self.app.config.update(METRICS_ENABLED = True, METRICS_PROFILE_SAMPLE_RATE = 1,
+                               METRICS_PROFILE_SLOW_MS = 0, METRICS_PROFILE_DIR = tmpdir)
+        init_metrics(self.app)
+        self.client.get('/')
+        files = os.listdir(tmpdir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith('.prof'))
+        self.assertIn('main.index', files[0])
+
     # 测试自定义命令
     # 之前我们已经创建了一个命令运行器对象runner，对它调用 invoke() 方法可以执行命令，传入命令函数对象，或是使用 args 关键字直接给出命令参数列表。
     # invoke() 方法返回的命令执行结果对象，它的 output 属性返回命令的输出信息。
@@ -302,16 +1127,306 @@ class SayHelloTestCase(unittest.TestCase):
         self.assertIn('Done', result.output)
         self.assertNotEqual(Movie.query.count(), 0)
 
+    # 测试按数量生成数据，相同的种子生成相同的数据
+    def test_forge_command_sized(self):
+        result = self.runner.invoke(args = ['forge', '--movies', '5', '--messages', '3', '--seed', '1'])
+        self.assertIn('Done', result.output)
+        self.assertEqual(Movie.query.count(), 6)
+        self.assertEqual(Message.query.count(), 4)
+        titles = [movie.title for movie in Movie.query.order_by(Movie.id).offset(1)]
+        Movie.query.filter(Movie.id > 1).delete()
+        db.session.commit()
+        self.runner.invoke(args = ['forge', '--movies', '5', '--seed', '1'])
+        self.assertEqual([movie.title for movie in Movie.query.order_by(Movie.id).offset(1)], titles)
+
+    # 测试清除软删除的条目
+    @committing
+    def test_purge_command(self):
+        old = datetime.utcnow() - timedelta(days = 30)
+        db.session.add_all([Movie(title = 'Old', year = '2000', user_id = 1, deleted_at = old),
+                            Movie(title = 'Recent', year = '2000', user_id = 1, deleted_at = datetime.utcnow())])
+        db.session.commit()
+        result = self.runner.invoke(args = ['purge', '--days', '7', '--batch-size', '1'])
+        self.assertIn('Purged 1 movies.', result.output)
+        self.assertEqual(sorted(m.title for m in Movie.query), ['Recent', 'Test Movie Title'])
+        # 天数不会短于撤销期限
+        result = self.runner.invoke(args = ['purge', '--days', '0', '--full'])
+        self.assertIn('Purged 0 movies.', result.output)
+        self.assertIn('Vacuumed database.', result.output)
+        self.assertEqual(Movie.query.count(), 2)
+
+    # 测试从本地模拟的元数据提供方获取电影信息，响应缓存在磁盘上
+    def test_enrich_command(self):
+        requests = []
+
+        class Provider(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # 保持连接，由连接池复用
+
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)
+                requests.append(query['title'][0])
+                if query['title'][0] == 'Test Movie Title':
+                    status, body = 200, json.dumps({'id': 'tt1', 'rating': '8.5', 'poster': 'javascript:x',
+                                                    'url': 'https://example.com/tt1'}).encode('utf-8')
+                elif query['title'][0] == 'Broken':
+                    status, body = 500, b''
+                else:
+                    status, body = 404, b''
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Provider)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        db.session.add_all([Movie(title = 'Unknown', year = '2001', user_id = 1),
+                            Movie(title = 'Broken', year = '2002', user_id = 1),
+                            Movie(title = 'Gone', year = '2003', user_id = 1, deleted_at = datetime.utcnow())])
+        db.session.commit()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            result = self.runner.invoke(args = ['enrich'])
+            self.assertIn('ENRICH_PROVIDER_URL is not set', result.output)
+            url = 'http://127.0.0.1:%d/movie?title={title}&year={year}' % server.server_address[1]
+            self.app.config.update(ENRICH_CACHE_DIR = tmp, ENRICH_PROVIDER_URL = url)
+            result = self.runner.invoke(args = ['enrich', '--batch-size', '2'])
+            self.assertIn('Enriched 1 movies, 1 not found, 1 failed.', result.output)
+            self.assertEqual(sorted(requests), ['Broken', 'Test Movie Title', 'Unknown'])
+            movie = Movie.query.get(1)
+            self.assertEqual((movie.external_id, movie.rating, movie.poster_url, movie.detail_url),
+                             ('tt1', 8.5, None, 'https://example.com/tt1'))
+            self.assertIsNone(Movie.query.filter_by(title = 'Broken').first().enriched_at)
+
+            data = self.client.get('/').get_data(as_text = True)
+            self.assertIn('https://example.com/tt1', data)
+            self.assertIn('8.5', data)
+            data = self.client.get('/api/v1/movies?fields=title,rating').get_json()
+            self.assertEqual(data['items'][0], {'title': 'Test Movie Title', 'rating': 8.5})
+
+            # 全部重新获取时，成功和未找到的结果来自磁盘缓存，只有失败的条目再次请求
+            result = self.runner.invoke(args = ['enrich', '--refresh-days', '0'])
+            self.assertIn('Enriched 1 movies, 1 not found, 1 failed.', result.output)
+            self.assertEqual(len(requests), 4)
+
+    # 测试统计页面：各写入路径增量更新的汇总计数与 flask rebuild-stats 重新计算的结果一致
+    def test_stats(self):
+        result = self.runner.invoke(args = ['rebuild-stats'])
+        self.assertIn('Rebuilt 3 summary rows.', result.output)
+        self.login()
+        self.client.post('/', data = dict(title = 'Old Movie', year = '1988'))
+        self.client.post('/', data = dict(title = 'Older Movie', year = '1981'))
+        self.client.post('/movie/edit/1', data = dict(title = 'Test Movie Title', year = '1989'))
+        self.client.post('/movie/delete/2')
+        self.client.post('/movie/undo')
+        self.client.post('/movie/bulk', data = {'ids': ['3'], 'action': 'year', 'year': '2001'})
+        self.client.post('/message', data = dict(name = 'Tom', content = 'Hi'))
+        self.client.post('/api/v1/movies/batch', json = {'create': [{'title': 'API', 'year': '1989'}],
+                                                         'update': [{'id': 2, 'year': '1975'}], 'delete': [3]})
+        self.client.post('/api/v1/messages/batch', json = {'create': [{'name': 'Tom', 'content': 'Again'}]})
+        data = self.client.get('/stats.json').get_json()
+        self.assertEqual(data['movies'], 3)
+        self.assertIn({'year': '1975', 'count': 1}, data['years'])
+        self.assertIn({'decade': '1980s', 'count': 2}, data['decades'])
+        self.assertEqual(data['posters'][0], {'name': 'Tom', 'count': 2})
+
+        self.runner.invoke(args = ['forge', '--movies', '5', '--messages', '5', '--seed', '2'])
+        data = self.client.get('/stats.json').get_json()
+        self.assertEqual(data['movies'], Movie.live().count())
+        self.assertEqual(data['messages'], Message.query.count())
+        self.assertEqual(data['posters'][0]['count'], Message.query.filter_by(name = data['posters'][0]['name']).count())
+        self.runner.invoke(args = ['rebuild-stats'])
+        self.assertEqual(self.client.get('/stats.json').get_json(), data)
+
+        data = self.client.get('/stats').get_data(as_text = True)
+        self.assertIn('1980s', data)
+        self.assertIn('Top posters', data)
+
+        # 不是四位数字的年份归入 other，排在最后
+        self.client.post('/', data = dict(title = 'Short Year', year = '88'))
+        decades = self.client.get('/stats.json').get_json()['decades']
+        self.assertEqual(decades[-1], {'decade': 'other', 'count': 1})
+        self.assertNotIn('880s', [row['decade'] for row in decades])
+
     # 测试初始化数据库命令
     def test_initdb_command(self):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
     
+    # 测试没有 FTS5 的数据库使用 LIKE 搜索
+    def test_search_like_fallback(self):
+        db.session.add_all([Movie(title = 'My Neighbor Totoro', year = '1988'), Movie(title = '100%_Totoro', year = '2000')])
+        db.session.commit()
+        with mock.patch('watchlist.search.fts_available', return_value = False):
+            data = self.client.get('/search.json?q=TOTORO').get_json()
+            self.assertEqual([item['title'] for item in data['items']], ['100%_Totoro', 'My Neighbor Totoro'])
+            self.assertEqual(self.client.get('/search.json?q=neighbor+totoro').get_json()['total'], 1)
+            self.assertEqual(self.client.get('/search.json?q=_tot').get_json()['total'], 1)  # _ 按字面匹配
+            self.assertEqual(self.client.get('/search.json?q=Tom&kind=message').get_json()['total'], 0)
+
+    # 测试读写分离：GET 从副本读取，POST 之后的一段时间内读主库
+    def test_read_replica(self):
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite://'}
+        replica = db.get_engine(self.app, bind = 'replica')
+        for model in (User, Movie, Version):
+            model.__table__.create(bind = replica)
+        replica.execute(User.__table__.insert(), id = 1, name = 'Test', username = 'test')
+        replica.execute(Movie.__table__.insert(), id = 50, title = 'Replica Movie', year = '2020', user_id = 1)
+        replica.execute(Version.__table__.insert(), name = Movie.version_key(1), value = 100)  # 副本有自己的版本号
+        db.session.remove()
+
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Replica Movie', data)
+        self.assertNotIn('Test Movie Title', data)
+        self.assertIn('Test Movie Title', self.client.get('/search?q=test').get_data(as_text = True))  # 未标记的视图读主库
+
+        self.login()
+        self.client.post('/', data = dict(title = 'Primary Movie', year = '2021'))
+        self.assertEqual(Movie.query.filter_by(title = 'Primary Movie').count(), 1)  # 写入主库
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Primary Movie', data)  # 读到自己刚写入的数据
+        with self.client.session_transaction() as session:
+            session['primary_until'] = 0  # 时间窗口结束
+        data = self.client.get('/').get_data(as_text = True)
+        self.assertIn('Replica Movie', data)
+
+    # 测试数据库地址和连接池参数
+    def test_database_config(self):
+        from watchlist.database import database_url, engine_options
+        self.assertEqual(database_url('postgres://u:p@db/watchlist'), 'postgresql://u:p@db/watchlist')
+        self.assertEqual(database_url('sqlite:///data.db'), 'sqlite:///data.db')
+        config = dict(self.app.config, SQLALCHEMY_DATABASE_URI = 'postgresql://db/watchlist',
+                      DATABASE_POOL_SIZE = 20, DATABASE_POOL_PRE_PING = True)
+        options = engine_options(config)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertNotIn('connect_args', options)  # check_same_thread 只适用于 SQLite
+        config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/data.db'
+        self.assertFalse(engine_options(config)['connect_args']['check_same_thread'])
+
+    # 测试静态文件构建：带指纹的文件名、压缩的样式表、预压缩版本和长期缓存
+    def test_assets_build(self):
+        import gzip
+        import shutil
+        from watchlist.assets import init_assets
+        static_folder = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(self.app.static_folder, static_folder, ignore = shutil.ignore_patterns('dist'))
+        with open(os.path.join(static_folder, 'images', 'icons.css'), 'w') as f:
+            f.write('/* 图标 */\n.avatar {\n    background: url("avatar.png");\n}\n')
+        self.app.static_folder = static_folder
+
+        result = self.runner.invoke(args = ['assets', 'build'])
+        self.assertIn('Built', result.output)
+        self.app.config['ASSETS_ENABLED'] = True
+        init_assets(self.app)
+        manifest = self.app.extensions['assets']
+        self.assertRegex(manifest['style.css'], r'^style\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(static_folder, 'dist', manifest['images/icons.css'])) as f:
+            css = f.read()
+        self.assertEqual(css, '.avatar{background:url(%s)}' % manifest['images/avatar.png'].split('/')[-1])
+        self.assertFalse(os.path.exists(os.path.join(static_folder, 'dist', manifest['images/totoro.gif'] + '.gz')))
+
+        data = self.client.get('/').get_data(as_text = True)
+        url = '/static/dist/' + manifest['style.css']
+        self.assertIn(url, data)
+        response = self.client.get(url, headers = {'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(gzip.decompress(response.get_data()), plain.get_data())
+        response.close()
+        plain.close()
+        response = self.client.get('/static/style.css')  # 原文件仍然可以访问
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+        response.close()
+
+    # 测试迁移命令：为旧版本的数据库补齐新增的列和索引
+    @requires_sqlite
+    @committing
+    def test_migrate_command(self):
+        db.session.remove()
+        db.engine.execute('DROP TABLE message')
+        db.engine.execute('DROP INDEX ix_movie_title')
+        db.engine.execute('CREATE TABLE message (id INTEGER PRIMARY KEY, name VARCHAR(20), content VARCHAR(200))')
+        db.engine.execute("INSERT INTO message (name, content) VALUES ('Old', 'Old message')")
+
+        result = self.runner.invoke(migrate)
+        self.assertIn('Added column message.created_at.', result.output)
+        self.assertIn('Created index ix_movie_title.', result.output)
+        self.assertIn('Created index ix_message_created_at_id.', result.output)
+        self.assertIn('Set created_at of 1 messages.', result.output)
+        self.assertIn('Migrated database.', result.output)
+        self.assertEqual(Message.query.first().content, 'Old message')
+
+        # 再次执行不会重复修改
+        result = self.runner.invoke(migrate)
+        self.assertNotIn('Added', result.output)
+        self.assertNotIn('Created', result.output)
+
+    # 测试批量导入导出命令
+    def test_import_export_commands(self):
+        with self.runner.isolated_filesystem():
+            with open('movies.csv', 'w') as f:
+                f.write('title,year\nLeon,1994\nWALL-E,2008\nLeon,1994\nTest Movie Title,2020\n,1999\n')
+            result = self.runner.invoke(import_movies, ['movies.csv', '--batch-size', '1'])
+            self.assertIn('Imported 2 movies, skipped 3.', result.output)
+            self.assertEqual(Movie.query.count(), 3)
+
+            # 类型不对或无法解析的行只被跳过，不会中止导入
+            with open('movies.jsonl', 'w') as f:
+                f.write('{"title": 123, "year": "1999"}\n{"title": ["Leon"], "year": "1994"}\nnot json\n[1]\n')
+                f.write('{"title": "Leon", "year": 1994}\n{"title": "Up", "year": 2009}\n')
+            result = self.runner.invoke(import_movies, ['movies.jsonl'])
+            self.assertIsNone(result.exception)
+            self.assertIn('Imported 1 movies, skipped 5.', result.output)
+
+            with open('messages.jsonl', 'w') as f:
+                f.write('{"name": "Tom", "content": "Hello", "created_at": "2020-01-01T08:00:00"}\n\n')
+                f.write('{"name": "", "content": "Empty name"}\n')
+                f.write('{"name": "Tom", "content": "Bad time", "created_at": "yesterday"}\n')
+                f.write('{"name": "Tom", "content": "Bad time", "created_at": 5}\n')
+                f.write('{"name": "Tom", "content": ["Hello"]}\n')
+            result = self.runner.invoke(import_messages, ['messages.jsonl'])
+            self.assertIsNone(result.exception)
+            self.assertIn('Imported 1 messages, skipped 4.', result.output)
+            self.assertEqual(Message.query.filter_by(name = 'Tom').first().created_at.year, 2020)
+
+            result = self.runner.invoke(export_movies, ['--format', 'jsonl'])
+            lines = result.output.splitlines()
+            self.assertEqual(len(lines), 4)
+            self.assertIn('"title": "WALL-E"', lines[2])
+
+            # 按用户导出后再导入到该用户，条目不会归到站长名下
+            self.runner.invoke(args = ['add-user', '--username', 'tom', '--password', '456'])
+            self.runner.invoke(args = ['add-user', '--username', 'jerry', '--password', '456'])
+            tom = User.query.filter_by(username = 'tom').first()
+            db.session.add(Movie(title = 'Tom Movie', year = '2021', user_id = tom.id))
+            db.session.commit()
+            result = self.runner.invoke(export_movies, ['tom.jsonl', '--user', 'tom'])
+            self.assertIsNone(result.exception)
+            with open('tom.jsonl') as f:
+                self.assertEqual([json.loads(line)['title'] for line in f], ['Tom Movie'])
+            result = self.runner.invoke(import_movies, ['tom.jsonl', '--user', 'jerry'])
+            self.assertIn('Imported 1 movies, skipped 0.', result.output)
+            self.assertEqual(Movie.query.filter_by(title = 'Tom Movie').count(), 2)
+            self.assertEqual(Movie.query.filter_by(user_id = 1).count(), 4)
+            result = self.runner.invoke(export_movies, ['--user', 'nobody'])
+            self.assertIn('No such user: nobody.', result.output)
+
     # 测试管理员命令
     # 测试生成管理员账户
     def test_admin_command(self):
-        db.drop_all()  
-        db.create_all()  # 创建新的数据库表
+        Movie.query.delete()
+        User.query.delete()  # 从没有用户的数据库开始
+        db.session.commit()
         result = self.runner.invoke(args = ['admin', '--username', 'Big Jiang', '--password', '123'])
         self.assertIn('Creating user...', result.output)
         self.assertIn('Done.', result.output)
@@ -321,12 +1436,107 @@ class SayHelloTestCase(unittest.TestCase):
 
     # 测试更新管理员账户
     def test_admin_command_update(self):
-        result = self.runner.invoke(args = ['admin', '--username', 'tom', '--password', '456'])
+        result = self.runner.invoke(args = ['admin', '--username', 'test', '--password', '456'])
         self.assertIn('Updating user...', result.output)
         self.assertIn('Done.', result.output)
         self.assertEqual(User.query.count(), 1)
-        self.assertEqual(User.query.first().username, 'tom')
-        self.assertTrue(User.query.first().validate_password('456'))
+        self.assertTrue(User.query.filter_by(username = 'test').first().validate_password('456'))
+
+        # 其他用户名创建新用户，不会改动站长
+        result = self.runner.invoke(args = ['admin', '--username', 'tom', '--password', '789'])
+        self.assertIn('Creating user...', result.output)
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(User.owner().username, 'test')
+        self.assertTrue(User.query.filter_by(username = 'tom').first().validate_password('789'))
+
+
+@requires_sqlite
+class ConcurrencyTestCase(unittest.TestCase):
+    """Many threads, each with its own client, write through the views to
+    a WAL database file at once; every write must land exactly once.
+    ``WATCHLIST_STRESS_THREADS`` and ``WATCHLIST_STRESS_REQUESTS`` make
+    the run heavier."""
+
+    threads = int(os.getenv('WATCHLIST_STRESS_THREADS', 8))
+    requests = int(os.getenv('WATCHLIST_STRESS_REQUESTS', 25))
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(TEST_DIR, 'stress-%s.db' % self._testMethodName),
+            LOGIN_RATE_LIMIT_ENABLED = False,
+        )
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        user_cache.clear()
+        response_cache.clear()
+        fragment_cache.clear()
+        user = User(name = 'Test', username = 'test')
+        user.set_password('123')
+        db.session.add(user)
+        db.session.flush()
+        db.session.add_all([Movie(title = 'Test Movie Title', year = '2020', user_id = user.id),
+                            Message(name = u'小江', content = u'电影真好看啊！')])
+        db.session.commit()
+        self.runner = self.app.test_cli_runner()
+        self.runner.invoke(args = ['rebuild-stats'])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()  # 关闭连接，临时目录才能删除
+        reset_process_state(self.app)
+        self.context.pop()
+
+    def hammer(self, work):
+        """Run ``work(client, thread, request)`` from every thread and
+        return the status codes."""
+        statuses, errors = [], []
+        barrier = threading.Barrier(self.threads)
+
+        def run(thread):
+            client = self.app.test_client()
+            try:
+                barrier.wait()  # 所有线程同时开始，尽量制造冲突
+                for i in range(self.requests):
+                    statuses.append(work(client, thread, i).status_code)
+            except Exception as e:  # 断言在主线程中进行
+                errors.append(e)
+
+        workers = [threading.Thread(target = run, args = (n,)) for n in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        return statuses
+
+    # 测试并发的留言和编辑不会出错、丢失更新或使汇总计数偏离
+    def test_concurrent_writes(self):
+        editors = self.threads // 2
+
+        def work(client, thread, i):
+            if thread < editors:
+                if i == 0:
+                    client.post('/login', data = dict(username = 'test', password = '123'))
+                return client.post('/movie/edit/1', data = dict(title = 'Edit %d-%d' % (thread, i),
+                                                                year = str(1990 + (thread + i) % 3)))
+            return client.post('/message', data = dict(name = 'Poster %d' % thread, content = 'Hi %d' % i))
+
+        statuses = self.hammer(work)
+        self.assertTrue(all(status < 500 for status in statuses))
+        edits = editors * self.requests
+        posts = (self.threads - editors) * self.requests
+
+        db.session.remove()
+        self.assertEqual(Message.query.count(), posts + 1)
+        self.assertEqual(Version.current('message'), posts)
+        self.assertEqual(Version.current(Movie.version_key(1)), edits)
+        counted = summary()
+        self.assertEqual(counted['movies'], 1)
+        rebuild_stats()
+        self.assertEqual(summary(), counted)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,44 +1,77 @@
 # -*- coding: utf-8 -*-
 import os
-import sys
 
-from flask import Flask, render_template
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask
 from flask_login import LoginManager
 
-# SQLite URI compatible
-WIN = sys.platform.startswith('win')
-if WIN:
-    prefix = 'sqlite:///'
-else:
-    prefix = 'sqlite:////'
+from watchlist.database import SQLAlchemy, engine_options
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev')
-# 使用os.path.dirname()便于把文件定位到项目根目录
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), os.getenv('DATABASE_FILE', 'data.db'))
-# 额外的兼容性处理的变量配置
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # 关闭对模型修改的监控
-
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)  # 该对象保存用以登录的设置
+db = SQLAlchemy()
+login_manager = LoginManager()  # 该对象保存用以登录的设置
 
 # Flask-Login 提供了一个 current_user 变量，注册这个函数的目的是，
 # 当程序运行后，如果用户已登录， current_user 变量的值会是当前用户的用户模型类记录
 @login_manager.user_loader
 def load_user(user_id):  # 创建用户回调函数，接受用户ID为参数
-    from watchlist.models import User  # 在函数内导入，避免循环依赖
-    user = User.query.get(int(user_id))
-    return user
+    from watchlist.cache import user_cache  # 在函数内导入，避免循环依赖
+    return user_cache.get(int(user_id))
 
 # 当认证保护触发，发现用户没有登录时，会重定向到登录界面
 # login_manager.login_view保存的是该登录视图函数的名字
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
 
-@app.context_processor
 def inject_user():  # 注册为模板上下文函数
-    from watchlist.models import User
-    user = User.query.first()
+    from watchlist.cache import user_cache
+    user = user_cache.owner()
     return dict(user = user)  # 返回一个字典，等同于{'user': user}
 
-from watchlist import views, errors, commands  # 放在最后，避免循环引用。使得视图函数、错误处理函数和命令函数可以注册到程序实例上
+
+def create_app(config_name = None, cli = True):
+    """Application factory.
+
+    ``config_name`` picks a class from ``watchlist.config`` (``FLASK_CONFIG``
+    by default).  Web entry points pass ``cli = False`` so that the command
+    module and its dependencies are never imported into a worker.
+    """
+    from watchlist.config import config, INSTANCE_DEFAULTS
+
+    app = Flask(__name__)
+    app.config.from_object(config[config_name or os.getenv('FLASK_CONFIG', 'development')])
+    for key, filename in INSTANCE_DEFAULTS.items():
+        if app.config[key] is None:
+            app.config[key] = os.path.join(app.instance_path, filename)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    if app.config['DATABASE_REPLICA_URL']:  # 只读副本作为名为 replica 的 bind，由 RoutingSession 选择
+        app.config.setdefault('SQLALCHEMY_BINDS', {})['replica'] = app.config['DATABASE_REPLICA_URL']
+
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.context_processor(inject_user)
+
+    from watchlist.templating import init_templating
+    from watchlist.metrics import init_metrics
+    from watchlist.assets import init_assets
+    from watchlist.sessions import init_sessions
+    from watchlist.enrich import init_enrich
+    from watchlist.ingest import init_ingest
+    from watchlist.security import init_proxy_fix
+    init_templating(app)
+    init_metrics(app)
+    init_assets(app)
+    init_sessions(app)
+    init_enrich(app)
+    init_ingest(app)
+    init_proxy_fix(app)
+
+    # 在函数内导入并注册蓝本，避免循环引用
+    from watchlist.views import main
+    from watchlist.errors import errors
+    from watchlist.api import api
+    app.register_blueprint(main)
+    app.register_blueprint(errors)
+    app.register_blueprint(api, url_prefix = '/api/v1')
+
+    if cli:  # 命令只在命令行中需要
+        from watchlist.commands import register_commands
+        register_commands(app)
+    return app
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from flask import Blueprint, current_app, request, jsonify
+from flask_login import current_user
+from sqlalchemy import bindparam
+
+from watchlist import db
+from watchlist.cache import user_cache
+from watchlist.database import read_replica
+from watchlist.models import Movie, Message, Stat, Version
+from watchlist.spam import get_filter
+from watchlist.utils import keyset_paginate, validate_message, validate_movie
+
+# JSON API：GET 按字段掩码返回列元组，批量接口在一个事务中完成创建、更新和删除
+api = Blueprint('api', __name__)  # 注册时使用 url_prefix='/api/v1'
+
+# 每种资源可以返回的列
+MOVIE_FIELDS = {'id': Movie.id, 'title': Movie.title, 'year': Movie.year, 'rating': Movie.rating,
+                'poster_url': Movie.poster_url, 'detail_url': Movie.detail_url}
+MOVIE_DEFAULT_FIELDS = ['id', 'title', 'year']  # 元数据列需要通过 ?fields= 显式请求
+MESSAGE_FIELDS = {'id': Message.id, 'name': Message.name, 'content': Message.content,
+                  'created_at': Message.created_at}
+
+
+def api_error(status, message, errors = None):
+    response = jsonify(message = message, errors = errors or [])
+    response.status_code = status
+    return response
+
+
+def list_rows(model, columns, criteria = (), default_fields = None):
+    """Paginated GET returning only the columns named in ``?fields=``."""
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(default_fields or columns)
+    unknown = [f for f in fields if f not in columns]
+    if unknown:
+        return api_error(400, 'Unknown fields.', unknown)
+
+    # 游标分页需要 id 列，即使没有请求也要查询
+    selected = fields if 'id' in fields else ['id'] + fields
+    query = db.session.query(*[columns[f] for f in selected]).filter(*criteria)
+    page = keyset_paginate(query, model.id)
+    offset = 0 if 'id' in fields else 1
+    items = [dict(zip(fields, row[offset:])) for row in page.items]
+    return jsonify(
+        items = items, total = page.total,
+        prev_cursor = page.prev_cursor, next_cursor = page.next_cursor
+    )
+
+
+def parse_batch():
+    """Return the ``create``/``update``/``delete`` lists of a batch request."""
+    data = request.get_json(silent = True)
+    if not isinstance(data, dict):
+        return None
+    create, update, delete = data.get('create', []), data.get('update', []), data.get('delete', [])
+    if not (isinstance(create, list) and isinstance(update, list) and isinstance(delete, list)):
+        return None
+    if not all(isinstance(item, dict) for item in create + update):
+        return None
+    if not all(isinstance(item.get('id'), int) for item in update) \
+            or not all(isinstance(item, int) for item in delete):
+        return None
+    return create, update, delete
+
+
+def valid_row(validate, fields, row):
+    # JSON 中的值可能不是字符串，先检查类型再复用表单的校验规则
+    values = [row[f] for f in fields]
+    return all(isinstance(v, str) for v in values) and validate(*values)
+
+
+def apply_batch(model, fields, validate, create, update, delete, scope = None, versions = (), soft_delete = False,
+                update_values = None):
+    """Validate the whole batch, then write it in one transaction.
+
+    Creates use one executemany INSERT, updates one executemany UPDATE and
+    deletes a single ``DELETE ... WHERE id IN (...)``.  Nothing is written
+    if any item is invalid.  ``scope`` (column name to value) is set on
+    created rows and restricts updates and deletes to matching rows;
+    ``versions`` names extra version counters to bump.  With
+    ``soft_delete`` deletes set ``deleted_at`` instead of removing rows.
+    ``update_values`` may add columns to the SET clause of updates.
+    """
+    table = model.__table__
+    scope = scope or {}
+    update_values = update_values or (lambda values: values)
+    errors = []
+    rows = [{f: item.get(f) for f in fields} for item in create]
+    for i, row in enumerate(rows):
+        if not valid_row(validate, fields, row):
+            errors.append({'op': 'create', 'index': i})
+
+    # 先更新版本号取得写锁，之后读取的现有值和汇总计数不会被并发的写入改变
+    for name in (model.__tablename__,) + tuple(versions):
+        Version.bump(name)
+    # 更新允许只提交部分字段，其余字段使用数据库中的值后再整体校验
+    ids = [item['id'] for item in update] + delete
+    existing = {}
+    if ids:
+        query = db.session.query(model.id, *[getattr(model, f) for f in fields]) \
+            .filter(model.id.in_(ids)).filter_by(**scope).with_for_update()  # 范围之外的行视为不存在
+        existing = {row[0]: dict(zip(fields, row[1:])) for row in query}
+    changes = []
+    for i, item in enumerate(update):
+        current = existing.get(item['id'])
+        if current is None:
+            errors.append({'op': 'update', 'index': i, 'id': item['id']})
+            continue
+        row = {f: item.get(f, current[f]) for f in fields}
+        if not valid_row(validate, fields, row):
+            errors.append({'op': 'update', 'index': i, 'id': item['id']})
+            continue
+        row['_id'] = item['id']
+        changes.append(row)
+    for i, row_id in enumerate(delete):
+        if row_id not in existing:
+            errors.append({'op': 'delete', 'index': i, 'id': row_id})
+    if errors:
+        db.session.rollback()
+        return None, errors
+
+    # 汇总计数：先减去将被修改和删除的行，写入后再加上新建和修改后的行
+    criteria = [getattr(model, name) == value for name, value in scope.items()]
+    changed = [row['_id'] for row in changes]
+    if changed or delete:
+        Stat.record(Stat.count_rows(model, criteria + [model.id.in_(changed + delete)], -1))
+    for row in rows:
+        row.update(scope)
+    if rows:
+        db.session.execute(table.insert(), rows)
+        Stat.record(Stat.count(model, rows))
+    if changes:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('_id'))
+            .values(**update_values({f: bindparam(f) for f in fields})), changes
+        )
+        Stat.record(Stat.count_rows(model, criteria + [model.id.in_(changed)]))
+    if delete and soft_delete:
+        db.session.execute(table.update().where(table.c.id.in_(delete)).values(deleted_at = datetime.utcnow()))
+    elif delete:
+        db.session.execute(table.delete().where(table.c.id.in_(delete)))
+    db.session.commit()
+    return {'created': len(rows), 'updated': len(changes), 'deleted': len(set(delete))}, None  # 重复的 id 只删除一次
+
+
+def batch_endpoint(model, fields, validate, filter_create = None, scope = None, versions = (), soft_delete = False,
+                   update_values = None):
+    if not current_user.is_authenticated:
+        return api_error(401, 'Login required.')
+    batch = parse_batch()
+    if batch is None:
+        return api_error(400, 'Invalid batch request.')
+    create, update, delete = batch
+
+    rejected = 0
+    if filter_create is not None and create:
+        keep = filter_create(create)
+        rejected = len(create) - sum(keep)
+        create = [item for item, ok in zip(create, keep) if ok]
+
+    result, errors = apply_batch(model, fields, validate, create, update, delete, scope, versions, soft_delete,
+                                 update_values)
+    if errors:
+        db.session.rollback()
+        return api_error(400, 'Invalid input.', errors)
+    if filter_create is not None:
+        result['rejected'] = rejected
+    return jsonify(result)
+
+
+@api.route('/movies')
+@read_replica
+def movies():
+    username = request.args.get('user')  # ?user= 只返回该用户的条目
+    criteria = [Movie.deleted_at.is_(None)]
+    if username is not None:
+        owner = user_cache.by_username(username)
+        if owner is None:
+            return api_error(404, 'Unknown user.')
+        criteria.append(Movie.user_id == owner.id)
+    return list_rows(Movie, MOVIE_FIELDS, criteria, MOVIE_DEFAULT_FIELDS)
+
+
+@api.route('/messages')
+@read_replica
+def messages():
+    return list_rows(Message, MESSAGE_FIELDS)
+
+
+@api.route('/movies/batch', methods = ['POST'])
+def movies_batch():
+    # 只能修改自己的条目，新建的条目属于当前用户
+    if not current_user.is_authenticated:
+        return api_error(401, 'Login required.')
+    scope = {'user_id': current_user.id, 'deleted_at': None}  # 已删除的条目视为不存在
+    return batch_endpoint(Movie, ('title', 'year'), validate_movie, scope = scope,
+                          versions = [Movie.version_key(current_user.id)], soft_delete = True,
+                          update_values = Movie.update_values)  # 修改标题或年份时清空元数据
+
+
+def _not_spam(items):
+    if not current_app.config['SPAM_FILTER_ENABLED']:
+        return [True] * len(items)
+    flags = get_filter().score_many([str(item.get('content') or '') for item in items])
+    return [not flag for flag in flags]
+
+
+@api.route('/messages/batch', methods = ['POST'])
+def messages_batch():
+    return batch_endpoint(Message, ('name', 'content'), validate_message, _not_spam)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:  # 可选依赖，没有安装时只生成 gzip 版本
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = 'dist'  # 构建结果在静态文件夹中的子目录
+MANIFEST = 'manifest.json'
+# 值得预压缩的文本类文件；图片本身已经压缩过
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.html'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE_RE = re.compile(r'\s+')
+_CSS_PUNCT_RE = re.compile(r'\s*([{}:;,>])\s*')
+_CSS_URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def minify_css(css):
+    """Strip comments and redundant whitespace; good enough for our sheets."""
+    css = _CSS_COMMENT_RE.sub('', css)
+    css = _CSS_SPACE_RE.sub(' ', css)
+    css = _CSS_PUNCT_RE.sub(r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def fingerprint(name, data):
+    root, ext = posixpath.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha256(data).hexdigest()[:12], ext)
+
+
+def _rewrite_urls(css, name, manifest):
+    # 样式表中引用的其他静态文件改为指向带指纹的文件（构建后两者都在 dist 目录中）
+    directory = posixpath.dirname(name)
+
+    def replace(match):
+        url = match.group(2)
+        if '://' in url or url.startswith(('/', 'data:', '#')):
+            return match.group(0)
+        path = url.partition('?')[0]
+        target = posixpath.normpath(posixpath.join(directory, path))
+        if target not in manifest:
+            return match.group(0)
+        hashed = posixpath.relpath(manifest[target], directory or '.')  # 带指纹的文件与原文件在同一层目录
+        return 'url(%s)' % hashed
+    return _CSS_URL_RE.sub(replace, css)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _sources(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST in dirs:
+            dirs.remove(DIST)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+
+def build(static_folder, compress_level = 9):
+    """Write fingerprinted, minified and precompressed copies of every file
+    in ``static_folder`` to its ``dist`` directory plus a manifest mapping
+    the original names to the new ones; return the manifest."""
+    output = os.path.join(static_folder, DIST)
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    sources = sorted(_sources(static_folder), key = lambda item: item[0].endswith('.css'))  # 样式表最后处理
+
+    manifest = {}
+    for name, path in sources:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            # 指纹取决于改写后的内容，因此被引用的文件要先处理
+            data = _rewrite_urls(minify_css(data.decode('utf-8')), name, manifest).encode('utf-8')
+        manifest[name] = fingerprint(name, data)
+        target = os.path.join(output, manifest[name])
+        _write(target, data)
+
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+            # mtime = 0 使同样的输入得到同样的输出；只保留确实更小的压缩版本
+            variants = [('.gz', gzip.compress(data, compress_level, mtime = 0))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data, quality = 11)))
+            for suffix, compressed in variants:
+                if len(compressed) < len(data):
+                    _write(target + suffix, compressed)
+
+    with open(os.path.join(output, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent = 2, sort_keys = True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def rewrite_static_url(endpoint, values):
+    """``url_defaults`` hook: ``url_for('static', filename='style.css')``
+    becomes ``/static/dist/style.<hash>.css`` once assets are built."""
+    if endpoint != 'static':
+        return
+    hashed = current_app.extensions['assets'].get(values.get('filename'))
+    if hashed is not None:
+        values['filename'] = DIST + '/' + hashed
+
+
+def send_static_file(filename):
+    """Static view: built files are cached for a year and served
+    precompressed when the client accepts it, the rest as before."""
+    app = current_app._get_current_object()
+    prefix = DIST + '/'
+    if not filename.startswith(prefix) or filename == prefix + MANIFEST:
+        return app.send_static_file(filename)
+
+    directory = os.path.join(app.static_folder, DIST)
+    name = filename[len(prefix):]
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[candidate] and os.path.isfile(os.path.join(directory, name + suffix)):
+            encoding, name = candidate, name + suffix
+            break
+    response = send_from_directory(directory, name, mimetype = mimetype, cache_timeout = 31536000)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE  # 文件名随内容变化，客户端无需重新验证
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    manifest = load_manifest(app.static_folder) if app.config['ASSETS_ENABLED'] else {}
+    app.extensions['assets'] = manifest
+    if manifest:
+        app.url_defaults(rewrite_static_url)
+    app.view_functions['static'] = send_static_file
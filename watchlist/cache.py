@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+from watchlist import db
+
+_MISSING = object()
+
+
+class UserCache(object):
+    """Process-local cache of ``User`` rows.
+
+    The owner row is read on every render (``inject_user``), the logged-in
+    user on every request (``load_user``) and the user behind ``/u/<name>``
+    on every page view, but they almost never change, so the rows are kept
+    detached in memory and only reloaded after ``clear()``.
+    With ``OWNER_CACHE_SHARED`` enabled the ``user`` version counter in the
+    database is polled at most once every ``OWNER_CACHE_CHECK_INTERVAL``
+    seconds, so writes made by other processes are noticed as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._usernames = {}  # 用户名到 id 的映射，只缓存存在的用户
+        self._owner = _MISSING
+        self._version = None
+        self._checked_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._usernames.clear()
+            self._owner = _MISSING
+
+    def _sync(self):
+        config = current_app.config
+        if not config['OWNER_CACHE_SHARED']:
+            return
+        now = time.time()
+        if now - self._checked_at < config['OWNER_CACHE_CHECK_INTERVAL']:
+            return
+        from watchlist.models import Version
+        version = Version.current('user')
+        self._checked_at = now
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    @staticmethod
+    def _detach(user):
+        # 从会话中移除，使缓存的对象不会随请求结束或提交而过期
+        if user is not None:
+            db.session.expunge(user)
+        return user
+
+    def get(self, user_id):
+        from watchlist.models import User
+        self._sync()
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._detach(User.query.get(user_id))
+            if user is not None:
+                with self._lock:
+                    self._users[user_id] = user
+        return user
+
+    def by_username(self, username):
+        """Return the user called ``username`` or ``None``."""
+        from watchlist.models import User
+        self._sync()
+        user_id = self._usernames.get(username)
+        if user_id is not None:
+            return self.get(user_id)
+        user = self._detach(User.query.filter_by(username = username).first())
+        if user is not None:
+            with self._lock:
+                self._users[user.id] = user
+                self._usernames[username] = user.id
+        return user
+
+    def owner(self):
+        """Return the site owner (the first user) or ``None``."""
+        from watchlist.models import User
+        self._sync()
+        owner = self._owner
+        if owner is _MISSING:
+            owner = self._detach(User.owner())
+            with self._lock:
+                self._owner = owner
+        return owner
+
+
+user_cache = UserCache()
+
+
+class MemoryBackend(object):
+    """In-process LRU store, the default backend."""
+
+    def __init__(self, max_entries = 512):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout = 0):
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend(object):
+    """One pickle file per key, shared by every process on the host.
+
+    Expired files are removed when read.  With ``max_entries`` the oldest
+    files (by mtime) are removed on ``set`` once the directory holds more.
+    """
+
+    def __init__(self, directory, max_entries = None):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok = True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # 其他进程已经删除
+            pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires and expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, timeout = 0):
+        expires = time.time() + timeout if timeout else 0
+        path = self._path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)  # 原子替换，其他进程不会读到写了一半的文件
+        if self.max_entries is not None:
+            self._prune()
+
+    def _prune(self):
+        names = [name for name in os.listdir(self.directory) if not name.endswith('.tmp')]  # 跳过正在写入的文件
+        if len(names) <= self.max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        # 多删除十分之一，之后的多次写入不需要再逐个读取修改时间
+        excess = len(entries) - self.max_entries + self.max_entries // 10
+        for _, path in sorted(entries)[:excess]:
+            self._remove(path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            self._remove(os.path.join(self.directory, name))
+
+
+class RedisBackend(object):
+    """Redis (or any server speaking its protocol) shared by all workers."""
+
+    def __init__(self, url, prefix = 'watchlist:'):
+        import redis  # 可选依赖，只有使用该后端时才需要安装
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, timeout = 0):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex = timeout or None)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def make_backend(config, prefix):
+    """Build a cache backend from the ``<prefix>_TYPE`` style settings."""
+    backend = config[prefix + '_TYPE']
+    if backend == 'null':
+        return None
+    if backend == 'memory':
+        return MemoryBackend(config[prefix + '_MAX_ENTRIES'])
+    if backend == 'file':
+        return FileBackend(config[prefix + '_DIR'], config[prefix + '_MAX_ENTRIES'])
+    if backend == 'redis':
+        return RedisBackend(config[prefix + '_REDIS_URL'], prefix = 'watchlist:%s:' % prefix.lower())
+    raise ValueError('Unknown cache type: %r' % backend)
+
+
+class ConfiguredCache(object):
+    """A cache whose backend is built on first use from the
+    ``<prefix>_*`` settings of the current app."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._backend = _MISSING
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is _MISSING:
+            with self._lock:
+                if self._backend is _MISSING:
+                    self._backend = make_backend(current_app.config, self.prefix)
+        return self._backend
+
+    @property
+    def timeout(self):
+        return current_app.config[self.prefix + '_TIMEOUT']
+
+    def reset(self):
+        """Forget the backend so that it is rebuilt from the configuration."""
+        self._backend = _MISSING
+
+    def clear(self):
+        backend = self.backend
+        if backend is not None:
+            backend.clear()
+
+
+class ResponseCache(ConfiguredCache):
+    """Full-page cache for anonymous GET requests.
+
+    Pages are keyed by path and query string and are only served to visitors
+    who are not logged in and have no pending flash messages.  Below
+    ``conditional`` the key also contains the version counters the page
+    depends on, so a write that bumps them makes the old pages unreachable
+    without a ``clear()``; only changes to users, which no page key covers,
+    clear the cache.  The memory backend is local to one process, so
+    multi-worker deployments should use the file or redis backend (or rely
+    on ``RESPONSE_CACHE_TIMEOUT``).
+    """
+
+    def __init__(self):
+        super(ResponseCache, self).__init__('RESPONSE_CACHE')
+
+    @staticmethod
+    def _cacheable():
+        return (request.method == 'GET'
+                and not current_user.is_authenticated
+                and not session.get('_flashes'))
+
+    def cached(self, view):
+        """Decorator serving ``view`` from the cache when possible."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            backend = self.backend
+            if backend is None or not self._cacheable():
+                return view(*args, **kwargs)
+
+            key = request.full_path + request.environ.get('watchlist.versions', '')
+            hit = backend.get(key)
+            if hit is not None:
+                body, status, headers = hit
+                response = current_app.response_class(body, status, headers)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                backend.set(key, (response.get_data(), response.status_code, list(response.headers)),
+                            self.timeout)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+
+
+response_cache = ResponseCache()
+# 模板片段缓存，键中包含数据版本号，数据变化后旧片段自然失效
+fragment_cache = ConfiguredCache('FRAGMENT_CACHE')
+
+
+def conditional(*names, state = None):
+    """Answer conditional GETs from the version counters of ``names``.
+
+    The strong ETag is derived from the table versions, the owner version,
+    the logged-in user and the full path, so a matching ``If-None-Match``
+    (or a fresh enough ``If-Modified-Since``) gets a 304 after a single
+    query on the version table, before the view touches the ORM or Jinja.
+    A name may also be a callable taking the view arguments, for counters
+    scoped to one user such as ``Movie.version_key``.  The snapshot also
+    seeds ``table_version()``, so cached fragments are keyed by versions
+    read before the view loads its rows.  ``state`` is an optional callable
+    taking the view arguments and returning per-session page state that is
+    not versioned, such as a pending undo.  A non-empty state goes into the
+    ETag and suppresses ``Last-Modified``, so the page changes when the
+    state does.
+    """
+    names = tuple(names) + ('user',)  # 页面标题中包含站长名字
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            from watchlist.models import Version
+            resolved = [name(**kwargs) if callable(name) else name for name in names]
+            snapshot = Version.snapshot(resolved)
+            # 版本号必须在查询数据之前读取：之后提交的写入只会使片段更早失效，不会把旧数据缓存到新版本号下
+            versions = request.environ.setdefault('watchlist.table_versions', {})
+            for name in resolved:
+                versions.setdefault(name, snapshot.get(name, (0, None))[0])
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+            viewer = current_user.get_id() if current_user.is_authenticated else 'anonymous'
+            parts = ['%s=%d' % (name, snapshot.get(name, (0, None))[0]) for name in resolved]
+            request.environ['watchlist.versions'] = '|' + '|'.join(parts)  # 供整页缓存组成缓存键
+            extra = state(**kwargs) if state is not None else ''
+            parts += [viewer, request.full_path, extra]
+            etag = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+            stamps = [updated_at for value, updated_at in snapshot.values() if updated_at]
+            # 会话状态变化不会更新版本号的时间，有状态时只使用 ETag
+            last_modified = max(stamps).replace(microsecond = 0) if stamps and not extra else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = bool(since and last_modified and last_modified <= since.replace(tzinfo = None))
+            if not_modified:
+                response = current_app.response_class(status = 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True  # 允许缓存，但每次使用前都要重新验证
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
@@ -1,14 +1,40 @@
 # -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import random
+import shutil
+from collections import Counter
+from datetime import datetime, timedelta
+
 import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, inspect, text
+
+from watchlist import db
+from watchlist.cache import fragment_cache, response_cache, user_cache
+from watchlist.enrich import enrich as enrich_movies
+from watchlist.models import User, Movie, Message, Stat, Version
+from watchlist.search import fts_available, rebuild_index
+from watchlist.spam import NaiveBayesStage, get_filter
+from watchlist.stats import rebuild_stats
+from watchlist.utils import batched, validate_message, validate_movie
+# AppGroup 注册的命令会在程序上下文中执行，create_app(cli = True) 时由 register_commands 添加到 app.cli
+cli = AppGroup('watchlist')
+assets = AppGroup('assets', help = 'Build the static assets.')
+cli.add_command(assets)
+
+def register_commands(app):
+    for command in cli.commands.values():
+        app.cli.add_command(command)
 
-from watchlist import app, db
-from watchlist.models import User, Movie, Message
 # 使用@click.command()装饰函数，使其成为命令行接口
 # 使用@click.option()等装饰函数，为其添加命令行选项
 # flask.cli是Flask内置的脚本命令接口，基于click实现的
 
 # 初始化数据库
-@app.cli.command()  # 注册为命令
+@cli.command()  # 注册为命令
 @click.option('--drop', is_flag = True, help = 'Create after drop.')  # 设置命令的选项
 def initdb(drop):  # 函数名即为命令的名字
     """Initialize the database.
@@ -18,15 +44,105 @@ def initdb(drop):  # 函数名即为命令的名字
     """
     if drop:
         db.drop_all()
+        # 重建后版本号从头开始，以版本号为键的片段缓存也要清空
+        user_cache.clear()
+        fragment_cache.clear()
     db.create_all()
     click.echo('Initialized database.')  # 输出
 
+# 被新索引取代的旧索引
+OBSOLETE_INDEXES = {'movie': {'ix_movie_user_id_id'}, 'message': {'ix_message_created_at'}}
+
+# 将模型中新增的表、列和索引应用到已有的数据库，不需要 initdb --drop
+@cli.command()
+def migrate():
+    """Apply schema changes to an existing database."""
+    db.create_all()  # 创建缺少的表（已存在的表不受影响）
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            column_type = column.type.compile(dialect = db.engine.dialect)
+            db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column_type))
+            click.echo('Added column %s.%s.' % (table.name, column.name))
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind = db.engine)
+                click.echo('Created index %s.' % index.name)
+        for name in indexes & OBSOLETE_INDEXES.get(table.name, set()):
+            db.engine.execute('DROP INDEX %s' % name)
+            click.echo('Dropped index %s.' % name)
+    # 加列之前的留言没有时间，记为最早一条留言的时间，使 (created_at, id) 排序仍然按 id 排列它们
+    messages = Message.__table__
+    earliest = db.session.query(func.min(Message.created_at)).scalar() or datetime.utcnow()
+    filled = db.session.execute(messages.update().where(messages.c.created_at.is_(None)).values(created_at = earliest)).rowcount
+    db.session.commit()
+    if filled:
+        click.echo('Set created_at of %d messages.' % filled)
+    owner = User.owner()
+    if owner is not None:  # 多用户之前的电影条目都属于站长
+        adopted = Movie.adopt_orphans(owner.id)
+        db.session.commit()
+        if adopted:
+            click.echo('Assigned %d movies to %s.' % (adopted, owner.username))
+    rebuild_index()  # 新建的全文索引表是空的，需要从原表重建
+    rebuild_stats()  # 汇总表同样需要从原表计算
+    click.echo('Migrated database.')
+
+# 从原表重新计算统计页面使用的汇总计数
+@cli.command('rebuild-stats')
+@click.option('--batch-size', default = 10000, show_default = True, help = 'Rows fetched per round trip.')
+def rebuild_stats_command(batch_size):
+    """Recompute the summary counters from the movies and messages."""
+    count = rebuild_stats(batch_size)
+    click.echo('Rebuilt %d summary rows.' % count)
+
+# 重建全文搜索索引
+@cli.command()
+def reindex():
+    """Rebuild the full-text search index."""
+    rebuild_index()
+    click.echo('Rebuilt search index.')
+
+# 生成大量虚拟数据时使用的词表，相同的 --seed 总是生成相同的数据
+FAKE_WORDS = ['Totoro', 'Poets', 'World', 'Leon', 'Mahjong', 'Butterfly', 'Comedy', 'Devils',
+              'Doorstep', 'Music', 'Spirited', 'Castle', 'Sky', 'Wind', 'River', 'Night', 'Summer']
+FAKE_NAMES = [u'小江', 'Small T', 'Brooks', 'Tom', 'Jerry', 'Alice', 'Bob', 'Natasha']
+
+
+def fake_movies(count, rng, user_id = None):
+    for i in range(count):
+        words = rng.sample(FAKE_WORDS, rng.randint(1, 3))
+        yield {'title': '%s %d' % (' '.join(words), i), 'year': str(rng.randint(1920, 2020)), 'user_id': user_id}
+
+
+def fake_messages(count, rng):
+    for i in range(count):
+        words = [rng.choice(FAKE_WORDS).lower() for _ in range(rng.randint(3, 20))]
+        yield {'name': rng.choice(FAKE_NAMES), 'content': ' '.join(words)[:200]}
+
+
 # 将数据添加到数据库中
-@app.cli.command()
-def forge():
+@cli.command()
+@click.option('--movies', 'movie_count', default = 0, help = 'Generate this many movies instead of the samples.')
+@click.option('--messages', 'message_count', default = 0, help = 'Generate this many messages instead of the samples.')
+@click.option('--seed', default = 0, show_default = True, help = 'Random seed for generated data.')
+def forge(movie_count, message_count, seed):
     """Generate fake data."""
     db.create_all()
-    
+    owner = User.owner()  # 还没有用户时，电影条目在创建管理员时归属管理员
+    owner_id = owner.id if owner else None
+
+    if movie_count or message_count:  # 生成指定数量的数据，用于基准测试
+        rng = random.Random(seed)
+        bulk_insert(Movie, fake_movies(movie_count, rng, owner_id), 5000, [Movie.version_key(owner_id)])
+        bulk_insert(Message, fake_messages(message_count, rng), 5000)
+        click.echo('Done.')
+        return
+
     # 定义虚拟数据
     # name = 'Big Jiang'
     movies = [
@@ -51,34 +167,347 @@ def forge():
     # user = User(name = name)
     # db.session.add(user)
     for m in movies:
-        movie = Movie(title = m['title'], year = m['year'])
+        movie = Movie(title = m['title'], year = m['year'], user_id = owner_id)
         db.session.add(movie)
     for m in messages:
         message = Message(name = m['name'], content = m['content'])
         db.session.add(message)
-    
+    Stat.record(Stat.count(Movie, movies))
+    Stat.record(Stat.count(Message, messages))
+    Version.bump('movie')
+    Version.bump(Movie.version_key(owner_id))
+    Version.bump('message')
     db.session.commit()
     click.echo('Done.')  # 命令行提示用户数据添加完成
 
-# 该程序只允许一个人使用，不需要编写注册页面。为了防止游客对数据进行修改，需要编写命令来创建管理员账户
+# 站长是第一个用户，主页默认显示站长的清单；其他用户用 add-user 创建，没有注册页面
 # 设置管理员账户
-@app.cli.command()  # 注册为命令
+@cli.command()  # 注册为命令
 @click.option('--username', prompt = True, help = 'The username used to login.')  # 命令要求输入用户名和密码（要求二次输入）
 @click.option('--password', prompt = True, hide_input = True, confirmation_prompt = True, help = 'The password used to login.')
 def admin(username, password):
-    """Create user."""
+    """Create user, or reset the password of an existing one."""
     db.create_all()
 
-    user = User.query.first()
-    if user is not None:  # 如果用户存在，则更新相关信息
+    user = User.query.filter_by(username = username).first()
+    if user is not None:  # 如果用户存在，则更新密码
         click.echo('Updating user...')
-        user.username = username
         user.set_password(password)
     else:  # 用户不存在，创建管理员
         click.echo('Creating user...')
+        first = User.owner() is None
         user = User(username = username, name = 'Admin')
         user.set_password(password)
         db.session.add(user)
+        db.session.flush()
+        if first:  # 第一个用户是站长，接收在此之前生成或导入的条目
+            Movie.adopt_orphans(user.id)
 
+    Version.bump('user')
     db.session.commit()
-    click.echo('Done.')
\ No newline at end of file
+    user_cache.clear()
+    response_cache.clear()
+    click.echo('Done.')
+
+
+@cli.command('add-user')
+@click.option('--username', prompt = True, help = 'The username used to login.')
+@click.option('--password', prompt = True, hide_input = True, confirmation_prompt = True, help = 'The password used to login.')
+@click.option('--name', help = 'Display name, the username by default.')
+def add_user(username, password, name):
+    """Create another user with an empty watchlist."""
+    if len(username) > 20 or (name and len(name) > 20):
+        raise click.BadParameter('Username and name must be at most 20 characters.')
+    if User.query.filter_by(username = username).first() is not None:
+        raise click.ClickException('User %s already exists.' % username)
+    user = User(username = username, name = name or username)
+    user.set_password(password)
+    db.session.add(user)
+    Version.bump('user')
+    db.session.commit()
+    user_cache.clear()
+    click.echo('Created user %s.' % username)
+
+
+# 批量导入导出：文件按行流式读写，导入时分批 executemany 插入，整个导入在一个事务中完成
+def read_records(stream, fmt):
+    """Yield one dict per CSV row or JSON line of ``stream``, ``None``
+    for a line that is not a JSON object."""
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield record if isinstance(record, dict) else None
+
+
+def guess_format(stream, fmt):
+    if fmt:
+        return fmt
+    ext = os.path.splitext(getattr(stream, 'name', ''))[1].lower()
+    return 'jsonl' if ext in ('.jsonl', '.json', '.ndjson') else 'csv'
+
+
+def write_records(stream, fmt, fields, rows):
+    """Write ``rows`` (tuples in ``fields`` order) one at a time."""
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(fields, row)), ensure_ascii = False, default = str))
+            stream.write('\n')
+
+
+def bulk_insert(model, records, batch_size, versions = (), prepare = None):
+    """Insert ``records`` with one executemany per batch, commit once at the end.
+
+    ``versions`` names extra version counters to bump, e.g. the owner's list.
+    ``prepare`` may drop rows from each batch just before it is inserted,
+    when the earlier batches are already visible to its queries.
+    """
+    inserted = 0
+    counts = Counter()
+    try:
+        for batch in batched(records, batch_size):
+            if prepare is not None:
+                batch = prepare(batch)
+                if not batch:
+                    continue
+            db.session.execute(model.__table__.insert(), batch)
+            counts.update(Stat.count(model, batch))  # 汇总计数在提交前一次写入
+            inserted += len(batch)
+        Stat.record(counts)
+        for name in (model.__tablename__,) + tuple(versions):
+            Version.bump(name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return inserted
+
+
+format_option = click.option('--format', 'fmt', type = click.Choice(['csv', 'jsonl']),
+                             help = 'File format, guessed from the extension by default.')
+batch_option = click.option('--batch-size', default = 5000, show_default = True,
+                            help = 'Rows per executemany batch.')
+
+
+@cli.command('import-movies')
+@click.argument('source', type = click.File('r', encoding = 'utf-8'))
+@format_option
+@batch_option
+@click.option('--user', 'username', help = 'Owner of the imported movies, the site owner by default.')
+def import_movies(source, fmt, batch_size, username):
+    """Import movies from a CSV or JSONL file (columns: title, year)."""
+    owner = User.query.filter_by(username = username).first() if username else User.owner()
+    if username and owner is None:
+        raise click.ClickException('No such user: %s.' % username)
+    owner_id = owner.id if owner else None
+    skipped = [0]
+
+    def records():
+        for record in read_records(source, guess_format(source, fmt)):
+            title, year = (record.get('title'), record.get('year')) if record is not None else (None, None)
+            if isinstance(year, int) and not isinstance(year, bool):  # JSON 中的年份可以是数字
+                year = str(year)
+            if not validate_movie(title, year):
+                skipped[0] += 1
+                continue
+            yield {'title': title, 'year': year, 'user_id': owner_id}
+
+    def new_rows(batch):
+        # 跳过该用户已有的 (title, year) 组合：每批按标题索引查询一次，内存占用与文件大小无关
+        seen = set()
+        for titles in batched({row['title'] for row in batch}, 500):
+            seen.update(db.session.query(Movie.title, Movie.year).filter(Movie.user_id == owner_id)
+                        .filter(Movie.deleted_at.is_(None), Movie.title.in_(titles)))
+        rows = []
+        for row in batch:
+            key = (row['title'], row['year'])
+            if key in seen:
+                skipped[0] += 1
+                continue
+            seen.add(key)
+            rows.append(row)
+        return rows
+
+    inserted = bulk_insert(Movie, records(), batch_size, [Movie.version_key(owner_id)], new_rows)
+    click.echo('Imported %d movies, skipped %d.' % (inserted, skipped[0]))
+
+
+@cli.command('import-messages')
+@click.argument('source', type = click.File('r', encoding = 'utf-8'))
+@format_option
+@batch_option
+def import_messages(source, fmt, batch_size):
+    """Import messages from a CSV or JSONL file (columns: name, content, created_at)."""
+    skipped = [0]
+    now = datetime.utcnow()
+
+    def records():
+        for record in read_records(source, guess_format(source, fmt)):
+            if record is None or not validate_message(record.get('name'), record.get('content')):
+                skipped[0] += 1
+                continue
+            created_at = record.get('created_at')
+            try:  # 无法解析的时间只跳过这一行，不中止整个导入
+                created_at = datetime.fromisoformat(created_at) if created_at else now
+            except (TypeError, ValueError):
+                skipped[0] += 1
+                continue
+            yield {'name': record['name'], 'content': record['content'], 'created_at': created_at}
+
+    inserted = bulk_insert(Message, records(), batch_size)
+    click.echo('Imported %d messages, skipped %d.' % (inserted, skipped[0]))
+
+
+@cli.command('export-movies')
+@click.argument('target', type = click.File('w', encoding = 'utf-8'), default = '-')
+@format_option
+@click.option('--user', 'username', help = 'Only export the movies of this user (all users by default).')
+def export_movies(target, fmt, username):
+    """Export movies to a CSV or JSONL file (stdout by default)."""
+    fields = ('id', 'title', 'year')
+    query = db.session.query(Movie.id, Movie.title, Movie.year).filter(Movie.deleted_at.is_(None))
+    if username:  # 与 import-movies --user 配合，按用户导出后再导入到对应的用户
+        owner = User.query.filter_by(username = username).first()
+        if owner is None:
+            raise click.ClickException('No such user: %s.' % username)
+        query = query.filter(Movie.user_id == owner.id)
+    rows = query.order_by(Movie.id).yield_per(1000)
+    write_records(target, guess_format(target, fmt), fields, rows)
+
+
+@cli.command('export-messages')
+@click.argument('target', type = click.File('w', encoding = 'utf-8'), default = '-')
+@format_option
+def export_messages(target, fmt):
+    """Export messages to a CSV or JSONL file (stdout by default)."""
+    fields = ('id', 'name', 'content', 'created_at')
+    rows = db.session.query(Message.id, Message.name, Message.content, Message.created_at) \
+        .order_by(Message.id).yield_per(1000)
+    write_records(target, guess_format(target, fmt), fields, rows)
+
+
+# 垃圾留言过滤模型
+@cli.command('train-spam')
+@click.argument('source', type = click.File('r', encoding = 'utf-8'))
+@format_option
+@click.option('--features', default = 2 ** 18, show_default = True, help = 'Number of hashed features.')
+def train_spam(source, fmt, features):
+    """Train the spam model from a CSV or JSONL file (columns: content, spam)."""
+    texts, labels = [], []
+    for record in read_records(source, guess_format(source, fmt)):
+        if record is None:
+            continue
+        texts.append(record.get('content') or '')
+        labels.append(str(record.get('spam')).lower() in ('1', 'true', 'yes', 'spam'))
+    try:
+        model = NaiveBayesStage.train(texts, labels, features)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    model.save(current_app.config['SPAM_MODEL_PATH'])  # 各进程发现文件修改时间变化后重新加载模型
+    click.echo('Trained on %d messages (%d spam).' % (len(texts), sum(labels)))
+
+
+@cli.command('filter-spam')
+@click.option('--delete', is_flag = True, help = 'Delete the messages found to be spam.')
+@batch_option
+def filter_spam(delete, batch_size):
+    """Score the existing messages in batches and report (or delete) spam."""
+    spam_filter = get_filter()
+    rows = db.session.query(Message.id, Message.content).order_by(Message.id).yield_per(batch_size)
+    spam_ids = []
+    for batch in batched(rows, batch_size):
+        flags = spam_filter.score_many([content for _, content in batch])
+        spam_ids.extend(message_id for (message_id, _), flag in zip(batch, flags) if flag)
+
+    if delete and spam_ids:
+        for ids in batched(spam_ids, batch_size):
+            Stat.record(Stat.count_rows(Message, [Message.id.in_(ids)], -1))
+            Message.query.filter(Message.id.in_(ids)).delete(synchronize_session = False)
+        Version.bump('message')
+        db.session.commit()
+        click.echo('Deleted %d spam messages.' % len(spam_ids))
+    else:
+        click.echo('Found %d spam messages.' % len(spam_ids))
+
+
+
+# 静态文件：生成带指纹的文件名、压缩样式表并预先生成 gzip/brotli 版本，部署前执行
+@assets.command('build')
+def assets_build():
+    """Fingerprint, minify and precompress the static files."""
+    from watchlist.assets import brotli, build
+    manifest = build(current_app.static_folder)
+    click.echo('Built %d assets%s.' % (len(manifest), '' if brotli else ' (install brotli for .br files)'))
+
+
+@assets.command('clean')
+def assets_clean():
+    """Remove the built static files."""
+    from watchlist.assets import DIST
+    shutil.rmtree(os.path.join(current_app.static_folder, DIST), ignore_errors = True)
+    click.echo('Removed built assets.')
+
+
+# 清除软删除的条目并归还空闲页，可以由 cron 等定期执行
+@cli.command()
+@click.option('--days', type = float, help = 'Purge movies deleted more than this many days ago '
+                                             '(MOVIE_PURGE_DAYS by default).')
+@click.option('--pages', default = 1000, show_default = True, help = 'Free pages to release per run, 0 for all.')
+@click.option('--full', is_flag = True, help = 'Switch to incremental auto-vacuum with one full VACUUM.')
+@batch_option
+def purge(days, pages, full, batch_size):
+    """Delete soft-deleted movies and vacuum incrementally."""
+    if days is None:
+        days = current_app.config['MOVIE_PURGE_DAYS']
+    # 不早于撤销期限，避免清除仍可以撤销的条目
+    days = max(days, current_app.config['MOVIE_UNDO_SECONDS'] / 86400.0)
+    cutoff = datetime.utcnow() - timedelta(days = days)
+    table = Movie.__table__
+    ids = [row[0] for row in db.session.query(Movie.id).filter(Movie.deleted_at < cutoff)]
+    for chunk in batched(ids, batch_size):  # 每批一条 DELETE，全文索引由触发器同步
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+    db.session.commit()
+    click.echo('Purged %d movies.' % len(ids))
+
+    if db.engine.dialect.name != 'sqlite':  # 其他数据库由自身的 autovacuum 回收空间
+        return
+    if ids and fts_available():
+        db.session.execute(text("INSERT INTO movie_fts (movie_fts) VALUES ('optimize')"))  # 合并索引段
+        db.session.commit()
+    with db.engine.connect() as conn:
+        if full:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')  # 重写整个数据库，之后才能使用增量 VACUUM
+            click.echo('Vacuumed database.')
+        elif conn.execute('PRAGMA auto_vacuum').scalar() == 2:  # INCREMENTAL
+            free = conn.execute('PRAGMA freelist_count').scalar()
+            conn.execute('PRAGMA incremental_vacuum(%d)' % pages if pages else 'PRAGMA incremental_vacuum')
+            click.echo('Released %d of %d free pages.' % (min(free, pages) if pages else free, free))
+        else:
+            click.echo('Auto-vacuum is off, run with --full once to enable incremental vacuum.')
+
+
+# 从元数据提供方获取评分、海报和详情链接，已获取的条目超过 ENRICH_REFRESH_DAYS 天后才重新获取
+@cli.command()
+@click.option('--limit', type = int, help = 'Enrich at most this many movies.')
+@click.option('--refresh-days', type = float, help = 'Refresh metadata older than this many days '
+                                                     '(ENRICH_REFRESH_DAYS by default).')
+@click.option('--batch-size', type = int, help = 'Movies looked up concurrently per batch (ENRICH_BATCH_SIZE).')
+def enrich(limit, refresh_days, batch_size):
+    """Fetch movie metadata from the configured provider."""
+    if not current_app.config['ENRICH_PROVIDER_URL']:
+        raise click.UsageError('ENRICH_PROVIDER_URL is not set.')
+    enriched, missing, failed = enrich_movies(limit, refresh_days, batch_size)
+    click.echo('Enriched %d movies, %d not found, %d failed.' % (enriched, missing, failed))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import time
+from functools import wraps
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+
+
+def apply_sqlite_pragmas(dbapi_connection, config):
+    """Tune a new SQLite connection for many readers and a few writers.
+
+    WAL lets readers keep going while a writer commits, ``busy_timeout``
+    makes a blocked writer wait instead of failing with "database is
+    locked", and ``synchronous=NORMAL`` is safe under WAL while saving an
+    fsync per commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA page_count')
+    if not cursor.fetchone()[0]:  # 只对还没有建表的数据库生效；对已有数据库设置也要等待写锁
+        cursor.execute('PRAGMA auto_vacuum=%s' % config['SQLITE_AUTO_VACUUM'])
+    cursor.execute('PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'])
+    cursor.execute('PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'])
+    cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+    cursor.execute('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+    cursor.execute('PRAGMA cache_size=%d' % config['SQLITE_CACHE_SIZE'])
+    cursor.close()
+
+
+def engine_options(config):
+    """Build ``SQLALCHEMY_ENGINE_OPTIONS`` from the ``DATABASE_POOL_*`` settings."""
+    options = {}
+    if config['DATABASE_POOL_SIZE']:
+        options.update(
+            pool_size = config['DATABASE_POOL_SIZE'],
+            max_overflow = config['DATABASE_POOL_MAX_OVERFLOW'],
+            pool_timeout = config['DATABASE_POOL_TIMEOUT'],
+        )
+        if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            from sqlalchemy.pool import QueuePool
+            # SQLite 文件数据库默认使用 NullPool（每次请求重新连接），指定连接池大小时改用 QueuePool
+            options.update(poolclass = QueuePool, connect_args = {'check_same_thread': False})
+    if config['DATABASE_POOL_RECYCLE']:
+        options['pool_recycle'] = config['DATABASE_POOL_RECYCLE']
+    if config['DATABASE_POOL_PRE_PING']:
+        options['pool_pre_ping'] = True  # 取出连接前先检查，避免使用被服务器断开的连接
+    return options
+
+
+def database_url(url):
+    # 部分托管服务提供 postgres:// 形式的地址，SQLAlchemy 1.4 起只接受 postgresql://
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def replica_enabled(app):
+    return 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+def use_replica():
+    return has_request_context() and request.environ.get('watchlist.read_replica', False)
+
+
+def read_replica(view):
+    """Send the queries of a GET ``view`` to the ``replica`` bind.
+
+    Writes always go to the primary.  For ``DATABASE_READ_YOUR_WRITES``
+    seconds after one of its POSTs a client keeps reading from the primary,
+    so it sees its own changes even while the replica lags behind.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method == 'GET' and replica_enabled(current_app) \
+                and session.get('primary_until', 0) <= time.time():
+            request.environ['watchlist.read_replica'] = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def remember_write(response):
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and replica_enabled(current_app):
+        session['primary_until'] = time.time() + current_app.config['DATABASE_READ_YOUR_WRITES']
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from the replica inside ``read_replica`` views."""
+
+    def get_bind(self, mapper = None, clause = None):
+        if not self._flushing and use_replica():
+            return get_state(self.app).db.get_engine(self.app, bind = 'replica')
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class SQLAlchemy(_SQLAlchemy):
+    """Flask-SQLAlchemy with the SQLite pragmas applied to every connection
+    and optional read-replica routing."""
+
+    def init_app(self, app):
+        super(SQLAlchemy, self).init_app(app)
+        app.after_request(remember_write)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_ = RoutingSession, db = self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            config = self.get_app().config
+
+            @event.listens_for(engine, 'connect')
+            def on_connect(dbapi_connection, connection_record):
+                apply_sqlite_pragmas(dbapi_connection, config)
+        return engine
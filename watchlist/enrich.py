@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import http.client
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlsplit
+
+from flask import current_app
+from sqlalchemy import bindparam, or_
+
+from watchlist import db
+from watchlist.cache import FileBackend
+
+logger = logging.getLogger(__name__)
+
+# 提供方返回的 JSON 字段与 Movie 列的对应关系
+FIELDS = {'id': 'external_id', 'rating': 'rating', 'poster': 'poster_url', 'url': 'detail_url'}
+
+
+class ProviderError(Exception):
+    """The metadata provider answered with something other than 200 or 404."""
+
+
+def provider_url(template, title, year):
+    """``ENRICH_PROVIDER_URL`` with ``{title}`` and ``{year}`` filled in."""
+    return template.format(title = quote(title or '', safe = ''), year = quote(year or '', safe = ''))
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections, one per thread and host, for the
+    thread-pool fetcher; a connection that went stale is reopened once."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault('connections', {})
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = connections[(scheme, netloc)] = cls(netloc, timeout = self.timeout)
+        return conn
+
+    def get(self, url):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for attempt in (0, 1):
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers = {'Accept': 'application/json'})
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt:
+                    raise
+
+
+async def _gather_threads(urls, concurrency, timeout):
+    import asyncio
+    pool = ConnectionPool(timeout)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(concurrency) as executor:
+        return await asyncio.gather(*[loop.run_in_executor(executor, pool.get, url) for url in urls],
+                                    return_exceptions = True)
+
+
+async def _gather_aiohttp(urls, concurrency, timeout):
+    import asyncio
+    import aiohttp
+    connector = aiohttp.TCPConnector(limit = concurrency)  # 连接池大小即并发上限
+    async with aiohttp.ClientSession(connector = connector, timeout = aiohttp.ClientTimeout(total = timeout)) as client:
+        async def get(url):
+            async with client.get(url, headers = {'Accept': 'application/json'}) as response:
+                return response.status, await response.read()
+        return await asyncio.gather(*[get(url) for url in urls], return_exceptions = True)
+
+
+def fetch_all(urls, concurrency, timeout):
+    """Fetch ``urls`` with at most ``concurrency`` requests in flight;
+    return ``(status, body)`` or the exception for each URL, in order."""
+    if not urls:
+        return []
+    # asyncio 和 aiohttp 只在获取元数据时导入，create_app 导入本模块时不增加 web worker 的启动时间
+    import asyncio
+    try:  # 可选依赖，没有安装时在线程池中使用标准库发送请求
+        import aiohttp
+        gather = _gather_aiohttp
+    except ImportError:
+        gather = _gather_threads
+    return asyncio.run(gather(urls, concurrency, timeout))
+
+
+class Enricher(object):
+    """Look movies up at ``ENRICH_PROVIDER_URL`` through a disk cache.
+
+    The provider is any HTTP endpoint answering ``GET`` with a JSON object
+    holding ``id``, ``rating``, ``poster`` and ``url`` (all optional), or
+    404 when it does not know the title.  Found and not-found answers are
+    cached by URL for ``ENRICH_CACHE_TTL`` and ``ENRICH_NEGATIVE_TTL``
+    seconds, so re-running the job, or two movies with the same title,
+    costs no request; errors are not cached and retried on the next run.
+    """
+
+    def __init__(self, config):
+        self.template = config['ENRICH_PROVIDER_URL']
+        self.concurrency = config['ENRICH_CONCURRENCY']
+        self.timeout = config['ENRICH_TIMEOUT']
+        self.ttl = config['ENRICH_CACHE_TTL']
+        self.negative_ttl = config['ENRICH_NEGATIVE_TTL']
+        self.cache = FileBackend(config['ENRICH_CACHE_DIR'])
+
+    def lookup(self, movies):
+        """Map each ``(id, title, year)`` to a dict of column values,
+        ``{}`` when the provider does not know it, or a :class:`ProviderError`."""
+        urls = {movie[0]: provider_url(self.template, movie[1], movie[2]) for movie in movies}
+        answers = {url: self.cache.get(url) for url in set(urls.values())}
+        missing = [url for url, answer in answers.items() if answer is None]
+        for url, result in zip(missing, fetch_all(missing, self.concurrency, self.timeout)):
+            if isinstance(result, Exception):
+                answers[url] = ProviderError('%s: %s' % (url, result))
+                continue
+            status, body = result
+            if status == 200:
+                try:
+                    data = json.loads(body.decode('utf-8'))
+                except ValueError as e:
+                    answers[url] = ProviderError('%s: %s' % (url, e))
+                    continue
+                answers[url] = {column: data.get(key) for key, column in FIELDS.items()}
+                self.cache.set(url, answers[url], self.ttl)
+            elif status == 404:
+                answers[url] = {}
+                self.cache.set(url, {}, self.negative_ttl)
+            else:
+                answers[url] = ProviderError('%s: HTTP %d' % (url, status))
+        return {movie_id: answers[url] for movie_id, url in urls.items()}
+
+
+def _normalize(values):
+    values = {column: values.get(column) for column in FIELDS.values()}
+    if values['external_id'] is not None:
+        values['external_id'] = str(values['external_id'])[:64]
+    try:
+        values['rating'] = float(values['rating']) if values['rating'] is not None else None
+    except (TypeError, ValueError):
+        values['rating'] = None
+    for column in ('poster_url', 'detail_url'):  # 只接受 http(s) 地址，避免在页面中输出 javascript: 等链接
+        url = values[column]
+        values[column] = url[:255] if isinstance(url, str) and url.startswith(('http://', 'https://')) else None
+    return values
+
+
+def enrich(limit = None, refresh_days = None, batch_size = None):
+    """Enrich live movies never enriched or enriched more than
+    ``refresh_days`` ago; return ``(enriched, not_found, failed)``."""
+    from watchlist.models import Movie, Version
+    config = current_app.config
+    if not config['ENRICH_PROVIDER_URL']:
+        return 0, 0, 0
+    refresh_days = config['ENRICH_REFRESH_DAYS'] if refresh_days is None else refresh_days
+    batch_size = batch_size or config['ENRICH_BATCH_SIZE']
+    enricher = Enricher(config)
+    stale = datetime.utcnow() - timedelta(days = refresh_days)
+    table = Movie.__table__
+    update = table.update().where(table.c.id == bindparam('movie_id')) \
+        .values(enriched_at = bindparam('enriched_at'), **{c: bindparam(c) for c in FIELDS.values()})
+
+    counts = [0, 0, 0]
+    last_id = 0
+    while limit is None or sum(counts) < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sum(counts))
+        movies = db.session.query(Movie.id, Movie.title, Movie.year, Movie.user_id) \
+            .filter(Movie.deleted_at.is_(None), Movie.id > last_id) \
+            .filter(or_(Movie.enriched_at.is_(None), Movie.enriched_at < stale)) \
+            .order_by(Movie.id).limit(size).all()
+        if not movies:
+            break
+        last_id = movies[-1].id  # 失败的条目本次不再重试，按 id 向后推进
+        results = enricher.lookup(movies)
+        now = datetime.utcnow()
+        rows, owners = [], set()
+        for movie in movies:
+            result = results[movie.id]
+            if isinstance(result, ProviderError):
+                logger.warning('Failed to enrich movie %d: %s', movie.id, result)
+                counts[2] += 1
+                continue
+            counts[0 if result else 1] += 1
+            rows.append(dict(_normalize(result), movie_id = movie.id, enriched_at = now))
+            owners.add(movie.user_id)
+        if rows:  # 每批一条 executemany，并让页面缓存失效
+            db.session.execute(update, rows)
+            for name in ['movie'] + [Movie.version_key(user_id) for user_id in owners]:
+                Version.bump(name)
+            db.session.commit()
+    return tuple(counts)
+
+
+class EnrichWorker(object):
+    """Optional background thread running :func:`enrich` every
+    ``ENRICH_WORKER_INTERVAL`` seconds.  Like the message writer it is
+    started on first use (the first request), i.e. after gunicorn forked."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    app = current_app._get_current_object()
+                    self._stopping.clear()
+                    self._thread = threading.Thread(target = self._run, args = (app,), name = 'enrich-worker')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def stop(self, timeout = 10):
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self, app):
+        interval = app.config['ENRICH_WORKER_INTERVAL']
+        while not self._stopping.wait(interval):
+            with app.app_context():
+                try:
+                    enrich()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Enrichment run failed')
+                finally:
+                    db.session.remove()
+
+
+enrich_worker = EnrichWorker()
+
+
+def init_enrich(app):
+    if app.config['ENRICH_WORKER_ENABLED'] and app.config['ENRICH_PROVIDER_URL']:
+        app.before_request(enrich_worker.ensure_started)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+from collections import deque, namedtuple
+
+from flask import current_app
+
+# 推送给客户端的事件：id 在进程内递增，kind 为 message 或 movie，data 为 JSON 字符串
+Event = namedtuple('Event', 'id kind data')
+
+KINDS = ('message', 'movie')
+
+
+class BrokerFull(Exception):
+    """``EVENTS_MAX_CLIENTS`` streams are already open in this process."""
+
+
+class Subscriber(object):
+    """Bounded buffer of one connected client.
+
+    A client that falls more than ``EVENTS_CLIENT_BUFFER`` events behind
+    is marked as overflowed and its stream ends; EventSource reconnects by
+    itself and catches up from the broker history with ``Last-Event-ID``.
+    """
+
+    def __init__(self, kinds, size):
+        self.kinds = kinds
+        self.size = size
+        self.overflowed = False
+        self._events = deque()
+        self._cond = threading.Condition()  # gevent 打过补丁后同样只挂起协程
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) >= self.size:
+                self.overflowed = True
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Return the next event, or ``None`` after ``timeout`` seconds."""
+        with self._cond:
+            if not self._events and not self.overflowed:
+                self._cond.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+
+class EventBroker(object):
+    """In-process publish/subscribe for the live feed.
+
+    The write paths call ``publish()`` after committing; every open
+    ``/events`` stream holds a :class:`Subscriber`.  The last
+    ``EVENTS_HISTORY`` events are kept so reconnecting clients miss
+    nothing.  Events only reach streams served by the same process, so run
+    the feed on one process with many green threads (``gunicorn -k gevent``)
+    rather than on many sync workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque()
+        self._last_id = 0
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, kind, *items):
+        """Publish one event per item of ``kind``; no-op when disabled."""
+        config = current_app.config
+        if not config['EVENTS_ENABLED'] or not items:
+            return
+        with self._lock:
+            events = []
+            for data in items:
+                self._last_id += 1
+                events.append(Event(self._last_id, kind, json.dumps(data, ensure_ascii = False, default = str)))
+            self._history.extend(events)
+            while len(self._history) > config['EVENTS_HISTORY']:
+                self._history.popleft()
+            subscribers = [s for s in self._subscribers if kind in s.kinds]
+        for subscriber in subscribers:  # 在锁外分发，慢客户端不会阻塞发布者
+            for event in events:
+                subscriber.put(event)
+
+    def subscribe(self, kinds, last_event_id = None):
+        config = current_app.config
+        subscriber = Subscriber(kinds, config['EVENTS_CLIENT_BUFFER'])
+        with self._lock:
+            if len(self._subscribers) >= config['EVENTS_MAX_CLIENTS']:
+                raise BrokerFull()
+            self._subscribers.add(subscriber)
+            # 重连的客户端先补发错过的事件；id 比当前大说明进程重启过，不补发
+            if last_event_id is not None and last_event_id <= self._last_id:
+                for event in self._history:
+                    if event.id > last_event_id and event.kind in kinds:
+                        subscriber.put(event)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, subscriber, heartbeat):
+        """Yield the SSE text of ``subscriber`` until it disconnects.
+
+        A comment line is sent every ``heartbeat`` seconds without events so
+        proxies keep the connection open and a dead client is noticed on the
+        next write.  The generator does not touch the app or the database.
+        """
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscriber.get(heartbeat)
+                if event is not None:
+                    yield 'id: %d\nevent: %s\ndata: %s\n\n' % event
+                elif subscriber.overflowed:
+                    break
+                else:
+                    yield ': ping\n\n'
+        finally:
+            self.unsubscribe(subscriber)
+
+
+broker = EventBroker()
+
+
+def movie_event(action, movie, username):
+    return {'action': action, 'id': movie.id, 'title': movie.title, 'year': movie.year, 'user': username}
+
+
+def message_event(message):
+    event = {'name': message['name'], 'content': message['content'], 'created_at': message['created_at'].isoformat()}
+    if message.get('id') is not None:  # 异步写入的留言批量插入，没有 id
+        event['id'] = message['id']
+    return event
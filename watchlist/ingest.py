@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from watchlist import db
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter(object):
+    """Write-behind queue for guestbook messages.
+
+    ``submit()`` only puts the validated message on a bounded in-process
+    queue; a background thread inserts the queued messages in batches of
+    ``MESSAGE_INGEST_BATCH_SIZE`` at most every
+    ``MESSAGE_INGEST_FLUSH_INTERVAL`` seconds, so a burst of POSTs costs a
+    few transactions instead of one commit (and fsync) each.  Each app has
+    its own writer (see ``init_ingest``).  The thread is started on first
+    use, i.e. after gunicorn has forked the worker, and the queue is
+    drained when the process exits.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def _start(self):
+        app = self.app
+        self._queue = queue.Queue(maxsize = app.config['MESSAGE_INGEST_QUEUE_SIZE'])
+        self._stopping.clear()
+        self._thread = threading.Thread(target = self._run, args = (app,), name = 'message-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, name, content):
+        """Queue a message; return ``False`` when the queue is full."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._start()
+        try:
+            self._queue.put_nowait({'name': name, 'content': content, 'created_at': datetime.utcnow()})
+        except queue.Full:
+            return False
+        return True
+
+    def stop(self, timeout = 10):
+        """Flush everything still queued and stop the writer thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        thread.join(timeout)
+        self._thread = None
+
+    def _run(self, app):
+        batch_size = app.config['MESSAGE_INGEST_BATCH_SIZE']
+        interval = app.config['MESSAGE_INGEST_FLUSH_INTERVAL']
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout = interval)]
+            except queue.Empty:
+                continue
+            # 收集一批留言：达到批量大小或等待超过刷新间隔后写入
+            deadline = time.time() + interval
+            while len(batch) < batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stopping.is_set():
+                    remaining = 0
+                try:
+                    batch.append(self._queue.get(timeout = remaining) if remaining else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with app.app_context():
+                self._flush(batch)
+
+    @staticmethod
+    def _flush(batch):
+        from watchlist.events import broker, message_event
+        from watchlist.models import Message, Stat, Version
+        try:
+            db.session.execute(Message.__table__.insert(), batch)
+            Stat.record(Stat.count(Message, batch))
+            Version.bump('message')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Failed to write %d queued messages', len(batch))
+        else:
+            broker.publish('message', *[message_event(message) for message in batch])
+        finally:
+            db.session.remove()
+
+
+def init_ingest(app):
+    app.extensions['message_writer'] = MessageWriter(app)
+
+
+# 当前程序的写入队列
+message_writer = LocalProxy(lambda: current_app.extensions['message_writer'])
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter as _Tally
+
+from flask import Blueprint, current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_ENVIRON_KEY = 'watchlist.metrics'
+
+# 请求耗时、SQL 耗时和模板渲染耗时使用的桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 每个请求的 SQL 查询数使用的桶
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for (k, _), v in zip(pairs, escaped))
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels = (), amount = 1):
+        labels = tuple(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels = ()):
+        return self._values.get(tuple(labels), 0)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labels, labels), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, labels = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [每个桶的计数..., 总和, 次数]
+
+    def observe(self, value, labels = ()):
+        labels = tuple(labels)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                data = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def count(self, labels = ()):
+        data = self._values.get(tuple(labels))
+        return data[-1] if data else 0
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, data in sorted(self._values.items()):
+                for bound, value in zip(self.buckets, data):
+                    lines.append('%s_bucket%s %d' % (
+                        self.name, _format_labels(self.labels, labels, [('le', repr(float(bound)))]), value))
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _format_labels(self.labels, labels, [('le', '+Inf')]), data[-1]))
+                lines.append('%s_sum%s %r' % (self.name, _format_labels(self.labels, labels), data[-2]))
+                lines.append('%s_count%s %d' % (self.name, _format_labels(self.labels, labels), data[-1]))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+REQUEST_LATENCY = registry.register(Histogram(
+    'watchlist_request_duration_seconds', 'Request latency by endpoint.', ('endpoint', 'method')))
+REQUEST_QUERIES = registry.register(Histogram(
+    'watchlist_request_sql_queries', 'SQL queries issued per request.', ('endpoint',), COUNT_BUCKETS))
+SQL_LATENCY = registry.register(Histogram(
+    'watchlist_sql_duration_seconds', 'SQL statement execution time by endpoint.', ('endpoint',)))
+TEMPLATE_LATENCY = registry.register(Histogram(
+    'watchlist_template_render_seconds', 'Template render time.', ('template',)))
+N_PLUS_ONE = registry.register(Counter(
+    'watchlist_n_plus_one_total', 'Requests that repeated one SQL statement suspiciously often.', ('endpoint',)))
+PROFILES = registry.register(Counter(
+    'watchlist_profiles_dumped_total', 'Slow request profiles written to disk.', ('endpoint',)))
+
+
+def _stats():
+    if not has_request_context():
+        return None
+    return request.environ.get(_ENVIRON_KEY)
+
+
+# SQL 事件钩子：注册在 Engine 类上，对所有引擎生效，只统计开启了指标的请求
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _stats() is not None:
+        conn.info.setdefault('watchlist_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    starts = conn.info.get('watchlist_query_start')
+    if stats is None or not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    stats['queries'] += 1
+    stats['sql_time'] += elapsed
+    stats['statements'][statement] += 1
+    SQL_LATENCY.observe(elapsed, (request.endpoint or 'unknown',))
+
+
+def _before_render_template(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats['templates'].append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats['templates']:
+        TEMPLATE_LATENCY.observe(time.perf_counter() - stats['templates'].pop(), (template.name,))
+
+
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+def _install_hooks():
+    global _hooks_installed
+    with _hooks_lock:
+        if _hooks_installed:
+            return
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        from flask import signals
+        if signals.signals_available:  # 模板信号需要安装 blinker
+            signals.before_render_template.connect(_before_render_template)
+            signals.template_rendered.connect(_template_rendered)
+        else:
+            logger.info('blinker is not installed, template render time is not recorded')
+        _hooks_installed = True
+
+
+def _start_profiler(config):
+    if config['METRICS_PROFILER'] == 'pyinstrument':
+        from pyinstrument import Profiler  # 可选依赖
+        profiler = Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _dump_profile(profiler, config, endpoint, elapsed):
+    directory = config['METRICS_PROFILE_DIR']
+    os.makedirs(directory, exist_ok = True)
+    name = '%s-%s-%dms' % (time.strftime('%Y%m%d-%H%M%S'), endpoint, elapsed * 1000)
+    if config['METRICS_PROFILER'] == 'pyinstrument':
+        with open(os.path.join(directory, name + '.html'), 'w', encoding = 'utf-8') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.dump_stats(os.path.join(directory, name + '.prof'))  # 用 python -m pstats 或 snakeviz 查看
+    PROFILES.inc((endpoint,))
+
+
+def before_request():
+    config = current_app.config
+    stats = {
+        'start': time.perf_counter(), 'queries': 0, 'sql_time': 0.0,
+        'statements': _Tally(), 'templates': [], 'profiler': None,
+    }
+    rate = config['METRICS_PROFILE_SAMPLE_RATE']
+    if rate and random.random() < rate:
+        stats['profiler'] = _start_profiler(config)
+    request.environ[_ENVIRON_KEY] = stats
+
+
+def after_request(response):
+    stats = request.environ.pop(_ENVIRON_KEY, None)
+    if stats is None:
+        return response
+    config = current_app.config
+    elapsed = time.perf_counter() - stats['start']
+    endpoint = request.endpoint or 'unknown'
+
+    REQUEST_LATENCY.observe(elapsed, (endpoint, request.method))
+    REQUEST_QUERIES.observe(stats['queries'], (endpoint,))
+
+    # 同一条 SQL 在一个请求中执行多次，通常是在循环中逐行查询（N+1）
+    if stats['statements']:
+        statement, repeats = stats['statements'].most_common(1)[0]
+        if repeats >= config['METRICS_N_PLUS_ONE_THRESHOLD']:
+            N_PLUS_ONE.inc((endpoint,))
+            logger.warning('Possible N+1 queries in %s: %d x %s', endpoint, repeats, statement)
+
+    profiler = stats['profiler']
+    if profiler is not None:
+        if config['METRICS_PROFILER'] == 'pyinstrument':
+            profiler.stop()
+        else:
+            profiler.disable()
+        if elapsed * 1000 >= config['METRICS_PROFILE_SLOW_MS']:
+            _dump_profile(profiler, config, endpoint, elapsed)
+
+    response.headers['Server-Timing'] = 'app;dur=%.1f, db;dur=%.1f' % (elapsed * 1000, stats['sql_time'] * 1000)
+    return response
+
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/metrics')
+def expose():
+    return current_app.response_class(registry.render(), mimetype = 'text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Instrument ``app`` when ``METRICS_ENABLED`` is set."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    _install_hooks()
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.register_blueprint(metrics)
@@ -1,29 +1,244 @@
 # -*- coding: utf-8 -*-
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy.dialects import postgresql
 from werkzeug.security import generate_password_hash, check_password_hash 
 
 from watchlist import db
+from watchlist.utils import batched
+
+
+def _increment(table, keys, delta, **values):
+    """Add ``delta`` to ``table.value`` of the row with the primary key
+    ``keys`` (and set ``values``), inserting the row if it is missing.
+
+    PostgreSQL gets ``INSERT ... ON CONFLICT DO UPDATE``, so two first
+    writers of a key cannot both insert.  Elsewhere (SQLite) the UPDATE
+    already holds the only write lock when the INSERT follows.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(value = delta, **dict(keys, **values))
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements = list(keys), set_ = dict(values, value = table.c.value + delta)))
+        return
+    criteria = [table.c[name] == value for name, value in keys.items()]
+    result = db.session.execute(table.update().where(db.and_(*criteria)).values(value = table.c.value + delta, **values))
+    if not result.rowcount:
+        db.session.execute(table.insert().values(value = delta, **dict(keys, **values)))
+
 
 class User(db.Model, UserMixin):  # 表名将是 user（自动生成，小写处理）
     id = db.Column(db.Integer, primary_key = True)  # 设置主键
     name = db.Column(db.String(20))  # 名字
-    username = db.Column(db.String(20))  # 用户名
+    username = db.Column(db.String(20), unique = True, index = True)  # 用户名，登录时按用户名查询
     password_hash = db.Column(db.String(128))  # 密码散列值
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, current_app.config['PASSWORD_HASH_METHOD'])
 
     def validate_password(self, password):  # 验证密码
         return check_password_hash(self.password_hash, password)  # 返回布尔值
+
+    @staticmethod
+    def owner():
+        """Return the site owner, the user with the lowest id, or ``None``."""
+        return User.query.order_by(User.id).first()  # 不排序时 PostgreSQL 返回的行会随更新而变化
         
 class Movie(db.Model):  # 表名movie
+    __table_args__ = (
+        db.Index('ix_movie_year_title', 'year', 'title'),  # 按年份筛选并按标题排序时使用的组合索引
+        # 按用户筛选并按 id 游标分页，只扫描该用户的条目；部分索引只包含未删除的条目
+        db.Index('ix_movie_live_user_id_id', 'user_id', 'id',
+                 sqlite_where = db.text('deleted_at IS NULL'), postgresql_where = db.text('deleted_at IS NULL')),
+        # flask purge 查找已删除的条目
+        db.Index('ix_movie_deleted_at', 'deleted_at',
+                 sqlite_where = db.text('deleted_at IS NOT NULL'), postgresql_where = db.text('deleted_at IS NOT NULL')),
+    )
+
     id = db.Column(db.Integer, primary_key = True)  
-    title = db.Column(db.String(60))  
+    title = db.Column(db.String(60), index = True)
     year = db.Column(db.String(4))  
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # 所属用户
+    deleted_at = db.Column(db.DateTime)  # 软删除时间（UTC），为空表示未删除
+    # flask enrich 从元数据提供方获取的信息，enriched_at 为获取时间（UTC），为空表示尚未获取
+    external_id = db.Column(db.String(64))
+    rating = db.Column(db.Float)
+    poster_url = db.Column(db.String(255))
+    detail_url = db.Column(db.String(255))
+    enriched_at = db.Column(db.DateTime)
+    ENRICH_COLUMNS = ('external_id', 'rating', 'poster_url', 'detail_url', 'enriched_at')
+
+    @staticmethod
+    def live():
+        """Query of the movies that are not (soft) deleted."""
+        return Movie.query.filter(Movie.deleted_at.is_(None))
+
+    @staticmethod
+    def version_key(user_id):
+        """Name of the version counter of one user's list."""
+        return 'movie:%s' % user_id
+
+    def clear_enrichment(self):
+        """Forget the metadata of the old title and year, so the next
+        ``flask enrich`` fetches it again."""
+        for column in Movie.ENRICH_COLUMNS:
+            setattr(self, column, None)
+
+    @staticmethod
+    def update_values(values):
+        """Return the SET values of an UPDATE of ``values`` (column name to
+        value or bind parameter) that also clears the metadata of the rows
+        whose title or year changes."""
+        table = Movie.__table__
+        names = [name for name in ('title', 'year') if name in values]
+        if not names:
+            return values
+        # SET 右侧读到的是更新前的值，只有标题或年份真正改变的行才清空
+        changed = db.or_(*[table.c[name] != values[name] for name in names])
+        return dict(values, **{column: db.case([(changed, None)], else_ = table.c[column])
+                               for column in Movie.ENRICH_COLUMNS})
+
+    @staticmethod
+    def _live_ids(user_id, ids):
+        # 调用方已经更新版本号取得写锁，读到的 id 在本事务结束前不会被并发的写入改变
+        return [row[0] for row in db.session.query(Movie.id)
+                .filter(Movie.user_id == user_id, Movie.id.in_(ids), Movie.deleted_at.is_(None))]
+
+    @staticmethod
+    def soft_delete(user_id, ids):
+        """Mark the live movies ``ids`` of ``user_id`` as deleted with one
+        UPDATE per 500 ids; return the ids of the deleted rows and the
+        deletion time, which identifies the batch for ``restore()``."""
+        table = Movie.__table__
+        stamp = datetime.utcnow()
+        deleted = []
+        for chunk in batched(sorted(set(ids)), 500):  # 控制 IN 列表中的参数个数
+            chunk = Movie._live_ids(user_id, chunk)  # 其他用户的和已删除的条目不在结果中
+            if not chunk:
+                continue
+            Stat.record(Stat.count_rows(Movie, [Movie.id.in_(chunk)], -1))
+            db.session.execute(table.update().where(table.c.id.in_(chunk)).values(deleted_at = stamp))
+            deleted.extend(chunk)
+        return deleted, stamp
+
+    @staticmethod
+    def restore(user_id, stamp):
+        """Undo the ``soft_delete()`` that happened at ``stamp``."""
+        table = Movie.__table__
+        Stat.record(Stat.count_rows(Movie, [Movie.user_id == user_id, Movie.deleted_at == stamp]))
+        return db.session.execute(
+            table.update().where(table.c.user_id == user_id).where(table.c.deleted_at == stamp)
+            .values(deleted_at = None)
+        ).rowcount
+
+    @staticmethod
+    def bulk_update(user_id, ids, **values):
+        """Set ``values`` on the live movies ``ids`` of ``user_id``; return
+        the ids of the updated rows."""
+        table = Movie.__table__
+        updated = []
+        for chunk in batched(sorted(set(ids)), 500):
+            chunk = Movie._live_ids(user_id, chunk)
+            if not chunk:
+                continue
+            criteria = [Movie.id.in_(chunk)]
+            Stat.record(Stat.count_rows(Movie, criteria, -1))  # 汇总计数先减去旧值，更新后再加上新值
+            db.session.execute(table.update().where(table.c.id.in_(chunk)).values(**Movie.update_values(values)))
+            Stat.record(Stat.count_rows(Movie, criteria))
+            updated.extend(chunk)
+        return updated
+
+    @staticmethod
+    def adopt_orphans(user_id):
+        """Give movies without an owner (imported before multi-user
+        support, or generated before any user existed) to ``user_id``."""
+        table = Movie.__table__
+        result = db.session.execute(table.update().where(table.c.user_id.is_(None)).values(user_id = user_id))
+        if result.rowcount:
+            Version.bump('movie')
+            Version.bump(Movie.version_key(user_id))
+        return result.rowcount
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_created_at_id', 'created_at', 'id'),  # 留言板按 (created_at, id) 游标分页
+    )
+
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(20))
     content = db.Column(db.String(200))  # 留言内容
+    created_at = db.Column(db.DateTime, default = datetime.utcnow)  # 留言时间（UTC），导入的留言可能早于已有的留言
+
+
+class Version(db.Model):  # 表名 version，保存各类数据的版本号，供多个进程判断缓存是否过期
+    name = db.Column(db.String(20), primary_key = True)
+    value = db.Column(db.Integer, nullable = False, default = 0)
+    updated_at = db.Column(db.DateTime, default = datetime.utcnow)  # 最后一次修改时间（UTC）
+
+    @staticmethod
+    def current(name):
+        """Return the version number of ``name``, 0 if it was never bumped."""
+        value = db.session.query(Version.value).filter(Version.name == name).scalar()
+        return value or 0
+
+    @staticmethod
+    def snapshot(names):
+        """Return ``{name: (value, updated_at)}`` for ``names`` in one query."""
+        rows = db.session.query(Version.name, Version.value, Version.updated_at) \
+            .filter(Version.name.in_(names)).all()
+        return {name: (value, updated_at) for name, value, updated_at in rows}
+
+    @staticmethod
+    def bump(name):
+        """Increase the version of ``name`` in the current transaction."""
+        _increment(Version.__table__, {'name': name}, 1, updated_at = datetime.utcnow())
+
+
+class Stat(db.Model):  # 表名 stat，统计页面使用的汇总计数，由各写入路径在同一事务中增量更新
+    __table_args__ = (
+        db.Index('ix_stat_kind_value', 'kind', 'value'),  # 按数量取前几名
+    )
+
+    kind = db.Column(db.String(20), primary_key = True)  # movie_year、message_month 或 message_name
+    key = db.Column(db.String(20), primary_key = True)
+    value = db.Column(db.Integer, nullable = False, default = 0)
+
+    # 计算汇总键需要的列
+    COLUMNS = {'movie': ('year',), 'message': ('name', 'created_at')}
+
+    @staticmethod
+    def keys(tablename, row):
+        """Summary keys a ``movie`` or ``message`` row (a mapping) counts towards."""
+        if tablename == 'movie':
+            return [('movie_year', row['year'])]
+        created_at = row.get('created_at') or datetime.utcnow()  # 未指定时由列的默认值填入当前时间
+        return [('message_month', created_at.strftime('%Y-%m')), ('message_name', row['name'])]
+
+    @staticmethod
+    def count(model, rows, sign = 1):
+        """Counter of the summary keys of ``rows``, each weighted ``sign``."""
+        counts = Counter()
+        for row in rows:
+            for key in Stat.keys(model.__tablename__, row):
+                counts[key] += sign
+        return counts
+
+    @staticmethod
+    def count_rows(model, criteria, sign = 1):
+        """Like ``count()`` for the rows matching ``criteria``, read just
+        before (``sign = -1``) or after a bulk UPDATE or DELETE.  The rows
+        are locked until commit; on SQLite the caller must already hold the
+        write lock (bump a version first) for the read to be current."""
+        names = Stat.COLUMNS[model.__tablename__]
+        query = db.session.query(*[getattr(model, name) for name in names]).filter(*criteria).with_for_update()
+        return Stat.count(model, (dict(zip(names, row)) for row in query), sign)
 
-    
\ No newline at end of file
+    @staticmethod
+    def record(counts):
+        """Add ``counts`` (``(kind, key)`` to delta) in the current transaction."""
+        for (kind, key), delta in sorted(counts.items()):  # 固定顺序加锁，并发事务不会互相死锁
+            if delta:
+                _increment(Stat.__table__, {'kind': kind, 'key': key}, delta)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import math
+import re
+
+from sqlalchemy import DDL, and_, event, func, select, text
+
+from watchlist import db
+
+# 外部内容（external content）形式的 FTS5 表：索引只保存词条，rowid 与原表的 id 一致，
+# 由触发器在原表增删改时同步
+_FTS_TABLES = (
+    # (FTS 表名, 原表名, 被索引的列)
+    ('movie_fts', 'movie', 'title'),
+    ('message_fts', 'message', 'content'),
+)
+
+_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+    INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+END
+---
+CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+    INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+END
+---
+CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+    INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+    INSERT INTO {fts} (rowid, {column}) VALUES (new.id, new.{column});
+END
+"""
+
+for _fts, _table, _column in _FTS_TABLES:
+    _statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        "{column}, content='{table}', content_rowid='id', prefix='2 3')",
+    ] + _TRIGGERS.split('---')
+    for _statement in _statements:
+        # create_all 之后创建（IF NOT EXISTS 保证可以重复执行），只在 SQLite 上生效
+        event.listen(db.metadata, 'after_create',
+                     DDL(_statement.strip().format(fts = _fts, table = _table, column = _column))
+                     .execute_if(dialect = 'sqlite'))
+    event.listen(db.metadata, 'before_drop',
+                 DDL('DROP TABLE IF EXISTS %s' % _fts).execute_if(dialect = 'sqlite'))
+
+
+def fts_available():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def rebuild_index():
+    """Rebuild every FTS table from its content table."""
+    if not fts_available():  # 其他数据库没有 FTS 表，搜索时使用 LIKE
+        return
+    for fts, table, column in _FTS_TABLES:
+        db.session.execute(text("INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts)))
+    db.session.commit()
+
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def build_match(query):
+    """Turn free text into a safe FTS5 query: every word is quoted and the
+    last one is a prefix match, so ``"tot"`` finds "Totoro" while typing."""
+    tokens = _TOKEN_RE.findall(query or '')
+    if not tokens:
+        return None
+    terms = ['"%s"' % token for token in tokens]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class SearchPage(object):
+    """One page of ranked search results."""
+
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.pages = int(math.ceil(total / float(per_page))) if total else 0
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+
+# 每种可搜索内容返回的列，没有 FTS5 时用 LIKE 匹配的列，以及排除已（软）删除行的条件
+_KINDS = {
+    'movie': ('movie_fts', 'movie', ('id', 'title', 'year'), 'title', 'movie.deleted_at IS NULL'),
+    'message': ('message_fts', 'message', ('id', 'name', 'content'), 'content', None),
+}
+KINDS = tuple(_KINDS)
+
+
+def search(kind, query, page = 1, per_page = 20):
+    """Return a ``SearchPage`` of ``kind`` rows matching ``query``, best first."""
+    fts, table, columns, column, live = _KINDS[kind]
+    match = build_match(query)
+    if match is None:
+        return SearchPage([], 0, 1, per_page)
+    if not fts_available():
+        return _like_search(table, columns, column, live, query, page, per_page)
+
+    if live is None:
+        count_sql = 'SELECT count(*) FROM {fts} WHERE {fts} MATCH :match'
+    else:  # 需要原表的列才能排除已删除的行
+        count_sql = 'SELECT count(*) FROM {fts} JOIN {table} ON {table}.id = {fts}.rowid ' \
+                    'WHERE {fts} MATCH :match AND ' + live
+    total = db.session.execute(text(count_sql.format(fts = fts, table = table)), {'match': match}).scalar()
+    rows = db.session.execute(text(
+        'SELECT {cols} FROM {fts} JOIN {table} ON {table}.id = {fts}.rowid '
+        'WHERE {fts} MATCH :match{live} ORDER BY {fts}.rank LIMIT :limit OFFSET :offset'.format(
+            cols = ', '.join('%s.%s' % (table, c) for c in columns), fts = fts, table = table,
+            live = ' AND ' + live if live else '')
+    ), {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page})
+    items = [dict(zip(columns, row)) for row in rows]
+    return SearchPage(items, total, page, per_page)
+
+
+def _like_search(table, columns, column, live, query, page, per_page):
+    """Fallback for databases without FTS5 (e.g. PostgreSQL): every word
+    must appear in ``column`` (case-insensitive), newest rows first."""
+    table = db.metadata.tables[table]
+    words = [w.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+             for w in _TOKEN_RE.findall(query)]
+    condition = and_(*[table.c[column].ilike('%' + w + '%', escape = '\\') for w in words])
+    if live is not None:
+        condition = and_(condition, text(live))
+    total = db.session.execute(select([func.count()]).select_from(table).where(condition)).scalar()
+    rows = db.session.execute(
+        select([table.c[c] for c in columns]).where(condition)
+        .order_by(table.c.id.desc()).limit(per_page).offset((page - 1) * per_page)
+    )
+    items = [dict(zip(columns, row)) for row in rows]
+    return SearchPage(items, total, page, per_page)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import atexit
+import multiprocessing
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class PasswordCheckUnavailable(Exception):
+    """The password pool is saturated or the check timed out."""
+
+
+def hash_method(pwhash):
+    """Return the method part of a werkzeug hash, iterations included."""
+    method = pwhash.split('$', 1)[0] if pwhash else ''
+    return normalize_method(method)
+
+
+def normalize_method(method):
+    # werkzeug 在省略迭代次数时使用默认值，比较前补齐，避免 pbkdf2:sha256 被误判为需要重新散列
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        method = '%s:%d' % (method, DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+def needs_rehash(pwhash, method):
+    return hash_method(pwhash) != normalize_method(method)
+
+
+_dummy_hashes = {}
+
+
+def dummy_hash(method):
+    """Hash of a random password with ``method``.  Unknown usernames are
+    checked against it, so they take as long as a wrong password."""
+    pwhash = _dummy_hashes.get(method)
+    if pwhash is None:
+        pwhash = _dummy_hashes[method] = generate_password_hash(secrets.token_urlsafe(16), method)
+    return pwhash
+
+
+class PasswordHasher(object):
+    """Run PBKDF2 checks in a bounded process pool.
+
+    Hashing is pure CPU work holding the GIL, so a burst of login attempts
+    would otherwise pin every request thread.  At most
+    ``PASSWORD_POOL_SIZE * PASSWORD_POOL_BACKLOG`` checks are in flight;
+    beyond that, or when a check takes longer than
+    ``PASSWORD_CHECK_TIMEOUT``, :class:`PasswordCheckUnavailable` is raised
+    and the request is answered with 503 instead of queueing.  A pool size
+    of 0 hashes inline on the request thread.  Like the message writer the
+    pool is started on first use, i.e. after gunicorn has forked.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._timeout = None
+
+    def _start(self, config):
+        size = config['PASSWORD_POOL_SIZE']
+        # spawn 启动的子进程不会继承请求线程持有的锁
+        self._executor = ProcessPoolExecutor(max_workers = size, mp_context = multiprocessing.get_context('spawn'))
+        self._slots = threading.BoundedSemaphore(size * config['PASSWORD_POOL_BACKLOG'])
+        self._timeout = config['PASSWORD_CHECK_TIMEOUT']
+        atexit.register(self.stop)
+
+    def _call(self, func, *args):
+        config = current_app.config
+        if not config['PASSWORD_POOL_SIZE']:
+            return func(*args)
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._start(config)
+        if not self._slots.acquire(blocking = False):
+            raise PasswordCheckUnavailable('password pool is full')
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())  # 超时的任务完成后才归还名额
+        try:
+            return future.result(timeout = self._timeout)
+        except TimeoutError:
+            raise PasswordCheckUnavailable('password check timed out')
+
+    def check(self, pwhash, password):
+        return self._call(check_password_hash, pwhash, password)
+
+    def hash(self, password):
+        """Hash ``password`` with ``PASSWORD_HASH_METHOD``."""
+        return self._call(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+    def stop(self):
+        executor = self._executor
+        if executor is None:
+            return
+        self._executor = None
+        executor.shutdown(wait = False)
+
+
+password_hasher = PasswordHasher()
+
+
+def parse_rate(rate):
+    """``'10/60'`` -> ``(10, 60.0)``: a burst of 10 refilled over 60 seconds."""
+    capacity, period = rate.split('/')
+    return int(capacity), float(period)
+
+
+class MemoryBucketStore(object):
+    """Token buckets of one process, oldest keys evicted beyond ``max_keys``."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * capacity / period)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:  # 被淘汰的桶等同于已经补满
+                self._buckets.popitem(last = False)
+        return allowed, tokens
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBucketStore(object):
+    """Token buckets shared by all workers through a small SQLite file.
+
+    The buckets live in their own file so the read-modify-write under
+    ``BEGIN IMMEDIATE`` never waits on the application's write lock.
+    """
+
+    def __init__(self, path, max_keys):
+        self.path = path
+        self.max_keys = max_keys
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS login_bucket '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout = 5, isolation_level = None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, capacity, period, now):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM login_bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * capacity / period)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO login_bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            if row is None:  # 新增桶时顺便清理最久未使用的桶
+                conn.execute('DELETE FROM login_bucket WHERE key IN (SELECT key FROM login_bucket '
+                             'ORDER BY updated DESC LIMIT -1 OFFSET ?)', (self.max_keys,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+    def clear(self):
+        self._connect().execute('DELETE FROM login_bucket')
+
+
+class LoginRateLimiter(object):
+    """Per-IP and per-username token buckets, checked before any hashing."""
+
+    def __init__(self, store, per_ip, per_username):
+        self.store = store
+        self.limits = [('ip', parse_rate(per_ip)), ('user', parse_rate(per_username))]
+
+    def hit(self, remote_addr, username):
+        """Take a token from both buckets; return 0 or the seconds to wait."""
+        now = time.time()
+        for kind, (capacity, period) in self.limits:
+            value = remote_addr if kind == 'ip' else username.lower()
+            allowed, tokens = self.store.take('%s:%s' % (kind, value), capacity, period, now)
+            if not allowed:
+                return int((1 - tokens) * period / capacity) + 1
+        return 0
+
+
+def build_limiter(config):
+    max_keys = config['LOGIN_RATE_LIMIT_MAX_KEYS']
+    if config['LOGIN_RATE_LIMIT_STORE'] == 'sqlite':
+        store = SQLiteBucketStore(config['LOGIN_RATE_LIMIT_DB'], max_keys)
+    else:
+        store = MemoryBucketStore(max_keys)
+    return LoginRateLimiter(store, config['LOGIN_RATE_LIMIT_PER_IP'], config['LOGIN_RATE_LIMIT_PER_USERNAME'])
+
+
+_lock = threading.Lock()
+_limiters = weakref.WeakKeyDictionary()  # 每个程序实例一个限流器
+
+
+def get_limiter():
+    app = current_app._get_current_object()
+    limiter = _limiters.get(app)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(app)
+            if limiter is None:
+                limiter = _limiters[app] = build_limiter(app.config)
+    return limiter
+
+
+def init_proxy_fix(app):
+    """Trust ``X-Forwarded-For`` and ``X-Forwarded-Proto`` from the given
+    number of reverse proxies, so ``request.remote_addr`` (the per-IP login
+    bucket) is the client and not the proxy."""
+    x_for, x_proto = app.config['PROXY_FIX_X_FOR'], app.config['PROXY_FIX_X_PROTO']
+    if x_for or x_proto:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for = x_for, x_proto = x_proto)
+
+
+def login_retry_after(remote_addr, username):
+    """Seconds the client has to wait before trying again, 0 if allowed."""
+    if not current_app.config['LOGIN_RATE_LIMIT_ENABLED']:
+        return 0
+    return get_limiter().hit(remote_addr or '-', username)
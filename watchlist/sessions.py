@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.sessions import SecureCookieSession, SessionInterface, session_json_serializer
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)  # 256 位随机数，无法猜测，因此 Cookie 不需要另外签名
+
+
+class ServerSession(SecureCookieSession):
+    """Session whose data lives in a store; the cookie only holds ``sid``.
+
+    ``sid`` is ``None`` until something is first saved, so visitors who
+    never log in or see a flash message cost nothing in the store.
+    """
+
+    def __init__(self, initial = None, sid = None, expires = 0.0):
+        super(ServerSession, self).__init__(initial)
+        self.sid = sid
+        self.expires = expires
+        self.previous = None
+
+    def regenerate(self):
+        """Move the data to a fresh id (call on login against fixation)."""
+        if self.sid is not None and self.previous is None:
+            self.previous = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class MemorySessionStore(object):
+    """Sessions of one process, least recently saved evicted beyond
+    ``max_entries``.  Only for single-process deployments: other workers
+    would not see the sessions."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()  # sid -> (data, user_id, expires)，按保存时间排序
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, sid, now):
+        entry = self._sessions.get(sid)  # 读取不加锁，每个请求只是一次字典查找
+        if entry is None or entry[2] <= now:
+            return None
+        # 返回副本：flash() 等会原地修改嵌套的列表，同一会话的并发请求不能共享保存的数据
+        return copy.deepcopy(entry[0]), entry[2]
+
+    def set(self, sid, data, user_id, expires):
+        data = copy.deepcopy(data)  # 避免之后对嵌套对象的修改影响保存的数据
+        with self._lock:
+            self._sessions.pop(sid, None)
+            self._sessions[sid] = (data, user_id, expires)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last = False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def revoke(self, user_id):
+        with self._lock:
+            sids = [sid for sid, entry in self._sessions.items() if entry[1] == user_id]
+            for sid in sids:
+                del self._sessions[sid]
+        return len(sids)
+
+    def sweep(self, now):
+        # 有效期等长，按保存顺序排列也就是按过期时间排列，只需从头删除
+        count = 0
+        with self._lock:
+            while self._sessions:
+                sid, entry = next(iter(self._sessions.items()))
+                if entry[2] > now:
+                    break
+                del self._sessions[sid]
+                count += 1
+        return count
+
+
+class SQLiteSessionStore(object):
+    """Sessions shared by all workers through a small SQLite file.
+
+    Like the login buckets the table lives in its own WAL-mode file, so
+    session writes never wait on the application's write lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS session (sid TEXT PRIMARY KEY, user_id TEXT, '
+                     'data TEXT NOT NULL, expires REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_session_user_id ON session (user_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout = 5, isolation_level = None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM session').fetchone()[0]
+
+    def get(self, sid, now):
+        row = self._connect().execute('SELECT data, expires FROM session WHERE sid = ? AND expires > ?',
+                                      (sid, now)).fetchone()
+        if row is None:
+            return None
+        return session_json_serializer.loads(row[0]), row[1]
+
+    def set(self, sid, data, user_id, expires):
+        self._connect().execute('INSERT OR REPLACE INTO session (sid, user_id, data, expires) VALUES (?, ?, ?, ?)',
+                                (sid, user_id, session_json_serializer.dumps(data), expires))
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM session WHERE sid = ?', (sid,))
+
+    def revoke(self, user_id):
+        return self._connect().execute('DELETE FROM session WHERE user_id = ?', (user_id,)).rowcount
+
+    def sweep(self, now):
+        return self._connect().execute('DELETE FROM session WHERE expires <= ?', (now,)).rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep session data (login, flashes, undo) server-side.
+
+    The cookie carries a random id and nothing else, so it stays small
+    and is never HMAC-verified; loading a session is a single lookup.
+    ``PERMANENT_SESSION_LIFETIME`` acts as an idle timeout: the expiry is
+    pushed back (one write) once less than half of it is left.  Expired
+    entries are swept at most every ``SESSION_SWEEP_INTERVAL`` seconds.
+    """
+
+    def __init__(self, store, sweep_interval):
+        self.store = store
+        self.sweep_interval = sweep_interval
+        self._swept_at = time.time()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            entry = self.store.get(sid, time.time())
+            if entry is not None:
+                return ServerSession(entry[0], sid, entry[1])
+        return ServerSession()
+
+    def _sweep(self, now):
+        if now - self._swept_at >= self.sweep_interval:
+            self._swept_at = now
+            self.store.sweep(now)
+
+    def save_session(self, app, session, response):
+        now = time.time()
+        self._sweep(now)
+        name = app.session_cookie_name
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous is not None:  # 更换了 id，旧 id 立即失效
+            self.store.delete(session.previous)
+            session.previous = None
+
+        if not session:
+            if session.sid is not None:  # 登出等清空了会话
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain = domain, path = path)
+            elif session.modified:
+                response.delete_cookie(name, domain = domain, path = path)
+            return
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.sid is None:
+            session.sid = new_sid()
+        elif not session.modified and session.expires - now > lifetime / 2:
+            return  # 数据和 Cookie 都不需要更新
+        session.expires = now + lifetime
+        self.store.set(session.sid, dict(session), session.get('_user_id'), session.expires)
+        response.set_cookie(name, session.sid, expires = self.get_expiration_time(app, session),
+                            httponly = self.get_cookie_httponly(app), domain = domain, path = path,
+                            secure = self.get_cookie_secure(app), samesite = self.get_cookie_samesite(app))
+
+
+def build_store(config):
+    kind = config['SESSION_STORE']
+    if kind == 'memory':
+        return MemorySessionStore(config['SESSION_MAX_ENTRIES'])
+    if kind == 'sqlite':
+        return SQLiteSessionStore(config['SESSION_DB'])
+    return None  # cookie：沿用 Flask 默认的签名 Cookie
+
+
+def init_sessions(app):
+    store = build_store(app.config)
+    if store is not None:
+        app.session_interface = ServerSessionInterface(store, app.config['SESSION_SWEEP_INTERVAL'])
+
+
+def session_store():
+    """The server-side store of the current app, ``None`` for cookie sessions."""
+    return getattr(current_app.session_interface, 'store', None)
+
+
+def regenerate_session():
+    """Give the current session a new id, keeping its data."""
+    current = session._get_current_object()
+    if isinstance(current, ServerSession):
+        current.regenerate()
+
+
+def revoke_sessions(user_id):
+    """Log ``user_id`` out everywhere; return the number of sessions ended,
+    ``None`` when sessions are cookies and cannot be revoked."""
+    store = session_store()
+    if store is None:
+        return None
+    return store.revoke(str(user_id))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import threading
+import weakref
+import zlib
+
+from flask import current_app
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_DOMAIN_RE = re.compile(r'https?://(?:www\.)?([^/\s:?#]+)', re.IGNORECASE)
+
+
+def tokenize(text):
+    """Lower-cased words plus one ``domain:<host>`` token per linked URL."""
+    text = (text or '').lower()
+    tokens = _TOKEN_RE.findall(text)
+    tokens.extend('domain:' + host for host in _DOMAIN_RE.findall(text))
+    return tokens
+
+
+def hash_tokens(tokens, n_features):
+    # crc32 在不同进程间结果一致（内置 hash() 对字符串是随机化的），训练和打分可以在不同进程中进行
+    return sorted({zlib.crc32(token.encode('utf-8')) % n_features for token in tokens})
+
+
+class BlocklistStage(object):
+    """Reject messages linking to a blocklisted domain or containing a
+    blocklisted word; all patterns are compiled into one regex."""
+
+    def __init__(self, patterns):
+        patterns = sorted({p.strip().lower() for p in patterns if p.strip()}, key = len, reverse = True)
+        self.regex = None
+        if patterns:
+            alternation = '|'.join(re.escape(p) for p in patterns)
+            # 域名可以带任意子域名；普通词语按词边界匹配
+            self.regex = re.compile(r'(?<![\w-])(?:[\w-]+\.)*(?:%s)(?![\w-])' % alternation, re.IGNORECASE)
+
+    def score_many(self, texts):
+        if self.regex is None:
+            return [False] * len(texts)
+        search = self.regex.search
+        return [search(text or '') is not None for text in texts]
+
+
+class NaiveBayesStage(object):
+    """Multinomial naive Bayes over hashed token features.
+
+    Only the per-feature log-likelihood ratio is kept, so scoring a message
+    is a gather and a sum over its token ids, and scoring a batch is a
+    single ``np.add.reduceat`` over the concatenated ids of every message.
+    """
+
+    def __init__(self, delta, prior, threshold = 0.0):
+        self.delta = delta  # log P(token|spam) - log P(token|ham)
+        self.prior = prior  # log P(spam) - log P(ham)
+        self.threshold = threshold
+        self.n_features = len(delta)
+
+    @classmethod
+    def train(cls, texts, labels, n_features = 2 ** 18, alpha = 1.0):
+        import numpy as np
+        counts = np.zeros((2, n_features), dtype = np.float64)
+        docs = np.zeros(2, dtype = np.float64)
+        for text, label in zip(texts, labels):
+            label = 1 if label else 0
+            counts[label, hash_tokens(tokenize(text), n_features)] += 1
+            docs[label] += 1
+        if not docs.all():
+            raise ValueError('Training data needs both spam and ham examples.')
+        smoothed = counts + alpha
+        log_prob = np.log(smoothed / smoothed.sum(axis = 1, keepdims = True))
+        delta = (log_prob[1] - log_prob[0]).astype(np.float32)
+        prior = float(np.log(docs[1] / docs[0]))
+        return cls(delta, prior)
+
+    def log_odds_many(self, texts):
+        import numpy as np
+        ids = [hash_tokens(tokenize(text), self.n_features) for text in texts]
+        lengths = np.fromiter((len(i) for i in ids), dtype = np.int64, count = len(ids))
+        flat = np.fromiter((f for i in ids for f in i), dtype = np.int64, count = int(lengths.sum()))
+        scores = np.full(len(texts), self.prior, dtype = np.float64)
+        nonempty = lengths > 0
+        if flat.size:
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))[nonempty]
+            scores[nonempty] += np.add.reduceat(self.delta[flat], offsets)
+        return scores
+
+    def score_many(self, texts):
+        return (self.log_odds_many(texts) > self.threshold).tolist()
+
+    def save(self, path):
+        import numpy as np
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, delta = self.delta, prior = np.array([self.prior]))
+        os.replace(tmp, path)  # 原子替换，正在运行的进程不会读到写了一半的模型
+
+    @classmethod
+    def load(cls, path, threshold = 0.0):
+        import numpy as np
+        with np.load(path) as data:
+            return cls(data['delta'], float(data['prior'][0]), threshold)
+
+
+class SpamFilter(object):
+    """Ordered list of stages; a message is spam as soon as one stage says so.
+
+    Every stage implements ``score_many(texts) -> [bool, ...]``, so further
+    checks can be plugged in by appending to ``stages``.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def score_many(self, texts):
+        result = [False] * len(texts)
+        pending = list(range(len(texts)))
+        for stage in self.stages:
+            if not pending:
+                break
+            flags = stage.score_many([texts[i] for i in pending])
+            for i, flag in zip(pending, flags):
+                result[i] = flag
+            pending = [i for i, flag in zip(pending, flags) if not flag]
+        return result
+
+    def is_spam(self, text):
+        return self.score_many([text])[0]
+
+
+def load_blocklist(config):
+    patterns = list(config['SPAM_BLOCKLIST'])
+    path = config['SPAM_BLOCKLIST_FILE']
+    if path and os.path.exists(path):
+        with open(path, encoding = 'utf-8') as f:
+            patterns.extend(line for line in f if not line.startswith('#'))
+    return patterns
+
+
+def build_filter(config):
+    stages = [BlocklistStage(load_blocklist(config))]
+    path = config['SPAM_MODEL_PATH']
+    if path and os.path.exists(path):
+        stages.append(NaiveBayesStage.load(path, config['SPAM_THRESHOLD']))
+    return SpamFilter(stages)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+def filter_stamp(config):
+    # 模型和黑名单文件的修改时间，任何一个变化（包括出现或删除）都重新加载
+    return _mtime(config['SPAM_MODEL_PATH']), _mtime(config['SPAM_BLOCKLIST_FILE'])
+
+
+_lock = threading.Lock()
+_filters = weakref.WeakKeyDictionary()  # 每个程序实例一个 (修改时间, 过滤器)
+
+
+def get_filter():
+    """Return the filter of the current app.  It is built once per process
+    and rebuilt when ``flask train-spam`` (or an edit of the blocklist file)
+    changes the files, so running workers pick up a new model without a
+    restart; the check is one ``stat`` per file."""
+    app = current_app._get_current_object()
+    stamp = filter_stamp(app.config)
+    entry = _filters.get(app)
+    if entry is None or entry[0] != stamp:
+        with _lock:
+            entry = _filters.get(app)
+            if entry is None or entry[0] != stamp:
+                entry = _filters[app] = (stamp, build_filter(app.config))
+    return entry[1]
+
+
+def reset_filter():
+    """Drop cached filters, e.g. after changing the configuration."""
+    with _lock:
+        _filters.clear()
+
+
+def is_spam(content):
+    if not current_app.config['SPAM_FILTER_ENABLED']:
+        return False
+    return get_filter().is_spam(content)
@@ -0,0 +1,28 @@
+// 订阅 /events，把新留言插入到列表顶部，不需要刷新页面
+(function () {
+    var list = document.querySelector('[data-live]');
+    if (!list || !window.EventSource) {
+        return;
+    }
+    var counter = document.querySelector('[data-live-count]');
+    var source = new EventSource(list.getAttribute('data-live'));
+
+    source.addEventListener('message', function (e) {
+        var message = JSON.parse(e.data);
+        var item = document.createElement('li');
+        var title = document.createElement('h3');
+        var time = document.createElement('small');
+        var content = document.createElement('p');
+        title.textContent = message.name + ' ';  // textContent 会转义内容，防止注入 HTML
+        time.className = 'timestamp';
+        time.textContent = message.created_at.slice(0, 16).replace('T', ' ');
+        content.textContent = message.content;
+        title.appendChild(time);
+        item.appendChild(title);
+        item.appendChild(content);
+        list.insertBefore(item, list.firstChild);
+        if (counter) {
+            counter.textContent = parseInt(counter.textContent, 10) + 1;
+        }
+    });
+})();
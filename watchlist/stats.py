@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+
+from sqlalchemy import func
+
+from watchlist import db
+from watchlist.models import Message, Movie, Stat, Version
+
+
+def rebuild_stats(batch_size = 10000):
+    """Recompute the summary table in one streaming pass over the live
+    movies and the messages; return the number of summary rows."""
+    counts = Counter()  # 内存占用只取决于不同年份、月份和留言人的个数
+    movies = db.session.query(Movie.year).filter(Movie.deleted_at.is_(None)).yield_per(batch_size)
+    counts.update(Stat.count(Movie, ({'year': year} for year, in movies)))
+    messages = db.session.query(Message.name, Message.created_at).yield_per(batch_size)
+    counts.update(Stat.count(Message, ({'name': name, 'created_at': created_at} for name, created_at in messages)))
+
+    table = Stat.__table__
+    db.session.execute(table.delete())
+    rows = [{'kind': kind, 'key': key, 'value': value} for (kind, key), value in counts.items() if value > 0]
+    if rows:
+        db.session.execute(table.insert(), rows)
+    Version.bump('stat')  # 统计页面的缓存依赖该版本号
+    db.session.commit()
+    return len(rows)
+
+
+def decade(year):
+    """``'1988'`` -> ``'1980s'``; years that are not four digits (the form
+    only checks the length) go to ``'other'``."""
+    if len(year) == 4 and year.isdigit():
+        return '%s0s' % year[:3]
+    return 'other'
+
+
+def _rows(kind):
+    return db.session.query(Stat.key, Stat.value).filter(Stat.kind == kind, Stat.value > 0)
+
+
+def summary(months = 12, top = 10):
+    """Counts for the stats page, read from the summary table only, so
+    the cost does not depend on the number of movies or messages."""
+    years = sorted(_rows('movie_year'))
+    decades = Counter()
+    for year, count in years:
+        decades[decade(year)] += count
+    monthly = _rows('message_month').order_by(Stat.key.desc()).limit(months).all()
+    posters = _rows('message_name').order_by(Stat.value.desc(), Stat.key).limit(top).all()
+    messages = db.session.query(func.sum(Stat.value)).filter(Stat.kind == 'message_month').scalar()
+    return {
+        'movies': sum(count for _, count in years),
+        'messages': messages or 0,
+        'years': [{'year': year, 'count': count} for year, count in years],
+        'decades': [{'decade': name, 'count': count}
+                    for name, count in sorted(decades.items(), key = lambda item: (item[0] == 'other', item[0]))],
+        'months': [{'month': month, 'count': count} for month, count in reversed(monthly)],
+        'posters': [{'name': name, 'count': count} for name, count in posters],
+    }
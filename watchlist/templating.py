@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+
+from flask import current_app, request, url_for
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from watchlist.cache import fragment_cache
+
+
+class FragmentCacheExtension(Extension):
+    """``{% cache key, ... %}...{% endcache %}`` stores the rendered block.
+
+    The key parts are joined into the cache key, so including the table
+    version makes a fragment stale as soon as the data changes.
+    """
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle = True)
+        return nodes.CallBlock(
+            self.call_method('_cache_support', [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cache_support(self, parts, caller):
+        backend = fragment_cache.backend
+        if backend is None:
+            return caller()
+        key = 'fragment:' + '|'.join(str(part) for part in parts)
+        html = backend.get(key)
+        if html is None:
+            html = str(caller())
+            backend.set(key, html, fragment_cache.timeout)
+        return Markup(html)  # 缓存中保存的是已转义的 HTML
+
+
+def table_version(name):
+    """Version counter of ``name``, read at most once per request."""
+    from watchlist.models import Version
+    versions = request.environ.setdefault('watchlist.table_versions', {})
+    if name not in versions:
+        versions[name] = Version.current(name)
+    return versions[name]
+
+
+def static_url(filename):
+    """Memoised ``url_for('static', filename=...)``."""
+    urls = current_app.extensions.setdefault('static_urls', {})
+    key = (request.script_root, filename)
+    url = urls.get(key)
+    if url is None:
+        url = urls[key] = url_for('static', filename = filename)
+    return url
+
+
+def init_templating(app):
+    directory = app.config['JINJA_BYTECODE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals.update(table_version = table_version, static_url = static_url)
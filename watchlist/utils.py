@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from flask import current_app, request
+from sqlalchemy import func, literal, tuple_
+
+
+def _text(value, length):
+    # JSON 导入和 API 中的值可能是数字、列表等，只接受字符串
+    return isinstance(value, str) and 0 < len(value) <= length
+
+
+def validate_movie(title, year):
+    """Server-side validation shared by the movie forms and bulk imports."""
+    return _text(title, 60) and validate_year(year)
+
+
+def validate_year(year):
+    return _text(year, 4)
+
+
+def validate_message(name, content):
+    """Server-side validation shared by the guestbook form and bulk imports."""
+    return _text(name, 20) and _text(content, 200)
+
+
+def batched(iterable, size):
+    """Yield lists of at most ``size`` items from ``iterable``."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class KeysetPage(object):
+    """One page of a keyset (cursor) paginated query."""
+
+    def __init__(self, items, total, per_page, prev_cursor = None, next_cursor = None):
+        self.items = items
+        self.total = total  # 总行数，由 SQL 的 COUNT(*) 计算
+        self.per_page = per_page
+        self.prev_cursor = prev_cursor  # 上一页游标，对应 ?before=<id>
+        self.next_cursor = next_cursor  # 下一页游标，对应 ?after=<id>
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def get_per_page():
+    """Read ``?per_page=`` from the request, capped by the configuration."""
+    per_page = request.args.get('per_page', type = int) or current_app.config['WATCHLIST_PER_PAGE']
+    return max(1, min(per_page, current_app.config['WATCHLIST_MAX_PER_PAGE']))
+
+
+def _cursor(columns, item):
+    if len(columns) == 1:
+        return getattr(item, columns[0].key)
+    # 多列游标写成 值_值 的形式，例如 2020-01-01T08:00:00_42
+    return '_'.join(value.isoformat() if isinstance(value, datetime) else str(value)
+                    for value in (getattr(item, column.key) for column in columns))
+
+
+def _parse_cursor(columns, name):
+    """Read ``?<name>=`` as a tuple of column values, ``None`` if absent or malformed."""
+    if len(columns) == 1:
+        value = request.args.get(name, type = int)
+        return None if value is None else (value,)
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    parts = raw.split('_')
+    if len(parts) != len(columns):
+        return None
+    try:
+        return tuple(datetime.fromisoformat(part) if column.type.python_type is datetime else int(part)
+                     for column, part in zip(columns, parts))
+    except ValueError:
+        return None
+
+
+def _compare(columns, values, greater):
+    if len(columns) == 1:
+        return columns[0] > values[0] if greater else columns[0] < values[0]
+    # 行值比较，(a, b) > (x, y)，可以直接在 (a, b) 组合索引上做范围扫描
+    key = tuple_(*columns)
+    values = tuple_(*[literal(value, column.type) for column, value in zip(columns, values)])
+    return key > values if greater else key < values
+
+
+def keyset_paginate(query, column, per_page = None, descending = False):
+    """Paginate ``query`` on the monotonic ``column`` (usually the primary key).
+
+    ``?after=<id>`` moves forward and ``?before=<id>`` moves backward, so every
+    page is an index range scan of at most ``per_page + 1`` rows no matter
+    how deep the visitor has paged, unlike ``OFFSET``.  With ``descending``
+    the first page holds the highest values and ``after`` moves to lower ones.
+    ``column`` may also be a tuple such as ``(created_at, id)`` whose last
+    column is unique; the cursors are then strings.
+    """
+    if per_page is None:
+        per_page = get_per_page()
+    columns = column if isinstance(column, tuple) else (column,)
+    after = _parse_cursor(columns, 'after')
+    before = _parse_cursor(columns, 'before')
+
+    # 统计总数交给数据库完成，而不是在模板中对整张表的列表调用 |length
+    total = query.with_entities(func.count(columns[-1])).order_by(None).scalar()
+
+    forward = [c.desc() if descending else c.asc() for c in columns]
+    backward = [c.asc() if descending else c.desc() for c in columns]
+    if before is not None:
+        rows = query.filter(_compare(columns, before, descending)) \
+            .order_by(*backward).limit(per_page + 1).all()
+        items = rows[:per_page][::-1]
+        prev_cursor = _cursor(columns, items[0]) if len(rows) > per_page else None
+        next_cursor = _cursor(columns, items[-1]) if items else None
+    else:
+        if after is not None:
+            query = query.filter(_compare(columns, after, not descending))
+        rows = query.order_by(*forward).limit(per_page + 1).all()
+        items = rows[:per_page]
+        prev_cursor = _cursor(columns, items[0]) if after is not None and items else None
+        next_cursor = _cursor(columns, items[-1]) if len(rows) > per_page else None
+
+    return KeysetPage(items, total, per_page, prev_cursor, next_cursor)
@@ -1,54 +1,136 @@
 # -*- coding: utf-8 -*-
-from flask import request, url_for, redirect, flash, render_template
+import time
+from datetime import datetime
+
+from flask import Blueprint, request, url_for, redirect, flash, render_template, jsonify, abort, current_app, \
+    Response, session
 from flask_login import login_user, login_required, logout_user, current_user
 
-from watchlist import app, db
-from watchlist.models import Movie, User, Message
+from watchlist import db
+from watchlist.cache import conditional, response_cache, user_cache
+from watchlist.database import read_replica
+from watchlist.events import KINDS as EVENT_KINDS, BrokerFull, broker, message_event, movie_event
+from watchlist.ingest import message_writer
+from watchlist.models import Movie, User, Message, Stat, Version
+from watchlist.search import KINDS, search as search_index
+from watchlist.security import PasswordCheckUnavailable, dummy_hash, login_retry_after, needs_rehash, password_hasher
+from watchlist.sessions import regenerate_session, revoke_sessions, session_store
+from watchlist.stats import summary as stats_summary
+from watchlist.spam import is_spam
+from watchlist.utils import get_per_page, keyset_paginate, validate_message, validate_movie, validate_year
+
+main = Blueprint('main', __name__)  # 页面视图蓝本
+
+def page_owner(username = None):
+    """The user whose list is shown: ``/u/<username>``, otherwise the
+    logged-in user, otherwise the site owner."""
+    if username is not None:
+        owner = user_cache.by_username(username)
+        if owner is None:
+            abort(404)
+        return owner
+    if current_user.is_authenticated:
+        return current_user
+    return user_cache.owner()
+
+def owner_version(username = None):
+    owner = page_owner(username)
+    return Movie.version_key(owner.id if owner else None)
+
+def bump_movies(user_id):
+    # 全局版本号供 API 和搜索使用，用户版本号只影响该用户的页面；
+    # 先读后写的操作要在读取前调用：第一条 UPDATE 使 SQLite 开始事务并取得写锁，之后读到的是最新数据
+    Version.bump('movie')
+    Version.bump(Movie.version_key(user_id))
+
+def undo_state(username = None):
+    # 撤销按钮只在撤销期限内显示，期限写入 ETag，过期后重新验证会得到没有按钮的页面
+    undo = session.get('undo')
+    return 'undo=%s' % undo['until'] if undo is not None and undo['until'] > time.time() else ''
+
+def render_movies(owner):
+    # 只查询该用户的条目，(user_id, id) 索引使分页和计数的开销与该用户的条目数成正比
+    page = keyset_paginate(Movie.live().filter(Movie.user_id == (owner.id if owner else None)), Movie.id)
+    editable = owner is not None and current_user.is_authenticated and current_user.id == owner.id
+    undo = session.get('undo')
+    can_undo = editable and undo is not None and undo['until'] > time.time()
+    return render_template('index.html', page = page, user = owner, editable = editable, can_undo = can_undo,
+                           version_key = Movie.version_key(owner.id if owner else None))
 
 # 主页 viewfunciont
-@app.route('/', methods = ['GET', 'POST'])
+@main.route('/', methods = ['GET', 'POST'])
+@read_replica  # GET 请求从只读副本读取（未配置副本时不起作用）
+@conditional(owner_version, state = undo_state)  # 该用户的数据未变化时直接返回 304
+@response_cache.cached  # 匿名 GET 请求直接返回缓存的页面
 def index():
     if request.method == 'POST':  # 提交添加电影条目的表单
         if not current_user.is_authenticated: 
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
 
         title = request.form.get('title')
         # title = request.form['title']
         year = request.form.get('year')
         # 仅靠在<input>内添加required属性实现客户端验证并不完全可靠，还要在服务器端追加验证
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not validate_movie(title, year):
             flash('Invalid input.')  
-            return redirect(url_for('index')) 
+            return redirect(url_for('.index')) 
         
-        movie = Movie(title = title, year = year)
+        movie = Movie(title = title, year = year, user_id = current_user.id)
         db.session.add(movie)  # 添加到数据会话
+        Stat.record(Stat.count(Movie, [{'year': year}]))  # 汇总计数与条目在同一事务中更新
+        bump_movies(current_user.id)  # 更新版本号，使 ETag 和缓存的页面失效
         db.session.commit()  # 提交到数据库
+        broker.publish('movie', movie_event('create', movie, current_user.username))  # 提交后再推送
         flash('Item created.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
-    movies = Movie.query.all()  # 读取所有电影记录
-    return render_template('index.html', movies = movies)
+    return render_movies(page_owner())
 
-@app.route('/message', methods = ['GET', 'POST'])
+# 用户的观影清单
+@main.route('/u/<username>')
+@read_replica
+@conditional(owner_version, state = undo_state)
+@response_cache.cached
+def user_page(username):
+    return render_movies(page_owner(username))
+
+@main.route('/message', methods = ['GET', 'POST'])
+@read_replica
+@conditional('message')
+@response_cache.cached
 def message():
     if request.method == 'POST':
         name = request.form.get('name')
         content = request.form.get('content')
-        if not name or not content or len(name)>20 or len(content)>200:
+        if not validate_message(name, content):
             flash('Invalid input.')
-            return redirect(url_for('message'))
-    
-        message = Message(name = name, content = content)
+            return redirect(url_for('.message'))
+        if is_spam(content):  # 垃圾留言直接拒绝，不写入数据库
+            flash('Message rejected as spam.')
+            return redirect(url_for('.message'))
+
+        if current_app.config['MESSAGE_INGEST_ASYNC']:  # 异步写入：放入队列后立即返回
+            if not message_writer.submit(name, content):
+                abort(503)  # 队列已满
+            flash('Message received.')
+            return redirect(url_for('.message'))
+
+        message = Message(name = name, content = content, created_at = datetime.utcnow())
         db.session.add(message)
+        Stat.record(Stat.count(Message, [{'name': name, 'created_at': message.created_at}]))
+        Version.bump('message')
         db.session.commit()
+        broker.publish('message', message_event(
+            {'id': message.id, 'name': name, 'content': content, 'created_at': message.created_at}))
         flash('Message created.')
-        return redirect(url_for('message'))
+        return redirect(url_for('.message'))
 
-    messages = Message.query.all()
-    return render_template('message.html', messages = messages)
+    # 最新的留言在第一页最上面；按留言时间而不是 id 排序，导入的旧留言排在它们的时间位置
+    page = keyset_paginate(Message.query, (Message.created_at, Message.id), descending = True)
+    return render_template('message.html', page = page)
 
 # 用户登录
-@app.route('/login', methods = ['GET', 'POST'])
+@main.route('/login', methods = ['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -56,30 +138,63 @@ def login():
 
         if not username or not password:
             flash('Invalid input.')
-            return redirect(url_for('login'))
-        
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):  # 验证用户名、密码是否一致
+            return redirect(url_for('.login'))
+
+        # 先限流再计算散列，暴力破解的请求不会占用 CPU
+        retry_after = login_retry_after(request.remote_addr, username)
+        if retry_after:
+            flash('Too many login attempts, please try again later.')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+
+        user = User.query.filter_by(username = username).first()  # 用户名上有唯一索引
+        # 用户不存在时也计算一次散列，响应时间不会暴露用户名是否存在
+        pwhash = user.password_hash if user is not None else dummy_hash(current_app.config['PASSWORD_HASH_METHOD'])
+        try:
+            valid = password_hasher.check(pwhash, password) and user is not None
+        except PasswordCheckUnavailable:
+            abort(503)
+        if valid:  # 验证用户名、密码是否一致
+            if needs_rehash(user.password_hash, current_app.config['PASSWORD_HASH_METHOD']):
+                try:  # 按当前的算法和参数重新散列，失败时下次登录再试
+                    user.password_hash = password_hasher.hash(password)
+                    Version.bump('user')
+                    db.session.commit()
+                    user_cache.clear()
+                except PasswordCheckUnavailable:
+                    pass
+            regenerate_session()  # 登录后更换会话 id，防止会话固定攻击
             login_user(user)  # 登入用户
             flash('Login success.')
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         
         flash('Invalid username or password.')
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
 
     return render_template('login.html')
 
 # 用户登出
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('Goodbye.')
 
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+# 登出所有设备：删除该用户在服务端保存的全部会话
+@main.route('/logout/all', methods = ['POST'])
+@login_required
+def logout_all():
+    count = revoke_sessions(current_user.id)
+    logout_user()
+    if count is None:  # Cookie 会话无法撤销，只能登出当前设备
+        flash('Goodbye.')
+    else:
+        flash('Logged out of %d sessions.' % count)
+    return redirect(url_for('.index'))
 
 # 设置(可更改用户名字name)
-@app.route('/settings', methods = ['GET', 'POST'])
+@main.route('/settings', methods = ['GET', 'POST'])
 @login_required
 def settings():
     if request.method == 'POST':
@@ -87,51 +202,184 @@ def settings():
 
         if not name or len(name) > 20:
             flash('Invalid input.')
-            return redirect(url_for('settings'))
-        current_user.name = name
-        # 如果不用current_user，则可以如下用法,因为该程序只能给一个人使用
-        # user = User.query.first()
-        # user.name = name
+            return redirect(url_for('.settings'))
+        # current_user 来自用户缓存，是脱离会话的对象，需要重新查询后再修改
+        user = User.query.get(current_user.id)
+        user.name = name
+        Version.bump('user')  # 通知其他进程用户信息已变化
         db.session.commit()
+        user_cache.clear()
+        response_cache.clear()
         flash('Settings updated.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
-    return render_template('settings.html')
+    return render_template('settings.html', revocable = session_store() is not None)
 
 # 编辑条目 view function
-@app.route('/movie/edit/<int:movie_id>', methods = ['GET', 'POST'])
+@main.route('/movie/edit/<int:movie_id>', methods = ['GET', 'POST'])
 @login_required  # 认证保护
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
+    movie = Movie.live().filter_by(id = movie_id, user_id = current_user.id).first_or_404()  # 只能编辑自己的条目
 
     if request.method == 'POST':  # 处理编辑表单请求
         title = request.form['title']
         year = request.form['year']
 
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        if not validate_movie(title, year):
             flash('Invalid input.')  
-            return redirect(url_for('edit', movie_id = movie_id))  
+            return redirect(url_for('.edit', movie_id = movie_id))  
 
+        bump_movies(current_user.id)
+        db.session.refresh(movie, with_for_update = True)  # 在写事务中重新读取，并发的编辑不会覆盖彼此的计数
+        if movie.deleted_at is not None:
+            db.session.rollback()
+            abort(404)
+        if year != movie.year:  # 汇总计数从旧年份移到新年份
+            counts = Stat.count(Movie, [{'year': movie.year}], -1)
+            counts.update(Stat.count(Movie, [{'year': year}]))
+            Stat.record(counts)
+        if (title, year) != (movie.title, movie.year):  # 元数据属于原来的电影，由下一次 flask enrich 重新获取
+            movie.clear_enrichment()
         movie.title = title  # 更新条目
-        movie.year = year        
+        movie.year = year
+        event = movie_event('update', movie, current_user.username)  # 提交后属性会过期，提交前生成事件
         db.session.commit()  # 修改原有条目可以直接提交
+        broker.publish('movie', event)
         flash('Item updated.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     return render_template('edit.html', movie = movie)  # 显示将被编辑的电影记录
 
 # 删除条目
-@app.route('/movie/delete/<int:movie_id>', methods = ['POST'])  # 安全起见，一般用POST请求来执行删除
+@main.route('/movie/delete/<int:movie_id>', methods = ['POST'])  # 安全起见，一般用POST请求来执行删除
 @login_required
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
-    db.session.delete(movie)  # 删除
-    db.session.commit()
+    movie = Movie.live().filter_by(id = movie_id, user_id = current_user.id).first_or_404()
+    event = movie_event('delete', movie, current_user.username)
+    delete_movies([movie_id])  # 软删除，可以撤销
+    broker.publish('movie', event)
     flash('Item deleted.')
 
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+def delete_movies(ids):
+    """Soft delete the current user's ``ids`` and remember the batch for
+    undo; return the ids that were deleted."""
+    bump_movies(current_user.id)
+    deleted, stamp = Movie.soft_delete(current_user.id, ids)
+    if deleted:
+        db.session.commit()
+        session['undo'] = {'stamp': stamp.isoformat(), 'until': time.time() + current_app.config['MOVIE_UNDO_SECONDS']}
+    else:
+        db.session.rollback()  # 没有变化，撤销版本号的更新
+    return deleted
+
+# 批量操作：勾选的条目用一条 UPDATE 语句删除或修改年份
+@main.route('/movie/bulk', methods = ['POST'])
+@login_required
+def bulk():
+    ids = request.form.getlist('ids', type = int)
+    action = request.form.get('action')
+    if not ids or action not in ('delete', 'year'):
+        flash('Invalid input.')
+        return redirect(url_for('.index'))
+
+    if action == 'delete':
+        deleted = delete_movies(ids)
+        if deleted:  # 只推送确实删除的条目，其他用户的和已删除的 id 不会被广播
+            broker.publish('movie', {'action': 'delete', 'ids': deleted, 'user': current_user.username})
+        flash('%d items deleted.' % len(deleted))
+        return redirect(url_for('.index'))
+
+    year = request.form.get('year')
+    if not validate_year(year):
+        flash('Invalid input.')
+        return redirect(url_for('.index'))
+    bump_movies(current_user.id)
+    updated = Movie.bulk_update(current_user.id, ids, year = year)
+    if updated:
+        db.session.commit()
+        broker.publish('movie', {'action': 'update', 'ids': updated, 'year': year, 'user': current_user.username})
+    else:
+        db.session.rollback()
+    flash('%d items updated.' % len(updated))
+    return redirect(url_for('.index'))
+
+# 撤销最近一次删除，只在 MOVIE_UNDO_SECONDS 秒内有效
+@main.route('/movie/undo', methods = ['POST'])
+@login_required
+def undo():
+    batch = session.pop('undo', None)
+    if batch is None or batch['until'] <= time.time():
+        flash('Nothing to undo.')
+        return redirect(url_for('.index'))
+    bump_movies(current_user.id)
+    count = Movie.restore(current_user.id, datetime.fromisoformat(batch['stamp']))
+    if count:
+        db.session.commit()
+        broker.publish('movie', {'action': 'restore', 'count': count, 'user': current_user.username})
+    else:
+        db.session.rollback()
+    flash('%d items restored.' % count)
+    return redirect(url_for('.index'))
 
 # space
-@app.route('/space')
+@main.route('/space')
+@response_cache.cached
 def space():
     return render_template('space.html')
+
+# 统计：按年份和年代的电影数、每月留言数和留言最多的人，都从汇总表读取
+@main.route('/stats')
+@read_replica
+@conditional('movie', 'message', 'stat')
+@response_cache.cached
+def stats():
+    return render_template('stats.html', stats = stats_summary())
+
+@main.route('/stats.json')
+@read_replica
+@conditional('movie', 'message', 'stat')
+def stats_json():
+    return jsonify(stats_summary())
+
+# 全文搜索，基于 SQLite FTS5，按相关度排序
+def _search_results():
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind', 'movie')
+    if kind not in KINDS:
+        kind = 'movie'
+    page = max(request.args.get('page', 1, type = int), 1)
+    return query, kind, search_index(kind, query, page, get_per_page())
+
+@main.route('/search')
+def search():
+    query, kind, results = _search_results()
+    return render_template('search.html', query = query, kind = kind, results = results)
+
+@main.route('/search.json')
+def search_json():
+    query, kind, results = _search_results()
+    return jsonify(
+        query = query, kind = kind, page = results.page, pages = results.pages,
+        total = results.total, items = results.items
+    )
+
+
+# 实时推送新留言和电影条目的变化（Server-Sent Events），?kind= 可以只订阅一种事件
+@main.route('/events')
+def events():
+    if not current_app.config['EVENTS_ENABLED']:
+        abort(404)
+    kinds = set(request.args.getlist('kind')) & set(EVENT_KINDS) or set(EVENT_KINDS)
+    last_event_id = request.headers.get('Last-Event-ID', type = int)
+    try:
+        subscriber = broker.subscribe(kinds, last_event_id)
+    except BrokerFull:
+        abort(503)
+    # 生成器不使用程序上下文和数据库连接，空闲的连接只占用一个缓冲区
+    stream = broker.stream(subscriber, current_app.config['EVENTS_HEARTBEAT'])
+    return Response(stream, mimetype = 'text/event-stream', headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # 关闭 Nginx 的响应缓冲
+    })
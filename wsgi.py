@@ -6,4 +6,9 @@ dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
-from watchlist import app
\ No newline at end of file
+from watchlist import create_app
+
+# /events 的每个连接会一直占用一个工作线程；需要保持大量空闲连接时使用协程 worker，例如
+# gunicorn -k gevent --worker-connections 5000 wsgi:app（gevent worker 会自动给 threading 等模块打补丁）
+
+app = create_app(os.getenv('FLASK_CONFIG', 'production'), cli = False)